@@ -0,0 +1,268 @@
+# # Benchmark of the dx-privacy mechanism
+# Times each stage of the mechanism (noise sampling, nearest neighbor search, ranking, post-processing fix and the
+# text-by-text wrappers of utils/text_lm.py) on synthetic vocabularies of the shapes of the experiments, for each
+# backend and chunk size, and reports the throughput in tokens per second and the peak memory (see utils/benchmark.py).
+# No model is downloaded. Results are saved as JSON in ROOT_SAVE_FOLDER/benchmarks (or ./benchmarks), along with the
+# commit and the machine, and compared with a previous run if baseline is set.
+
+import importlib.util
+import json
+import numpy as np
+import os
+from os.path import join
+from dotenv import load_dotenv
+from utils.dx import (
+    sample_noise_vectors_np,
+    prepare_vocabulary,
+    noisy_embeddings_to_ids_cp_chunked,
+    dx_post_processing,
+)
+from utils.tools import rank_neighbors
+from utils.memory import get_planner
+from utils.text_lm import (
+    nearest_neighbor_search_on_textsV2,
+    apply_post_processing_on_textsV2,
+)
+from utils.benchmark import (
+    VOCABULARY_SHAPES,
+    synthetic_vocabulary,
+    synthetic_texts,
+    measure,
+    machine_info,
+    save_results,
+    compare_results,
+)
+from utils.files import print_timed
+
+load_dotenv()
+
+# BEGIN PARAMETERS
+# Keys of utils.benchmark.VOCABULARY_SHAPES
+vocabularies = ["bart/8", "llama3/16", "bart", "llama3"]
+backends = ["numpy", "cupy"]  # Backends not installed are skipped
+# Chunk sizes of the nearest neighbor search and ranking, None for the chunk size of utils/memory.py
+chunk_sizes = [None, 256, 1024]
+tokens = 2048  # Number of noisy embeddings processed by each stage
+# Number of embeddings ranked, the output has vocab_size ids per embedding
+rank_tokens = 128
+number_of_texts = 8  # Texts processed by the *_on_textsV2 wrappers
+text_length = 512
+epsilon = 10
+dx_constant = 0.006
+distance_metric = "euclidean"
+repetitions = 3
+baseline = None  # e.g. "benchmarks/benchmark_20250101T000000+0000_0123abcd.json" to print the speedups over a previous run
+# END PARAMETERS
+
+save_folderpath = join(os.environ.get("ROOT_SAVE_FOLDER", "."), "benchmarks")
+available_backends = [
+    b for b in backends if b != "cupy" or importlib.util.find_spec("cupy") is not None
+]
+if available_backends != backends:
+    print_timed("CuPy is not installed, the cupy backend is skipped")
+
+run = {
+    "machine": machine_info(available_backends),
+    "parameters": {
+        "tokens": tokens,
+        "rank_tokens": rank_tokens,
+        "number_of_texts": number_of_texts,
+        "text_length": text_length,
+        "epsilon": epsilon,
+        "dx_constant": dx_constant,
+        "distance_metric": distance_metric,
+        "repetitions": repetitions,
+    },
+    "results": [],
+}
+
+
+def record(
+    name: str,
+    backend: str,
+    stage: str,
+    requested_chunk_size: int | None,
+    chunk_size: int | None,
+    measurement: dict,
+) -> None:
+    vocab_size, hidden_size = VOCABULARY_SHAPES[name]
+    result = {
+        "vocabulary": name,
+        "vocab_size": vocab_size,
+        "hidden_size": hidden_size,
+        "backend": backend,
+        "stage": stage,
+        "requested_chunk_size": requested_chunk_size,
+        "chunk_size": chunk_size,
+        **measurement,
+    }
+    run["results"].append(result)
+    print_timed(
+        f"{name} {backend} {stage} chunk_size={chunk_size}: {result['tokens_per_second']:.0f} tokens/s, "
+        f"peak {result['peak_bytes'] / 2**20:.1f} MiB"
+    )
+
+
+def benchmark_vocabulary(name: str) -> None:
+    """Records the results of all stages for the synthetic vocabulary name, each backend and chunk size."""
+    vocab_size, hidden_size = VOCABULARY_SHAPES[name]
+    print_timed(f"Synthetic vocabulary {name} of shape {vocab_size}x{hidden_size}")
+    vocabulary = synthetic_vocabulary(vocab_size, hidden_size)
+    rng = np.random.default_rng(0)
+    embeddings = vocabulary[rng.integers(0, vocab_size, tokens)]
+
+    # The noise is sampled on CPU whatever the backend
+    record(
+        name,
+        "numpy",
+        "sample_noise_vectors_np",
+        None,
+        None,
+        measure(
+            lambda: sample_noise_vectors_np(
+                hidden_size, 1, tokens, epsilon, n_threads=os.cpu_count()
+            ),
+            tokens,
+            "numpy",
+            repetitions,
+        ),
+    )
+    noisy_embeddings = (
+        embeddings + sample_noise_vectors_np(hidden_size, 1, tokens, epsilon)[0]
+    )
+    texts_ids, attention_mask = synthetic_texts(
+        vocab_size, number_of_texts, text_length
+    )
+    texts_embeddings = vocabulary[texts_ids] + sample_noise_vectors_np(
+        hidden_size, number_of_texts, text_length, epsilon
+    )
+    text_tokens = int(attention_mask.sum())
+
+    for backend in available_backends:
+        vocab_backend = prepare_vocabulary(vocabulary, distance_metric, backend)
+        for requested_chunk_size in chunk_sizes:
+            if backend == "numpy":
+                chunk_size = requested_chunk_size or vocab_backend.best_chunk_size(
+                    "nearest"
+                )
+                search = lambda: vocab_backend.search(noisy_embeddings, chunk_size)
+            else:
+                chunk_size = requested_chunk_size or get_planner("cupy").chunk_size(
+                    "nearest", vocabulary.shape, hidden_size
+                )
+                search = lambda: noisy_embeddings_to_ids_cp_chunked(
+                    noisy_embeddings, vocab_backend, distance_metric, chunk_size
+                )
+            record(
+                name,
+                backend,
+                "nearest_neighbor_search",
+                requested_chunk_size,
+                chunk_size,
+                measure(search, tokens, backend, repetitions),
+            )
+
+            # rank_neighbors (cupy) uses the chunk size of utils/memory.py
+            if backend == "numpy" or requested_chunk_size is None:
+                if backend == "numpy":
+                    chunk_size = requested_chunk_size or vocab_backend.best_chunk_size(
+                        "rank"
+                    )
+                    rank = lambda: vocab_backend.rank(
+                        noisy_embeddings[:rank_tokens], chunk_size
+                    )
+                else:
+                    chunk_size = get_planner("cupy").chunk_size(
+                        "rank", vocabulary.shape, hidden_size
+                    )
+                    rank = lambda: rank_neighbors(
+                        noisy_embeddings[:rank_tokens], vocab_backend, distance_metric
+                    )
+                record(
+                    name,
+                    backend,
+                    "rank_neighbors",
+                    requested_chunk_size,
+                    chunk_size,
+                    measure(rank, rank_tokens, backend, repetitions),
+                )
+
+        # The stages below choose their chunk sizes with utils/memory.py
+        record(
+            name,
+            backend,
+            "dx_post_processing",
+            None,
+            None,
+            measure(
+                lambda: dx_post_processing(
+                    noisy_embeddings,
+                    vocab_backend,
+                    dx_constant,
+                    epsilon,
+                    distance_metric,
+                    backend,
+                ),
+                tokens,
+                backend,
+                repetitions,
+            ),
+        )
+        record(
+            name,
+            backend,
+            "nearest_neighbor_search_on_textsV2",
+            None,
+            None,
+            measure(
+                lambda: nearest_neighbor_search_on_textsV2(
+                    texts_embeddings,
+                    vocab_backend,
+                    attention_mask,
+                    0,
+                    distance_metric,
+                    backend,
+                ),
+                text_tokens,
+                backend,
+                repetitions,
+            ),
+        )
+        record(
+            name,
+            backend,
+            "apply_post_processing_on_textsV2",
+            None,
+            None,
+            measure(
+                lambda: apply_post_processing_on_textsV2(
+                    texts_embeddings,
+                    vocab_backend,
+                    attention_mask,
+                    0,
+                    dx_constant,
+                    epsilon,
+                    distance_metric,
+                    backend,
+                ),
+                text_tokens,
+                backend,
+                repetitions,
+            ),
+        )
+
+
+for name in vocabularies:
+    benchmark_vocabulary(name)
+
+filepath = save_results(run, save_folderpath)
+print_timed(f"Results saved in {filepath}")
+
+if baseline is not None:
+    with open(baseline) as f:
+        baseline_run = json.load(f)
+    print_timed(
+        f"Speedups over {baseline} (commit {baseline_run['machine']['commit']}, host {baseline_run['machine']['host']})"
+    )
+    for comparison in compare_results(run, baseline_run):
+        print_timed(f"{comparison['key']}: {comparison['speedup']:.2f}x")
@@ -0,0 +1,76 @@
+# # Import time of the utils modules
+# Each import is timed in a fresh interpreter, so that modules already imported by a previous
+# measurement do not make the next ones look faster. The modules imported lazily (see utils/backends.py)
+# are listed for each import: the analysis scripts (Regression.py, Similarities.py, Section5-dxPrivacy)
+# only import utils.files, and never pay the import of CuPy or PyTorch.
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+import numpy as np
+
+# BEGIN PARAMETERS
+modules = [
+    "utils.files",  # I/O helpers of the analysis scripts
+    "utils.tools",
+    "utils.dx",
+    "utils.text_lm",
+    # The imports avoided by utils.files, as they were paid by utils.tools and utils.dx before
+    "cupy",
+    "torch",
+]
+# Reported when an import loads them
+heavy_modules = [
+    "cupy",
+    "cupyx",
+    "torch",
+    "transformers",
+    "safetensors",
+    "huggingface_hub",
+]
+repetitions = 5
+# END PARAMETERS
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+try:
+    __import__({module!r})
+    error = None
+except ImportError as e:
+    error = str(e)
+seconds = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": seconds,
+    "error": error,
+    "loaded": [m for m in {heavy_modules!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure(module: str) -> dict:
+    """The import of module in a fresh interpreter, run from this folder so that utils is importable."""
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            MEASURE.format(module=module, heavy_modules=heavy_modules),
+        ],
+        cwd=Path(__file__).parent,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+print(f"{'module':<16}{'median (ms)':>12}{'min (ms)':>10}  heavy modules loaded")
+for module in modules:
+    runs = [measure(module) for _ in range(repetitions)]
+    if runs[0]["error"] is not None:
+        print(f"{module:<16}{'-':>12}{'-':>10}  not importable: {runs[0]['error']}")
+        continue
+    seconds = np.array([run["seconds"] for run in runs]) * 1000
+    loaded = ", ".join(runs[0]["loaded"]) or "none"
+    print(f"{module:<16}{np.median(seconds):>12.1f}{seconds.min():>10.1f}  {loaded}")
@@ -18,7 +18,7 @@ from pathlib import Path
 
 load_dotenv()
 sys.path.append(str(Path(__file__).parent))  # Add parent directory to path
-from utils.tools import load_pickle
+from utils.files import load_pickle
 
 # BEGIN PARAMETERS
 embedding_models = ["bart", "llama"]
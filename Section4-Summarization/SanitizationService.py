@@ -0,0 +1,124 @@
+# # Sanitization service
+# Keeps the tokenizer and the prepared vocabulary of a model in memory and sanitizes texts on request, coalescing
+# concurrent requests into micro-batches (see utils/service.py). E.g., with the default parameters:
+#   curl -X POST localhost:8000/sanitize -d '{"text": "A text to sanitize", "epsilon": 10}'
+#   curl localhost:8000/metrics
+# or, with unix_socket = "/tmp/sanitization.sock":
+#   curl --unix-socket /tmp/sanitization.sock -X POST localhost/sanitize -d '{"text": "A text", "epsilon": 10}'
+
+import asyncio
+import numpy as np
+import os
+from os.path import join
+from dotenv import load_dotenv
+from transformers import AutoTokenizer
+from utils.dx import prepare_vocabulary
+from utils.text_lm import load_model_vocabulary
+from utils.neighbor_table import get_neighbor_table, get_safe_radii
+from utils.detokenizer import get_table_decoder, check_decoder_parity
+from utils.service import SanitizationService
+from utils.files import print_timed
+
+load_dotenv()
+
+# BEGIN PARAMETERS
+model_name = "facebook/bart-large-cnn"  # e.g. "meta-llama/Meta-Llama-3-8B-Instruct"
+model_revision = "37f520fa929c961707657b28798b30c003dd100b"  # e.g. "5f0b02c75b57c5855da9ae460ce51323ea669d8a" for Llama 3
+use_fast = False  # The tokenizer of the TextSanitization.py script of the model, True for Llama 3
+dx_constant = 0.006
+distance_metric = "euclidean"
+tail_mass = None  # See bart/TextSanitization.py
+neighbor_table_size = None  # See bart/TextSanitization.py
+identity_shortcut = False  # See bart/TextSanitization.py
+backend = "numpy"  # "numpy" to serve on CPU, "cupy" to serve on GPU
+index = None  # See bart/TextSanitization.py
+index_options = None  # See bart/TextSanitization.py
+compression = None  # See bart/TextSanitization.py
+fast_detokenization = False  # See bart/TextSanitization.py
+max_wait = 0.01  # Seconds a request waits for other requests to join its batch
+max_batch_tokens = 65536  # Largest number of tokens sanitized in one batch
+max_body_bytes = (
+    1 << 20
+)  # Largest body of a request in bytes, larger requests are rejected with a 400
+host = "127.0.0.1"  # None to only listen on unix_socket
+port = 8000
+unix_socket = None  # e.g. "/tmp/sanitization.sock"
+# END PARAMETERS
+
+tokenizer = AutoTokenizer.from_pretrained(
+    model_name, use_fast=use_fast, revision=model_revision
+)
+if tokenizer.pad_token is None:
+    # Same as llama3/TextSanitization.py
+    tokenizer.pad_token = tokenizer.eos_token
+
+vocab_embs = load_model_vocabulary(
+    model_name,
+    model_revision,
+    join(os.environ["ROOT_SAVE_FOLDER"], "vocabularies"),
+)
+
+neighbor_table = None
+if neighbor_table_size is not None:
+    neighbor_table = get_neighbor_table(
+        vocab_embs,
+        neighbor_table_size,
+        join(os.environ["ROOT_SAVE_FOLDER"], "neighbor_tables"),
+        model_name,
+        model_revision,
+        distance_metric,
+        backend,
+    )
+
+safe_radii = None
+if identity_shortcut and distance_metric != "cosine":
+    safe_radii = get_safe_radii(
+        vocab_embs,
+        join(os.environ["ROOT_SAVE_FOLDER"], "neighbor_tables"),
+        model_name,
+        model_revision,
+        backend,
+    )
+
+decoder = None
+if fast_detokenization:
+    decoder = get_table_decoder(
+        tokenizer,
+        join(os.environ["ROOT_SAVE_FOLDER"], "detokenizers"),
+        model_name,
+        model_revision,
+        vocab_embs.shape[0],
+    )
+    # No corpus here, the table is only checked on random ids
+    if (
+        len(
+            check_decoder_parity(
+                decoder, tokenizer, np.zeros((0, 128), dtype=np.int64), 1000
+            )
+        )
+        > 0
+    ):
+        print_timed(
+            "The decoding table does not match batch_decode, using batch_decode"
+        )
+        decoder = None
+
+service = SanitizationService(
+    tokenizer,
+    vocab_embs,
+    tokenizer.pad_token_id,
+    dx_constant,
+    distance_metric,
+    backend,
+    tail_mass,
+    neighbor_table,
+    prepare_vocabulary(
+        vocab_embs, distance_metric, backend, index, compression, index_options
+    ),
+    safe_radii,
+    decoder=decoder,
+    max_wait=max_wait,
+    max_batch_tokens=max_batch_tokens,
+    max_body_bytes=max_body_bytes,
+)
+asyncio.run(service.serve(host, port, unix_socket))
@@ -10,7 +10,7 @@ import sys
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))  # Add parent directory to path
-from utils.tools import save_pickle, load_pickle, print_timed
+from utils.files import save_pickle, load_pickle, print_timed
 
 load_dotenv()
 
@@ -1,5 +1,5 @@
 from datasets import load_from_disk
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+from transformers import AutoTokenizer
 import torch
 import os
 from os.path import join
@@ -11,15 +11,29 @@ from pathlib import Path
 
 
 sys.path.append(str(Path(__file__).parent.parent))  # Add parent directory to path
-from utils.dx import sample_noise_vectors_np
+from utils.dx import sample_noise_vectors_np, prepare_vocabulary
 from utils.text_lm import (
-    get_model_vocabulary,
+    load_model_vocabulary,
     text_to_tokens_ids,
     nearest_neighbor_search_on_textsV2,
     apply_post_processing_on_textsV2,
+    apply_post_processing_on_texts_ids,
+    sanitize_texts_packed,
+    sanitize_texts_packed_multi_epsilon,
+    PackedSanitizationStages,
     ids_to_texts,
+    task_seed,
 )
-from utils.tools import print_timed, save_pickle, load_pickle
+from utils.ann import ApproximateNeighborSearch
+from utils.compressed_search import CompressedNeighborSearch
+from utils.neighbor_table import get_neighbor_table, get_safe_radii
+from utils.sharding import sanitize_texts_sharded
+from utils.task_queue import TaskQueue, run_task_queue
+from utils.pipeline import run_pipeline
+from utils.candidates import get_candidate_vocabulary
+from utils.detokenizer import get_table_decoder, check_decoder_parity
+from utils.memory import set_memory_budget
+from utils.files import print_timed, save_pickle, load_pickle
 
 load_dotenv()
 
@@ -27,6 +41,28 @@ load_dotenv()
 epsilons = [i for i in range(1, 101, 3)] + [i for i in range(115, 501, 15)]
 dx_constant = 0.006
 distance_metric = "euclidean"
+tail_mass = None  # e.g. 1e-9 to only sample among the nearest neighbors holding all but 1e-9 of the post-processing probability mass
+neighbor_table_size = None  # e.g. 2048 to look up post-processing neighbors in a table of the 2048 nearest neighbors of each token, built once and stored in ROOT_SAVE_FOLDER/neighbor_tables
+identity_shortcut = False  # Skip the nearest neighbor search of the tokens whose noise is provably too short to change them (euclidean distance, packed layout), using safe radii computed once and stored in ROOT_SAVE_FOLDER/neighbor_tables
+fused_epsilons = False  # Process each batch for all epsilons in a single pass, with the packed layout
+common_noise = False  # With fused_epsilons, sample the noise of each token once for all epsilons and search all epsilons in one pass along its ray (correlated outputs across epsilons, unchanged for each epsilon)
+trials = None  # e.g. 5 to sanitize each text 5 times independently in one pass (packed layout, without n_processes), saved as epsi{epsilon}trial{trial}full files
+exclude_tokens = False  # Never output special, byte fallback and unused tokens: searches run against a compact matrix of the other tokens (see utils/candidates.py)
+token_chunk_size = None  # e.g. 65536 to stream the packed tokens of a batch through buffers of 65536 embeddings (gather, noise, search), bounding peak memory whatever the batch size
+packed = False  # Process the non-pad tokens of a batch as one contiguous array instead of text-by-text
+pipelined = False  # Overlap the stages of consecutive batches (noise sampling, search, post-processing, decoding, writing) in threads with bounded queues, see utils/pipeline.py. With fused_epsilons, only the computation overlaps with decoding and writing
+memory_budget = None  # Bytes (int) or fraction (float) of the available VRAM (cupy) or RAM (numpy) used by the dx-privacy mechanism, None for the defaults of utils/memory.py
+backend = "cupy"  # "cupy" to compute the dx-privacy mechanism on GPU, "numpy" to compute it on CPU
+index = None  # With the numpy backend, "pruned" to search nearest neighbors exactly with a k-means index of the vocabulary (see utils/pruned_search.py), or "annoy" or "ivf" to search them approximately (see utils/ann.py)
+index_options = None  # Keyword arguments of the index, e.g. {"n_probes": 16} for "ivf" or {"n_candidates": 50, "search_k": 5000} for "annoy" to raise their recall at the cost of speed
+compression = None  # With the numpy backend and without index, "float16", "bfloat16", "int8" or "pq" to shortlist nearest neighbors on a compressed vocabulary held in memory, re-ranked exactly from the memory-mapped float32 vocabulary (see utils/compressed_search.py)
+n_processes = None  # e.g. 64 to sanitize (batch, epsilon) shards with a pool of CPU processes sharing the vocabulary in memory, see utils/sharding.py
+master_seed = None  # e.g. 1234 to draw the noise of each (batch, epsilon) task from its own random streams derived from this seed, so that any task can be re-run bit-identically (packed layout)
+task_queue = None  # e.g. "task_queue" to share the (batch, epsilon) tasks among several runs of this script, on one or several hosts, through the folder ROOT_SAVE_FOLDER/task_queue (requires master_seed, see utils/task_queue.py)
+fast_detokenization = False  # Decode sanitized ids with a table of the bytes of each token, built once and stored in ROOT_SAVE_FOLDER/detokenizers, after checking it matches batch_decode on the corpus (see utils/detokenizer.py)
+detokenization_processes = (
+    None  # e.g. 8 to decode the texts of each part file with 8 processes
+)
 cuda_device = "cpu"  # Model will be loaded on cpu, we only need to load it to get its embedding model
 batch_size = 1500
 # END PARAMETERS
@@ -58,28 +94,94 @@ texts_indexes_to_compute = np.load(
 texts = (np.array(texts)[texts_indexes_to_compute]).tolist()
 
 
-def load_embedding_model() -> tuple[AutoTokenizer, AutoModelForSeq2SeqLM]:
+model_name = "facebook/bart-large-cnn"
+model_revision = "37f520fa929c961707657b28798b30c003dd100b"
+
+
+def load_tokenizer() -> AutoTokenizer:
     tokenizer = AutoTokenizer.from_pretrained(
-        "facebook/bart-large-cnn",
+        model_name,
         device=cuda_device,
         torch_dtype="auto",
         use_fast=False,
-        revision="37f520fa929c961707657b28798b30c003dd100b",
+        revision=model_revision,
     )
-    model = AutoModelForSeq2SeqLM.from_pretrained(
-        "facebook/bart-large-cnn",
-        torch_dtype="auto",
-        revision="37f520fa929c961707657b28798b30c003dd100b",
+
+    return tokenizer
+
+
+tokenizer = load_tokenizer()
+# Only the embedding model is read from the checkpoint, and cached as float32 in ROOT_SAVE_FOLDER/vocabularies
+vocab_embs = load_model_vocabulary(
+    model_name,
+    model_revision,
+    join(os.environ["ROOT_SAVE_FOLDER"], "vocabularies"),
+)
+
+if memory_budget is not None:
+    set_memory_budget(backend, memory_budget)
+
+# The tokens which can be output, and the matrix searched by the dx-privacy mechanism
+candidates = None
+search_vocab_embs = vocab_embs
+search_revision = model_revision
+if exclude_tokens:
+    candidates = get_candidate_vocabulary(tokenizer, vocab_embs)
+    print_timed(
+        f"Searching {candidates.shape[0]} candidates out of {vocab_embs.shape[0]} tokens"
     )
-    model.eval()
-    # Ensure the model is in eval mode
+    search_vocab_embs = candidates.embeddings
+    search_revision = candidates.revision(model_revision)
 
-    return tokenizer, model
+neighbor_table = None
+if neighbor_table_size is not None:
+    print_timed("Loading the neighbor table")
+    neighbor_table = get_neighbor_table(
+        search_vocab_embs,
+        neighbor_table_size,
+        join(os.environ["ROOT_SAVE_FOLDER"], "neighbor_tables"),
+        model_name,
+        search_revision,
+        distance_metric,
+        backend,
+    )
 
+safe_radii = None
+if identity_shortcut and distance_metric != "cosine":
+    print_timed("Loading the safe radii")
+    safe_radii = get_safe_radii(
+        search_vocab_embs,
+        join(os.environ["ROOT_SAVE_FOLDER"], "neighbor_tables"),
+        model_name,
+        search_revision,
+        backend,
+    )
 
-tokenizer, model = load_embedding_model()
-vocab_embs = get_model_vocabulary(model).numpy()
-del model  # Save RAM
+# Prepare the vocabulary once for all batches and epsilons (copied to GPU for cupy)
+vocab_backend = prepare_vocabulary(
+    search_vocab_embs, distance_metric, backend, index, compression, index_options
+)
+if isinstance(vocab_backend, (ApproximateNeighborSearch, CompressedNeighborSearch)):
+    # Recall of the index, or memory and throughput of the compressed vocabulary, against the exact search, on
+    # noisy embeddings of a sample of the vocabulary
+    recall_sample = search_vocab_embs[
+        np.random.default_rng(0).choice(search_vocab_embs.shape[0], 1000, replace=False)
+    ]
+    for epsilon in (min(epsilons), max(epsilons)):
+        noisy_sample = (
+            recall_sample
+            + sample_noise_vectors_np(
+                recall_sample.shape[1], 1, recall_sample.shape[0], epsilon
+            )[0]
+        )
+        if isinstance(vocab_backend, ApproximateNeighborSearch):
+            print_timed(f"Recall of the {index} index for epsilon = {epsilon}")
+            vocab_backend.measure_recall(noisy_sample)
+        else:
+            print_timed(
+                f"Savings of the {compression} vocabulary for epsilon = {epsilon}"
+            )
+            vocab_backend.measure_savings(noisy_sample)
 
 # Transform texts to token ids
 # Do NOT move this into the loop. By tokenizing here,
@@ -93,79 +195,377 @@ attention_mask = attention_mask.numpy()
 # Save attention mask to disk
 save_pickle(save_folderpath, "attention_mask.pickle", attention_mask, False)
 
-n = len(texts)
-for epsilon in epsilons:
-    print_timed(f"Epsilon = {epsilon}")
-    part = 1
-    for i in range(0, n, batch_size):
-        j = min(i + batch_size, n)
+decoder = None
+if fast_detokenization:
+    decoder = get_table_decoder(
+        tokenizer,
+        join(os.environ["ROOT_SAVE_FOLDER"], "detokenizers"),
+        model_name,
+        model_revision,
+        vocab_embs.shape[0],
+    )
+    if len(check_decoder_parity(decoder, tokenizer, texts_ids.numpy())) > 0:
+        print_timed(
+            "The decoding table does not match batch_decode, using batch_decode"
+        )
+        decoder = None
 
-        print_timed(f"Epsi{epsilon}: Processing slice {i}:{j}")
 
-        texts_embeddings = vocab_embs[texts_ids[i:j]]
+def files_prefix(epsilon: int, trial: int | None = None) -> str:
+    # Files of each trial are indexed by (trial, text): epsi{epsilon}trial{trial} then the texts in order
+    return f"epsi{epsilon}" if trial is None else f"epsi{epsilon}trial{trial}"
 
-        print_timed("Sampling noise")
-        # We need one noise vector per token
-        noises = sample_noise_vectors_np(
-            dimension=texts_embeddings.shape[2],
-            shape1=texts_embeddings.shape[0],
-            shape2=texts_embeddings.shape[1],
-            epsilon=epsilon,
+
+def save_part_file(
+    epsilon: int,
+    part: int,
+    noisy_texts_ids: np.ndarray,
+    trial: int | None = None,
+    noisy_texts: list[str] | None = None,
+) -> None:
+    if noisy_texts is None:
+        print_timed("ids_to_texts")
+        noisy_texts = ids_to_texts(
+            noisy_texts_ids, tokenizer, decoder, detokenization_processes
         )
 
-        # Use attention_mask to avoid adding noise to special tokens like <PAD>
-        # The following line multiplies the noise by zero for special tokens
-        noises *= (attention_mask[i:j])[..., np.newaxis]
+    print_timed("Saving")
+    filename = f"{files_prefix(epsilon, trial)}partfile_{part:04d}"
+    save_pickle(save_folderpath, f"{filename}.pickle", noisy_texts, False)
+
+    # Also save noisy_texts_ids
+    np.save(join(save_folderpath, f"{filename}.npy"), noisy_texts_ids)
+
+
+def merge_part_files(epsilon: int, trial: int | None = None) -> None:
+    # Load all parts file for the epsilon and save into one file
+    prefix = files_prefix(epsilon, trial)
+    slice_noisy_ids = []
+    slice_noisy_texts_ids: list[np.ndarray] = []
+    for file in sorted(os.listdir(save_folderpath)):
+        if re.fullmatch(f"^{prefix}partfile.*.pickle", file):
+            slice_noisy_ids += load_pickle(save_folderpath, file)
+            os.remove(join(save_folderpath, file))
+        elif re.fullmatch(f"^{prefix}partfile.*.npy", file):
+            slice_noisy_texts_ids.append(np.load(join(save_folderpath, file)))
+            os.remove(join(save_folderpath, file))
+
+    save_pickle(save_folderpath, f"{prefix}full.pickle", slice_noisy_ids, False)
+
+    slice_noisy_texts_ids_merged = np.concat(slice_noisy_texts_ids)
+    np.save(join(save_folderpath, f"{prefix}full.npy"), slice_noisy_texts_ids_merged)
+
+
+def save_trials_part_files(
+    epsilon: int, part: int, noisy_texts_ids: np.ndarray
+) -> None:
+    # With trials, noisy_texts_ids is indexed by (trial, text)
+    if trials is None:
+        save_part_file(epsilon, part, noisy_texts_ids)
+    else:
+        for trial, trial_noisy_texts_ids in enumerate(noisy_texts_ids):
+            save_part_file(epsilon, part, trial_noisy_texts_ids, trial)
+
+
+def merge_trials_part_files(epsilon: int) -> None:
+    for trial in [None] if trials is None else range(trials):
+        merge_part_files(epsilon, trial)
+
+
+if trials is not None and (n_processes is not None or not (fused_epsilons or packed)):
+    raise ValueError("trials requires the packed layout, without n_processes")
+if master_seed is not None and not (fused_epsilons or packed):
+    raise ValueError("master_seed requires the packed layout")
+if task_queue is not None and (master_seed is None or trials is not None):
+    raise ValueError("task_queue requires master_seed, without trials")
+if pipelined and (
+    trials is not None
+    or not (fused_epsilons or packed)
+    or (token_chunk_size is not None and not fused_epsilons)
+):
+    raise ValueError(
+        "pipelined requires the packed layout without trials, and fused_epsilons for token_chunk_size"
+    )
+
+
+def batch_seed(i: int, j: int):
+    # The random streams of the texts i to j, see task_seed
+    return None if master_seed is None else task_seed(master_seed, i, j)
+
+
+# The last stages of the pipeline, their items being ((epsilon, part), ...)
+def decoding_stage(item: tuple) -> tuple:
+    task, noisy_texts_ids = item
+    noisy_texts = ids_to_texts(
+        noisy_texts_ids, tokenizer, decoder, detokenization_processes
+    )
+    return task, noisy_texts_ids, noisy_texts
 
-        texts_embeddings += noises
 
-        print_timed("nearest_neighbor_search_on_textsV2")
-        pivot_texts_ids = nearest_neighbor_search_on_textsV2(
-            texts_embeddings,
+def writing_stage(item: tuple) -> None:
+    (epsilon, part), noisy_texts_ids, noisy_texts = item
+    print_timed(f"Epsi{epsilon}: saving part {part}")
+    save_part_file(epsilon, part, noisy_texts_ids, noisy_texts=noisy_texts)
+
+
+n = len(texts)
+if task_queue is not None:
+    # This run is one of the workers of the queue, each task sanitizes batch_size texts for one epsilon
+    queue = TaskQueue(join(os.environ["ROOT_SAVE_FOLDER"], task_queue))
+    queue.submit(epsilons, n, batch_size)
+    run_task_queue(
+        queue,
+        lambda epsilon, i, j: sanitize_texts_packed(
+            texts_ids[i:j],
+            attention_mask[i:j],
             vocab_embs,
-            attention_mask,
             tokenizer.pad_token_id,
+            dx_constant,
+            epsilon,
             distance_metric,
-        )
+            backend,
+            tail_mass,
+            neighbor_table,
+            vocab_backend,
+            safe_radii,
+            None,
+            candidates,
+            token_chunk_size,
+            batch_seed(i, j),
+        ),
+        stale_timeout=24 * 3600,
+    )
+    # The worker which completes the last task saves the results
+    if queue.remaining() == 0 and queue.lock("merge"):
+        for epsilon in epsilons:
+            noisy_texts_ids = queue.merge(epsilon, n, batch_size)
+            for part, i in enumerate(range(0, n, batch_size), start=1):
+                save_part_file(epsilon, part, noisy_texts_ids[i : i + batch_size])
+            merge_part_files(epsilon)
+elif n_processes is not None:
+    # Each worker process sanitizes batch_size texts for one epsilon at a time, on CPU
+    all_noisy_texts_ids = sanitize_texts_sharded(
+        texts_ids,
+        attention_mask,
+        vocab_embs,
+        tokenizer.pad_token_id,
+        dx_constant,
+        epsilons,
+        distance_metric,
+        tail_mass,
+        neighbor_table,
+        safe_radii,
+        n_processes,
+        batch_size,
+        candidates=candidates,
+        master_seed=master_seed,
+    )
+    for epsilon, noisy_texts_ids in zip(epsilons, all_noisy_texts_ids):
+        for part, i in enumerate(range(0, n, batch_size), start=1):
+            save_part_file(epsilon, part, noisy_texts_ids[i : i + batch_size])
+        merge_part_files(epsilon)
+elif fused_epsilons and pipelined:
+    # The batches are processed for all epsilons in a single pass while the previous results are decoded and written
+    def fused_batches():
+        for part, i in enumerate(range(0, n, batch_size), start=1):
+            j = min(i + batch_size, n)
 
-        noisy_texts_embeddings = vocab_embs[pivot_texts_ids]
+            print_timed(f"Processing slice {i}:{j} for all epsilons")
+            for epsilon, noisy_texts_ids in sanitize_texts_packed_multi_epsilon(
+                texts_ids[i:j],
+                attention_mask[i:j],
+                vocab_embs,
+                tokenizer.pad_token_id,
+                dx_constant,
+                epsilons,
+                distance_metric,
+                backend,
+                tail_mass,
+                neighbor_table,
+                vocab_backend,
+                safe_radii,
+                common_noise,
+                None,
+                candidates,
+                token_chunk_size,
+                batch_seed(i, j),
+            ):
+                print_timed(f"Epsilon = {epsilon}")
+                yield (epsilon, part), noisy_texts_ids
+
+    run_pipeline(fused_batches(), [decoding_stage, writing_stage])
+    for epsilon in epsilons:
+        merge_part_files(epsilon)
+elif fused_epsilons:
+    # Process each batch for all epsilons in a single pass
+    part = 1
+    for i in range(0, n, batch_size):
+        j = min(i + batch_size, n)
 
-        print_timed("Post-processing fix")
-        noisy_texts_ids = apply_post_processing_on_textsV2(
-            noisy_texts_embeddings,
+        print_timed(f"Processing slice {i}:{j} for all epsilons")
+        for epsilon, noisy_texts_ids in sanitize_texts_packed_multi_epsilon(
+            texts_ids[i:j],
+            attention_mask[i:j],
             vocab_embs,
-            attention_mask,
             tokenizer.pad_token_id,
             dx_constant,
-            epsilon,
+            epsilons,
             distance_metric,
+            backend,
+            tail_mass,
+            neighbor_table,
+            vocab_backend,
+            safe_radii,
+            common_noise,
+            trials,
+            candidates,
+            token_chunk_size,
+            batch_seed(i, j),
+        ):
+            print_timed(f"Epsilon = {epsilon}")
+            save_trials_part_files(epsilon, part, noisy_texts_ids)
+        part += 1
+
+    for epsilon in epsilons:
+        merge_trials_part_files(epsilon)
+elif pipelined:
+    # While a batch is searched or post-processed (one at a time, see PackedSanitizationStages), the noise of the next
+    # one is sampled and the previous one is decoded and written
+    stages = PackedSanitizationStages(
+        vocab_embs,
+        tokenizer.pad_token_id,
+        dx_constant,
+        distance_metric,
+        backend,
+        tail_mass,
+        neighbor_table,
+        vocab_backend,
+        safe_radii,
+        candidates,
+    )
+
+    def noise_stage(task: tuple) -> tuple:
+        epsilon, part, i, j = task
+        print_timed(f"Epsi{epsilon}: Processing slice {i}:{j}")
+        batch = stages.noise(
+            texts_ids[i:j], attention_mask[i:j], epsilon, batch_seed(i, j)
         )
+        return (epsilon, part), batch
 
-        print_timed("ids_to_texts")
-        noisy_texts = ids_to_texts(noisy_texts_ids, tokenizer)
+    def search_stage(item: tuple) -> tuple:
+        task, batch = item
+        return task, stages.search(batch)
 
-        print_timed("Saving")
-        filename = f"epsi{epsilon}partfile_{part:04d}"
-        save_pickle(save_folderpath, f"{filename}.pickle", noisy_texts, False)
+    def post_processing_stage(item: tuple) -> tuple:
+        task, batch = item
+        return task, stages.post_process(batch)
 
-        # Also save noisy_texts_ids
-        np.save(join(save_folderpath, f"{filename}.npy"), noisy_texts_ids)
-        part += 1
+    run_pipeline(
+        [
+            (epsilon, part, i, min(i + batch_size, n))
+            for epsilon in epsilons
+            for part, i in enumerate(range(0, n, batch_size), start=1)
+        ],
+        [
+            noise_stage,
+            search_stage,
+            post_processing_stage,
+            decoding_stage,
+            writing_stage,
+        ],
+    )
+    for epsilon in epsilons:
+        merge_part_files(epsilon)
+else:
+    for epsilon in epsilons:
+        print_timed(f"Epsilon = {epsilon}")
+        part = 1
+        for i in range(0, n, batch_size):
+            j = min(i + batch_size, n)
 
-    # Load all parts file for the current epsilon and save into one file
-    slice_noisy_ids = []
-    slice_noisy_texts_ids: list[np.ndarray] = []
-    for file in sorted(os.listdir(save_folderpath)):
-        if re.fullmatch(f"^epsi{epsilon}partfile.*.pickle", file):
-            slice_noisy_ids += load_pickle(save_folderpath, file)
-            os.remove(join(save_folderpath, file))
-        elif re.fullmatch(f"^epsi{epsilon}partfile.*.npy", file):
-            slice_noisy_texts_ids.append(np.load(join(save_folderpath, file)))
-            os.remove(join(save_folderpath, file))
+            print_timed(f"Epsi{epsilon}: Processing slice {i}:{j}")
 
-    save_pickle(save_folderpath, f"epsi{epsilon}full.pickle", slice_noisy_ids, False)
+            if packed:
+                print_timed("sanitize_texts_packed")
+                noisy_texts_ids = sanitize_texts_packed(
+                    texts_ids[i:j],
+                    attention_mask[i:j],
+                    vocab_embs,
+                    tokenizer.pad_token_id,
+                    dx_constant,
+                    epsilon,
+                    distance_metric,
+                    backend,
+                    tail_mass,
+                    neighbor_table,
+                    vocab_backend,
+                    safe_radii,
+                    trials,
+                    candidates,
+                    token_chunk_size,
+                    batch_seed(i, j),
+                )
+            else:
+                texts_embeddings = vocab_embs[texts_ids[i:j]]
 
-    slice_noisy_texts_ids_merged = np.concat(slice_noisy_texts_ids)
-    np.save(
-        join(save_folderpath, f"epsi{epsilon}full.npy"), slice_noisy_texts_ids_merged
-    )
+                print_timed("Sampling noise")
+                # We need one noise vector per token
+                noises = sample_noise_vectors_np(
+                    dimension=texts_embeddings.shape[2],
+                    shape1=texts_embeddings.shape[0],
+                    shape2=texts_embeddings.shape[1],
+                    epsilon=epsilon,
+                    n_threads=os.cpu_count(),
+                )
+
+                # Use attention_mask to avoid adding noise to special tokens like <PAD>
+                # The following line multiplies the noise by zero for special tokens
+                noises *= (attention_mask[i:j])[..., np.newaxis]
+
+                texts_embeddings += noises
+
+                print_timed("nearest_neighbor_search_on_textsV2")
+                pivot_texts_ids = nearest_neighbor_search_on_textsV2(
+                    texts_embeddings,
+                    vocab_backend,
+                    attention_mask[i:j],
+                    tokenizer.pad_token_id,
+                    distance_metric,
+                    backend,
+                    candidates,
+                )
+
+                print_timed("Post-processing fix")
+                if neighbor_table is None:
+                    noisy_texts_embeddings = vocab_embs[pivot_texts_ids]
+                    noisy_texts_ids = apply_post_processing_on_textsV2(
+                        noisy_texts_embeddings,
+                        search_vocab_embs,
+                        attention_mask[i:j],
+                        tokenizer.pad_token_id,
+                        dx_constant,
+                        epsilon,
+                        distance_metric,
+                        backend,
+                        tail_mass,
+                        candidates,
+                    )
+                else:
+                    noisy_texts_ids = apply_post_processing_on_texts_ids(
+                        pivot_texts_ids,
+                        neighbor_table,
+                        search_vocab_embs,
+                        attention_mask[i:j],
+                        tokenizer.pad_token_id,
+                        dx_constant,
+                        epsilon,
+                        distance_metric,
+                        backend,
+                        tail_mass,
+                        candidates,
+                    )
+
+            save_trials_part_files(epsilon, part, noisy_texts_ids)
+            part += 1
+
+        merge_trials_part_files(epsilon)
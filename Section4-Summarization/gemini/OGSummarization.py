@@ -12,7 +12,7 @@ import sys
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))  # Add parent directory to path
-from utils.tools import print_timed, load_pickle, save_pickle
+from utils.files import print_timed, load_pickle, save_pickle
 
 load_dotenv()
 
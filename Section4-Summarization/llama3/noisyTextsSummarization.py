@@ -9,7 +9,7 @@ import sys
 from pathlib import Path
 
 sys.path.append(str(Path(__file__).parent.parent))  # Add parent directory to path
-from utils.tools import load_pickle, save_pickle, print_timed
+from utils.files import load_pickle, save_pickle, print_timed
 
 load_dotenv()
 
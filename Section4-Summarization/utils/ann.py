@@ -0,0 +1,239 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from os.path import exists
+from time import perf_counter
+from utils.search import ExactNeighborSearch
+from utils.kmeans import kmeans, centroids_scores, nearest_centroids
+from utils.files import print_timed
+
+try:
+    from annoy import AnnoyIndex
+except ImportError:
+    # Only the "ivf" index is available
+    AnnoyIndex = None
+
+
+class ApproximateNeighborSearch(ExactNeighborSearch):
+    """Base class of the approximate nearest neighbor indexes. An index only proposes a few candidates
+    for each embedding (see candidates), which are then verified exactly in float32: the returned id is the
+    nearest candidate, and it is the exact nearest neighbor whenever the index proposed it. The fraction of
+    embeddings for which this happens, the recall, is traded for speed with a knob specific to each index,
+    and can be measured against the exact search with measure_recall.
+
+    Only the nearest neighbor search (search) uses the index. The ranking methods inherited from
+    ExactNeighborSearch (rank, nth_nearest_neighbors, ...) stay exact.
+    """
+
+    def candidates(self, embeddings: np.ndarray) -> list[np.ndarray]:
+        """The ids of the candidates proposed by the index for each embedding."""
+        raise NotImplementedError
+
+    def search(self, embeddings: np.ndarray, chunk_size: int = 4096) -> np.ndarray:
+        """Performs an approximate nearest neighbor search of the embeddings against the vocabulary, chunk-by-chunk.
+
+        Args:
+            embeddings (np.ndarray): A two-dimensional array containing the embeddings we want to process.
+            chunk_size (int, optional): The number of elements in embeddings to compute at a time. Defaults to 4096,
+                -1 is accepted for compatibility with ExactNeighborSearch.search and uses the default.
+
+        Returns:
+            np.ndarray: A one-dimensional array of shape (embeddings.shape[0]) containing the vocabulary index of the
+                nearest candidate for each embedding.
+        """
+        input_size = embeddings.shape[0]
+        if chunk_size == -1:
+            chunk_size = 4096
+        chunk_size = min(chunk_size, max(1, input_size))
+        noisy_ids = np.empty((input_size), dtype=self.ids_dtype)
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            for i in range(0, input_size, chunk_size):
+                j = min(i + chunk_size, input_size)
+                chunk = np.asarray(embeddings[i:j], dtype=np.float32)
+
+                def verify_rows(start: int, end: int) -> None:
+                    candidates = self.candidates(chunk[start:end])
+                    for row, ids in zip(range(start, end), candidates):
+                        exact_scores = self.scores(chunk[row : row + 1], ids=ids)[0]
+                        noisy_ids[i + row] = ids[exact_scores.argmin()]
+
+                self._map_rows(executor, verify_rows, j - i)
+
+        return noisy_ids
+
+    def measure_recall(
+        self, embeddings: np.ndarray, sample_size: int = 1000, seed: int = 0
+    ) -> dict:
+        """Measures the recall of the index, i.e., the fraction of embeddings for which search returns the
+        exact nearest neighbor, on a random sample of the embeddings, and its speed against the exact search.
+
+        Args:
+            embeddings (np.ndarray): A two-dimensional array containing embeddings, e.g., noisy embeddings.
+            sample_size (int, optional): The number of embeddings sampled. Defaults to 1000.
+            seed (int, optional): The seed of the sampling. Defaults to 0.
+
+        Returns:
+            dict: The "recall", and the number of embeddings processed per second by the index ("throughput")
+                and by the exact search ("exact_throughput").
+        """
+        rng = np.random.default_rng(seed)
+        sample_size = min(sample_size, embeddings.shape[0])
+        sample = embeddings[
+            np.sort(rng.choice(embeddings.shape[0], sample_size, replace=False))
+        ]
+
+        start = perf_counter()
+        ids = self.search(sample)
+        seconds = perf_counter() - start
+        start = perf_counter()
+        exact_ids = ExactNeighborSearch.search(self, sample)
+        exact_seconds = perf_counter() - start
+
+        result = {
+            "recall": float((ids == exact_ids).mean()),
+            "throughput": sample_size / seconds,
+            "exact_throughput": sample_size / exact_seconds,
+        }
+        print_timed(
+            f"{type(self).__name__}: recall {result['recall']:.2%} on {sample_size} embeddings, "
+            f"{result['throughput']:.1f} embeddings/s against {result['exact_throughput']:.1f} for the exact search"
+        )
+        return result
+
+
+class AnnoyNeighborSearch(ApproximateNeighborSearch):
+    """Approximate nearest neighbor search with an Annoy forest of random projection trees, as in Section5-dxPrivacy.
+    The recall/latency knobs are n_candidates, the number of candidates verified exactly for each embedding,
+    and search_k, the number of tree nodes inspected to find them."""
+
+    def __init__(
+        self,
+        vocabulary: np.ndarray,
+        distance_metric: str = "euclidean",
+        n_threads: int | None = None,
+        n_trees: int = 50,
+        n_candidates: int = 10,
+        search_k: int = -1,
+        filepath: str | None = None,
+    ) -> None:
+        """
+        Args:
+            vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+            distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary.
+                One of "euclidean", "sqeuclidean" or "cosine". Defaults to "euclidean".
+            n_threads (int | None, optional): The number of threads querying the index. Defaults to None,
+                which uses all available cores.
+            n_trees (int, optional): The number of trees of the forest. Defaults to 50, as in Section5-dxPrivacy.
+            n_candidates (int, optional): The number of candidates verified exactly for each embedding. Defaults to 10.
+            search_k (int, optional): The number of nodes inspected, -1 for Annoy's default of n_trees * n_candidates. Defaults to -1.
+            filepath (str | None, optional): Where to save the index once built, it is loaded from there if it already exists. Defaults to None.
+        """
+        if AnnoyIndex is None:
+            raise ImportError("The annoy index requires the annoy package")
+        super().__init__(vocabulary, distance_metric, n_threads)
+        self.n_candidates = n_candidates
+        self.search_k = search_k
+
+        # The vocabulary is already normalized for the cosine distance
+        self.index = AnnoyIndex(
+            self.hidden_size, "angular" if distance_metric == "cosine" else "euclidean"
+        )
+        if filepath is not None and exists(filepath):
+            self.index.load(filepath)
+            return
+        for vector_num, vector in enumerate(self.vocabulary):
+            self.index.add_item(vector_num, vector)
+        print_timed("Building annoy index...")
+        self.index.build(n_trees, n_jobs=self.n_threads)
+        print_timed("Annoy index built")
+        if filepath is not None:
+            self.index.save(filepath)
+
+    def candidates(self, embeddings: np.ndarray) -> list[np.ndarray]:
+        return [
+            np.array(
+                self.index.get_nns_by_vector(
+                    embedding, self.n_candidates, self.search_k
+                )
+            )
+            for embedding in embeddings
+        ]
+
+
+class IVFNeighborSearch(ApproximateNeighborSearch):
+    """Approximate nearest neighbor search with an inverted file index: the vocabulary is clustered with
+    k-means, and only the elements of the n_probes clusters whose centroids are the nearest to an embedding
+    are verified exactly. n_probes is the recall/latency knob, n_probes = n_lists is an exact search.
+    """
+
+    def __init__(
+        self,
+        vocabulary: np.ndarray,
+        distance_metric: str = "euclidean",
+        n_threads: int | None = None,
+        n_lists: int | None = None,
+        n_probes: int = 8,
+        sample_size: int = 65536,
+        iterations: int = 10,
+        seed: int = 0,
+    ) -> None:
+        """
+        Args:
+            vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+            distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary.
+                One of "euclidean", "sqeuclidean" or "cosine". Defaults to "euclidean".
+            n_threads (int | None, optional): The number of threads verifying candidates. Defaults to None,
+                which uses all available cores.
+            n_lists (int | None, optional): The number of clusters. Defaults to None, which uses the square root of the vocabulary size.
+            n_probes (int, optional): The number of clusters inspected for each embedding. Defaults to 8.
+            sample_size (int, optional): The number of elements of the vocabulary used to train k-means. Defaults to 65536.
+            iterations (int, optional): The number of k-means iterations. Defaults to 10.
+            seed (int, optional): The seed of the k-means initialization. Defaults to 0.
+        """
+        super().__init__(vocabulary, distance_metric, n_threads)
+        rng = np.random.default_rng(seed)
+        if n_lists is None:
+            n_lists = int(np.sqrt(self.vocab_size))
+        sample_size = max(min(sample_size, self.vocab_size), n_lists)
+        sample = self.vocabulary[
+            np.sort(rng.choice(self.vocab_size, sample_size, replace=False))
+        ]
+        self.centroids = kmeans(sample, n_lists, iterations, rng)
+        self.n_probes = n_probes
+
+        assignment = self._assign()
+        # Remove the empty lists, so that each probe yields candidates
+        counts = np.bincount(assignment, minlength=n_lists)
+        if (counts == 0).any():
+            self.centroids = self.centroids[counts > 0]
+            n_lists = self.centroids.shape[0]
+            assignment = self._assign()
+
+        # The elements of each list are contiguous in list_ids, list c is list_ids[offsets[c]:offsets[c + 1]]
+        self.list_ids = np.argsort(assignment, kind="stable").astype(self.ids_dtype)
+        self.offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=n_lists), out=self.offsets[1:])
+
+    def _assign(self) -> np.ndarray:
+        """The index of the nearest centroid of each element of the vocabulary."""
+        return np.concatenate(
+            [
+                nearest_centroids(self.vocabulary[i : i + 8192], self.centroids)
+                for i in range(0, self.vocab_size, 8192)
+            ]
+        )
+
+    def candidates(self, embeddings: np.ndarray) -> list[np.ndarray]:
+        if self.distance_metric == "cosine":
+            norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+            embeddings = embeddings / np.maximum(norms, np.finfo(np.float32).tiny)
+        n_probes = min(self.n_probes, self.centroids.shape[0])
+        probes = np.argpartition(
+            centroids_scores(embeddings, self.centroids), n_probes - 1, axis=-1
+        )[:, :n_probes]
+        return [
+            np.concatenate(
+                [self.list_ids[self.offsets[c] : self.offsets[c + 1]] for c in row]
+            )
+            for row in probes
+        ]
@@ -0,0 +1,51 @@
+import importlib
+from types import ModuleType
+
+
+class LazyModule:
+    """A module which is only imported on first use, i.e., when one of its attributes is accessed. Modules holding
+    compute backends (CuPy, PyTorch) are imported this way, so that importing utils never pays their import cost
+    nor fails on machines without them, as long as their backend is not used.
+    """
+
+    def __init__(self, name: str, hint: str | None = None) -> None:
+        """
+        Args:
+            name (str): The full name of the module, e.g., "cupyx.scipy.spatial.distance".
+            hint (str | None, optional): Added to the ImportError raised when the module is missing. Defaults to None.
+        """
+        self._name = name
+        self._hint = hint
+        self._module: ModuleType | None = None
+
+    def _load(self) -> ModuleType:
+        if self._module is None:
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError as error:
+                message = f"{self._name} is not installed"
+                if self._hint is not None:
+                    message = f"{message}: {self._hint}"
+                raise ImportError(message) from error
+        return self._module
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+# The "cupy" backend of utils.dx: CuPy and the cdist of cupyx
+cp = LazyModule("cupy", 'the "cupy" backend requires CuPy, use the "numpy" backend')
+distance = LazyModule(
+    "cupyx.scipy.spatial.distance",
+    'the "cupy" backend requires CuPy, use the "numpy" backend',
+)
+torch = LazyModule("torch")
+
+# Only needed to load models and tokenizers, see text_lm.load_model_vocabulary and detokenizer.TableDecoder
+huggingface_hub = LazyModule("huggingface_hub")
+safetensors = LazyModule("safetensors")
+tokenization_gpt2 = LazyModule("transformers.models.gpt2.tokenization_gpt2")
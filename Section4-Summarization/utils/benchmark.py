@@ -0,0 +1,185 @@
+import json
+import os
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from datetime import datetime, timezone
+from os.path import join, exists
+from time import perf_counter
+from typing import Callable
+from utils.backends import cp
+
+# The shapes of the embedding matrices of the models of the experiments, and scaled-down variants of them
+VOCABULARY_SHAPES = {
+    "bart": (50265, 1024),
+    "llama3": (128256, 4096),
+    "bart/8": (50265 // 8, 1024),
+    "llama3/16": (128256 // 16, 4096),
+}
+
+
+def synthetic_vocabulary(
+    vocab_size: int,
+    hidden_size: int,
+    scale: float = 0.05,
+    seed: int = 0,
+    block_size: int = 8192,
+) -> np.ndarray:
+    """A random float32 embedding matrix, with normal coordinates of standard deviation scale. Generated block by block,
+    without the float64 copy of the whole matrix, so that Llama 3 sized matrices fit in memory.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.empty((vocab_size, hidden_size), dtype=np.float32)
+    for i in range(0, vocab_size, block_size):
+        block = vocabulary[i : i + block_size]
+        rng.standard_normal(block.shape, dtype=np.float32, out=block)
+        block *= scale
+    return vocabulary
+
+
+def synthetic_texts(
+    vocab_size: int,
+    number_of_texts: int,
+    length: int,
+    pad_fraction: float = 0.25,
+    seed: int = 0,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Random texts of token ids, right-padded to length. Each text has between (1 - 2 * pad_fraction) * length and length
+    tokens, so that about pad_fraction of the positions are pad tokens.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The token ids and the attention mask, both of shape (number_of_texts, length).
+    """
+    rng = np.random.default_rng(seed)
+    texts_ids = rng.integers(0, vocab_size, (number_of_texts, length))
+    lengths = rng.integers(
+        max(1, round((1 - 2 * pad_fraction) * length)), length + 1, number_of_texts
+    )
+    attention_mask = (np.arange(length) < lengths[:, np.newaxis]).astype(np.int64)
+    return texts_ids, attention_mask
+
+
+def measure(
+    function: Callable[[], object],
+    tokens: int,
+    backend: str,
+    repetitions: int = 3,
+) -> dict:
+    """Times function, which processes tokens tokens with backend. A first untimed run measures the peak memory
+    allocated by function: host memory traced by tracemalloc (numpy reports its arrays to it) for "numpy", the growth of
+    the memory pool of CuPy for "cupy". It also serves as warm-up.
+
+    Returns:
+        dict: The median and minimum time of the repetitions in seconds, the throughput in tokens per second (for the
+            median time) and the peak memory in bytes.
+    """
+    if backend == "cupy":
+        mempool = cp.get_default_memory_pool()
+        mempool.free_all_blocks()
+        baseline = mempool.total_bytes()
+        function()
+        cp.cuda.Device().synchronize()
+        peak_bytes = mempool.total_bytes() - baseline
+    else:
+        tracemalloc.start()
+        try:
+            baseline = tracemalloc.get_traced_memory()[0]
+            function()
+            peak_bytes = tracemalloc.get_traced_memory()[1] - baseline
+        finally:
+            tracemalloc.stop()
+
+    seconds = []
+    for _ in range(repetitions):
+        start = perf_counter()
+        function()
+        if backend == "cupy":
+            cp.cuda.Device().synchronize()
+        seconds.append(perf_counter() - start)
+    median = float(np.median(seconds))
+    return {
+        "tokens": tokens,
+        "median_seconds": median,
+        "min_seconds": float(np.min(seconds)),
+        "tokens_per_second": tokens / median,
+        "peak_bytes": int(peak_bytes),
+    }
+
+
+def machine_info(backends: list[str]) -> dict:
+    """Describes the commit and the machine of a run, so that results can be compared across both."""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    info = {
+        "commit": commit,
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+    }
+    if "cupy" in backends:
+        info["cupy"] = cp.__version__
+        info["gpu"] = cp.cuda.runtime.getDeviceProperties(cp.cuda.Device().id)[
+            "name"
+        ].decode()
+    return info
+
+
+def result_key(result: dict) -> tuple:
+    """What a result measures, to match the results of two runs."""
+    return (
+        result["vocabulary"],
+        result["backend"],
+        result["stage"],
+        result["requested_chunk_size"],
+    )
+
+
+def save_results(run: dict, folderpath: str) -> str:
+    """Saves a run as JSON in folderpath, named after its date and commit. Returns the path of the file."""
+    if not exists(folderpath):
+        os.makedirs(folderpath)
+    date = run["machine"]["date"].replace(":", "").replace("-", "")
+    commit = (run["machine"]["commit"] or "nocommit")[:8]
+    filepath = join(folderpath, f"benchmark_{date}_{commit}.json")
+    tmp_filepath = f"{filepath}.tmp"
+    with open(tmp_filepath, "w") as f:
+        json.dump(run, f, indent=2)
+    os.replace(tmp_filepath, filepath)
+    return filepath
+
+
+def compare_results(run: dict, baseline: dict) -> list[dict]:
+    """The speedup of each result of run over the result measuring the same thing in baseline, see result_key.
+
+    Returns:
+        list[dict]: One dict per result of run found in baseline, with its key, the throughput of both and the speedup.
+    """
+    baseline_results = {result_key(r): r for r in baseline["results"]}
+    comparison = []
+    for result in run["results"]:
+        key = result_key(result)
+        if key not in baseline_results:
+            continue
+        before = baseline_results[key]["tokens_per_second"]
+        comparison.append(
+            {
+                "key": key,
+                "baseline_tokens_per_second": before,
+                "tokens_per_second": result["tokens_per_second"],
+                "speedup": result["tokens_per_second"] / before,
+            }
+        )
+    return comparison
@@ -0,0 +1,153 @@
+import numpy as np
+import re
+from typing import TYPE_CHECKING
+from utils.tools import best_uint_type
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+# Tokens which are never output by the dx-privacy mechanism when excluded, see excluded_token_ids:
+# - byte fallback tokens of SentencePiece tokenizers, e.g., "<0x0A>"
+BYTE_FALLBACK_PATTERN = re.compile(r"<0x[0-9A-Fa-f]{2}>")
+# - placeholders which were never trained, e.g., "madeupword0000" (BART) or "[unused12]" (BERT)
+UNUSED_PATTERN = re.compile(r"madeupword\d+|\[unused\d+\]|<unused\d+>")
+
+
+class CandidateVocabulary:
+    """The elements of the vocabulary which can be output by the dx-privacy mechanism (the candidates), stored
+    as a compact matrix. Nearest neighbor searches and the post-processing fix run against this matrix, so excluded
+    elements (e.g., special tokens) are never output and do not cost anything, and their results are ids of
+    candidates, which are mapped back to token ids with to_token_ids. The tokens to sanitize do not need to be
+    candidates themselves, their embeddings are taken from the whole vocabulary.
+
+    Tables built for the vocabulary (neighbor tables, safe radii, see utils.neighbor_table) must be built for
+    the candidate matrix instead, e.g., get_neighbor_table(candidates.embeddings, ..., candidates.revision(revision)).
+    """
+
+    def __init__(
+        self,
+        token_ids: np.ndarray,
+        embeddings: np.ndarray,
+        vocab_size: int,
+        name: str = "candidates",
+    ) -> None:
+        """
+        Args:
+            token_ids (np.ndarray): The sorted token ids of the candidates, see from_vocabulary.
+            embeddings (np.ndarray): A two-dimensional array containing the embeddings of the candidates, in the same order.
+            vocab_size (int): The number of elements of the whole vocabulary.
+            name (str, optional): Identifies the selection of candidates in the file names of tables. Defaults to "candidates".
+        """
+        self.token_ids = np.asarray(token_ids).astype(best_uint_type(vocab_size))
+        self.embeddings = embeddings
+        self.vocab_size = vocab_size
+        self.name = name
+        # Index of each token among the candidates, -1 for excluded tokens
+        self.candidate_ids = np.full(vocab_size, -1, dtype=np.int64)
+        self.candidate_ids[self.token_ids] = np.arange(self.token_ids.shape[0])
+
+    @classmethod
+    def from_vocabulary(
+        cls,
+        vocabulary: np.ndarray,
+        excluded_ids: np.ndarray,
+        name: str = "candidates",
+    ) -> "CandidateVocabulary":
+        """The candidates of a vocabulary, i.e., all its elements except excluded_ids (see excluded_token_ids)."""
+        keep = np.ones(vocabulary.shape[0], dtype=bool)
+        keep[np.asarray(excluded_ids, dtype=np.int64)] = False
+        token_ids = np.flatnonzero(keep)
+        return cls(
+            token_ids,
+            np.ascontiguousarray(vocabulary[token_ids]),
+            vocabulary.shape[0],
+            name,
+        )
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """The shape of the candidate matrix."""
+        return self.embeddings.shape
+
+    def to_token_ids(self, candidate_ids: np.ndarray) -> np.ndarray:
+        """The token ids of candidates given by their index in the candidate matrix."""
+        return self.token_ids[candidate_ids]
+
+    def to_candidate_ids(self, token_ids: np.ndarray) -> np.ndarray:
+        """The index of tokens in the candidate matrix, -1 for the tokens which are not candidates."""
+        return self.candidate_ids[token_ids]
+
+    def revision(self, revision: str) -> str:
+        """The revision of the model suffixed with the name of the candidates, to key the tables built for them."""
+        return f"{revision}_{self.name}"
+
+
+def excluded_token_ids(
+    tokenizer: "AutoTokenizer",
+    vocab_size: int,
+    special_tokens: bool = True,
+    byte_fallback: bool = True,
+    unused: bool = True,
+) -> np.ndarray:
+    """The ids of the tokens which should never be output by the dx-privacy mechanism.
+
+    Args:
+        tokenizer (AutoTokenizer): The tokenizer of the model.
+        vocab_size (int): The number of rows of the embedding matrix of the model, which may be larger than the
+            vocabulary of the tokenizer. The rows without a token are always excluded.
+        special_tokens (bool, optional): Exclude the special tokens, e.g., pad and end of sequence tokens,
+            or the reserved special tokens of Llama 3. Defaults to True.
+        byte_fallback (bool, optional): Exclude the byte fallback tokens of SentencePiece tokenizers. Defaults to True.
+        unused (bool, optional): Exclude placeholder tokens which were never trained, see UNUSED_PATTERN. Defaults to True.
+
+    Returns:
+        np.ndarray: The sorted ids of the excluded tokens.
+    """
+    excluded = set(range(min(len(tokenizer), vocab_size), vocab_size))
+    if special_tokens:
+        excluded.update(tokenizer.all_special_ids)
+        # Added tokens, e.g., "<|reserved_special_token_0|>", are not all listed in all_special_ids
+        excluded.update(
+            token_id
+            for token_id, token in tokenizer.added_tokens_decoder.items()
+            if token.special
+        )
+    if byte_fallback or unused:
+        tokens = tokenizer.convert_ids_to_tokens(
+            list(range(min(len(tokenizer), vocab_size)))
+        )
+        for token_id, token in enumerate(tokens):
+            if token is None:
+                continue
+            if (byte_fallback and BYTE_FALLBACK_PATTERN.fullmatch(token)) or (
+                unused and UNUSED_PATTERN.fullmatch(token)
+            ):
+                excluded.add(token_id)
+    return np.array(sorted(i for i in excluded if i < vocab_size), dtype=np.int64)
+
+
+def get_candidate_vocabulary(
+    tokenizer: "AutoTokenizer",
+    vocabulary: np.ndarray,
+    special_tokens: bool = True,
+    byte_fallback: bool = True,
+    unused: bool = True,
+) -> CandidateVocabulary:
+    """The candidates of the vocabulary of a model, without the tokens excluded by excluded_token_ids.
+    See excluded_token_ids for the arguments."""
+    excluded = excluded_token_ids(
+        tokenizer, vocabulary.shape[0], special_tokens, byte_fallback, unused
+    )
+    name = "_".join(
+        ["candidates"]
+        + [
+            kind
+            for kind, flag in (
+                ("special", special_tokens),
+                ("bytes", byte_fallback),
+                ("unused", unused),
+            )
+            if flag
+        ]
+    )
+    return CandidateVocabulary.from_vocabulary(vocabulary, excluded, name)
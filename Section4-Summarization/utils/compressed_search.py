@@ -0,0 +1,377 @@
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from utils.search import ExactNeighborSearch
+from utils.kmeans import kmeans, nearest_centroids
+from utils.files import print_timed
+
+# The compressed representations of the vocabulary supported by CompressedNeighborSearch:
+# - "float16": IEEE half precision, 2 bytes per dimension
+# - "bfloat16": the 16 most significant bits of the float32 values, 2 bytes per dimension
+# - "int8": one int8 per dimension and one float32 scale per row
+# - "pq": product quantization, one uint8 code per subspace of pq_subspace_dim dimensions
+COMPRESSIONS = ("float16", "bfloat16", "int8", "pq")
+
+
+def to_bfloat16(array: np.ndarray) -> np.ndarray:
+    """Rounds a float32 array to bfloat16 (to nearest, ties to even), returned as the uint16 upper halves."""
+    bits = np.ascontiguousarray(array, dtype=np.float32).view(np.uint32)
+    rounding = np.uint32(0x7FFF) + ((bits >> 16) & np.uint32(1))
+    return ((bits + rounding) >> 16).astype(np.uint16)
+
+
+def from_bfloat16(array: np.ndarray) -> np.ndarray:
+    """Converts the uint16 upper halves returned by to_bfloat16 back to a float32 array."""
+    return (array.astype(np.uint32) << 16).view(np.float32)
+
+
+class CompressedNeighborSearch(ExactNeighborSearch):
+    """Nearest neighbor search of embeddings against a compressed copy of the vocabulary, on CPU,
+    with an exact re-ranking in float32 so that the returned ids are the ones of ExactNeighborSearch.
+
+    Only the compressed vocabulary and a few floats per element are held in memory. The float32
+    vocabulary is not copied: pass it memory-mapped, as returned by text_lm.load_model_vocabulary, and
+    only the rows of the shortlists are read from it by the search. For Llama 3 (128256 x 4096), the
+    2 GiB of float32 become 1 GiB of float16, 512 MiB of int8 or 32 MiB of product quantization codes.
+
+    The compressed vocabulary is only an approximation ṽ of each element v, but the error of the
+    approximation is bounded by the residual norm r = ||v - ṽ||, which is computed once here. For an
+    embedding x, Cauchy-Schwarz gives |x·v - x·ṽ| <= ||x|| r, and the triangle inequality gives
+    ||x - v|| >= ||x - ṽ|| - r. The approximate scores thus give a lower bound of the exact score of
+    every element. The best approximate element is scored exactly first, and only the elements whose
+    lower bound is below its exact score can be nearer: this shortlist is re-ranked exactly. Its size
+    depends on how well the compression preserves the gaps between distances: a few elements for
+    float16, many more for product quantization. An embedding whose shortlist is longer than
+    max_shortlist_fraction of the vocabulary is searched exactly in the whole float32 vocabulary instead,
+    as streaming it through a GEMM is faster than gathering most of its rows.
+
+    The float16, bfloat16 and int8 scores are dot products with the vocabulary decompressed block by
+    block (numpy has no reduced precision matmul). The product quantization scores are asymmetric
+    distances: a lookup table of the distances between the sub-vectors of each embedding and the
+    centroids of each subspace is computed once per embedding, and the distance to an element is the
+    sum of the table entries of its codes, without any matmul against the vocabulary.
+
+    Only the nearest neighbor search (search) uses the compressed vocabulary. The ranking methods
+    inherited from ExactNeighborSearch (rank, nth_nearest_neighbors, ...) read the float32 vocabulary.
+    The average size of the shortlists of the last search is kept in shortlist_size.
+    """
+
+    def __init__(
+        self,
+        vocabulary: np.ndarray,
+        distance_metric: str = "euclidean",
+        compression: str = "pq",
+        n_threads: int | None = None,
+        block_size: int = 8192,
+        pq_subspace_dim: int = 16,
+        pq_sample_size: int = 16384,
+        pq_iterations: int = 10,
+        seed: int = 0,
+        tolerance: float = 1e-5,
+        max_shortlist_fraction: float = 0.1,
+    ) -> None:
+        """
+        Args:
+            vocabulary (np.ndarray): A two-dimensional float32 array containing all the embeddings of the
+                vocabulary, preferably memory-mapped. It is not copied.
+            distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary.
+                One of "euclidean" or "sqeuclidean", the cosine distance would need a normalized copy of the
+                vocabulary. Defaults to "euclidean".
+            compression (str, optional): One of COMPRESSIONS. Defaults to "pq".
+            n_threads (int | None, optional): The number of threads used for row-wise operations. Defaults to None,
+                which uses all available cores.
+            block_size (int, optional): The number of elements of the vocabulary scored at a time. Defaults to 8192.
+            pq_subspace_dim (int, optional): The number of dimensions of each subspace for product quantization,
+                it must divide the number of dimensions of the vocabulary. Defaults to 16.
+            pq_sample_size (int, optional): The number of elements of the vocabulary used to train the product
+                quantization centroids. Defaults to 16384.
+            pq_iterations (int, optional): The number of k-means iterations for product quantization. Defaults to 10.
+            seed (int, optional): The seed of the k-means initialization for product quantization. Defaults to 0.
+            tolerance (float, optional): Relative margin added to the bounds to account for float32 rounding. Defaults to 1e-5.
+            max_shortlist_fraction (float, optional): The largest fraction of the vocabulary re-ranked element by
+                element. Longer shortlists are re-ranked with the exact search of the whole vocabulary. Defaults to 0.1.
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Unknown compression {compression}, expected one of {COMPRESSIONS}"
+            )
+        if distance_metric == "cosine":
+            raise ValueError(
+                "Compressed vocabularies support the euclidean and sqeuclidean distances"
+            )
+        super().__init__(vocabulary, distance_metric, n_threads)
+        self.compression = compression
+        self.block_size = block_size
+        self.tolerance = tolerance
+        self.max_shortlist_fraction = max_shortlist_fraction
+
+        blocks = [
+            (start, min(start + block_size, self.vocab_size))
+            for start in range(0, self.vocab_size, block_size)
+        ]
+        if compression == "float16":
+            self.codes = np.empty(self.shape, dtype=np.float16)
+        elif compression == "bfloat16":
+            self.codes = np.empty(self.shape, dtype=np.uint16)
+        elif compression == "int8":
+            self.codes = np.empty(self.shape, dtype=np.int8)
+            self.scales = np.empty(self.vocab_size, dtype=np.float32)
+        else:
+            if self.hidden_size % pq_subspace_dim != 0:
+                raise ValueError(
+                    f"pq_subspace_dim={pq_subspace_dim} does not divide the {self.hidden_size} dimensions of the vocabulary"
+                )
+            self._train_codebooks(pq_subspace_dim, pq_sample_size, pq_iterations, seed)
+            # codes[m] holds the centroid of subspace m of each element
+            self.codes = np.empty(
+                (self.codebooks.shape[0], self.vocab_size), dtype=np.uint8
+            )
+        # The vocabulary is read block by block, once
+        for start, end in blocks:
+            self._encode(start, end)
+
+        self.max_norm = float(np.sqrt(self.vocab_sq_norms.max()))
+        self.residual_norms = np.empty(self.vocab_size, dtype=np.float32)
+        for start, end in blocks:
+            residuals = self.vocabulary[start:end] - self.decompress(start, end)
+            self.residual_norms[start:end] = np.linalg.norm(residuals, axis=-1)
+
+        self.shortlist_size = 0.0
+
+    def _train_codebooks(
+        self, subspace_dim: int, sample_size: int, iterations: int, seed: int
+    ) -> None:
+        """Learns 256 centroids per subspace with k-means on a sample of the vocabulary."""
+        rng = np.random.default_rng(seed)
+        n_subspaces = self.hidden_size // subspace_dim
+        sample = self.vocabulary[
+            np.sort(
+                rng.choice(
+                    self.vocab_size, min(sample_size, self.vocab_size), replace=False
+                )
+            )
+        ]
+        n_centroids = min(256, sample.shape[0])
+        self.codebooks = np.empty(
+            (n_subspaces, n_centroids, subspace_dim), dtype=np.float32
+        )
+        for m in range(n_subspaces):
+            self.codebooks[m] = kmeans(
+                np.ascontiguousarray(
+                    sample[:, m * subspace_dim : (m + 1) * subspace_dim]
+                ),
+                n_centroids,
+                iterations,
+                rng,
+            )
+
+    def _encode(self, start: int, end: int) -> None:
+        """Compresses the elements start to end of the vocabulary."""
+        block = np.asarray(self.vocabulary[start:end])
+        if self.compression == "float16":
+            self.codes[start:end] = block
+        elif self.compression == "bfloat16":
+            self.codes[start:end] = to_bfloat16(block)
+        elif self.compression == "int8":
+            scales = np.abs(block).max(axis=-1) / 127
+            scales[scales == 0] = 1
+            self.scales[start:end] = scales
+            self.codes[start:end] = np.rint(block / scales[:, np.newaxis])
+        else:
+            subspace_dim = self.codebooks.shape[2]
+            for m, codebook in enumerate(self.codebooks):
+                self.codes[m, start:end] = nearest_centroids(
+                    block[:, m * subspace_dim : (m + 1) * subspace_dim], codebook
+                )
+
+    @property
+    def compressed_nbytes(self) -> int:
+        """The number of bytes held in memory by the search: the compressed vocabulary, the norms of the
+        elements and of their residuals."""
+        nbytes = (
+            self.codes.nbytes + self.residual_norms.nbytes + self.vocab_sq_norms.nbytes
+        )
+        if self.compression == "int8":
+            nbytes += self.scales.nbytes
+        elif self.compression == "pq":
+            nbytes += self.codebooks.nbytes
+        return nbytes
+
+    def decompress(self, start: int, end: int) -> np.ndarray:
+        """The approximation of the elements start to end of the vocabulary, as a float32 array."""
+        if self.compression == "float16":
+            return self.codes[start:end].astype(np.float32)
+        if self.compression == "bfloat16":
+            return from_bfloat16(self.codes[start:end])
+        if self.compression == "int8":
+            return self.codes[start:end] * self.scales[start:end, np.newaxis]
+        subspaces = np.arange(self.codebooks.shape[0])[:, np.newaxis]
+        return (
+            self.codebooks[subspaces, self.codes[:, start:end]]
+            .transpose(1, 0, 2)
+            .reshape(end - start, self.hidden_size)
+        )
+
+    def lower_bounds(
+        self, executor: ThreadPoolExecutor, embeddings: np.ndarray, out: np.ndarray
+    ) -> np.ndarray:
+        """Lower bounds of the scores of ExactNeighborSearch.scores, computed with the compressed vocabulary
+        block by block, one block per thread for product quantization."""
+        embeddings_norms = np.linalg.norm(embeddings, axis=-1)[:, np.newaxis]
+        sq_norms = embeddings_norms**2
+        blocks = range(0, self.vocab_size, self.block_size)
+
+        if self.compression == "pq":
+            n_subspaces, n_centroids, subspace_dim = self.codebooks.shape
+            sub_embeddings = embeddings.reshape(-1, n_subspaces, subspace_dim)
+            # tables[m, i, c] = ||x_m - c||² for the sub-vector m of the i-th embedding and the centroid c of m
+            tables = np.matmul(
+                -2 * sub_embeddings.transpose(1, 0, 2),
+                self.codebooks.transpose(0, 2, 1),
+            )
+            tables += np.einsum("mcd,mcd->mc", self.codebooks, self.codebooks)[
+                :, np.newaxis
+            ]
+            tables += np.einsum("imd,imd->mi", sub_embeddings, sub_embeddings)[
+                :, :, np.newaxis
+            ]
+
+            def bound_block(start: int) -> None:
+                end = min(start + self.block_size, self.vocab_size)
+                block = out[:, start:end]
+                gathered = np.empty(block.shape, dtype=np.float32)
+                np.take(tables[0], self.codes[0, start:end], axis=-1, out=block)
+                for m in range(1, n_subspaces):
+                    np.take(tables[m], self.codes[m, start:end], axis=-1, out=gathered)
+                    block += gathered
+                # ||x - v|| >= ||x - ṽ|| - r, then back to the scores -2x·v + ||v||² = ||x - v||² - ||x||²
+                np.sqrt(np.maximum(block, 0, out=block), out=block)
+                block -= self.residual_norms[start:end]
+                np.maximum(block, 0, out=block)
+                block *= block
+                block -= sq_norms
+
+            list(executor.map(bound_block, blocks))
+            return out
+
+        # -2x·ṽ + ||v||² - 2||x|| r, decompressed blocks are multiplied by BLAS, which is already parallel
+        for start in blocks:
+            end = min(start + self.block_size, self.vocab_size)
+            block = np.matmul(
+                -2 * embeddings, self.decompress(start, end).T, out=out[:, start:end]
+            )
+            block += self.vocab_sq_norms[start:end]
+            block -= 2 * embeddings_norms * self.residual_norms[start:end]
+        return out
+
+    def search(self, embeddings: np.ndarray, chunk_size: int = -1) -> np.ndarray:
+        """Performs a nearest neighbor search of the embeddings against the vocabulary, chunk-by-chunk.
+        The shortlist of each embedding is computed with the compressed vocabulary, then re-ranked exactly.
+
+        Args:
+            embeddings (np.ndarray): A two-dimensional array containing the embeddings we want to process.
+            chunk_size (int, optional): The number of elements in embeddings to compute at a time. Defaults to -1,
+                which will determine the best chunk size considering the RAM available.
+
+        Returns:
+            np.ndarray: A one-dimensional array of shape (embeddings.shape[0]) containing the vocabulary index of the
+                nearest neighbor for each embedding.
+        """
+        input_size = embeddings.shape[0]
+        if chunk_size == -1:
+            chunk_size = self.best_chunk_size("nearest")
+        chunk_size = min(chunk_size, max(1, input_size))
+
+        noisy_ids = np.empty((input_size), dtype=self.ids_dtype)
+        shortlist_sizes = np.empty((input_size), dtype=np.int64)
+        buffer = np.empty((chunk_size, self.vocab_size), dtype=np.float32)
+        # Margin of the bounds for the float32 rounding of the scores
+        margin = self.tolerance * self.max_norm * (self.max_norm + 2)
+        max_shortlist_size = self.max_shortlist_fraction * self.vocab_size
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            for i in range(0, input_size, chunk_size):
+                j = min(i + chunk_size, input_size)
+                chunk = np.asarray(embeddings[i:j], dtype=np.float32)
+                bounds = self.lower_bounds(executor, chunk, out=buffer[: j - i])
+                chunk_margin = margin * (1 + np.linalg.norm(chunk, axis=-1))
+
+                long_shortlists = np.zeros(j - i, dtype=bool)
+
+                def rerank_rows(start: int, end: int) -> None:
+                    for row in range(start, end):
+                        # The exact score of the most promising element bounds the score of the nearest neighbor
+                        best = bounds[row].argmin()
+                        best_score = self.scores(chunk[row : row + 1], ids=[best])[0, 0]
+                        ids = np.flatnonzero(
+                            bounds[row] <= best_score + chunk_margin[row]
+                        )
+                        shortlist_sizes[i + row] = ids.shape[0]
+                        if ids.shape[0] > max_shortlist_size:
+                            long_shortlists[row] = True
+                            continue
+                        exact_scores = self.scores(chunk[row : row + 1], ids=ids)[0]
+                        noisy_ids[i + row] = ids[exact_scores.argmin()]
+
+                self._map_rows(executor, rerank_rows, j - i)
+
+                # Gathering most of the rows of the vocabulary is slower than streaming all of them through a GEMM
+                rows = np.flatnonzero(long_shortlists)
+                if rows.shape[0] > 0:
+                    scores = self.scores(chunk[rows], out=buffer[: rows.shape[0]])
+
+                    def argmin_rows(start: int, end: int) -> None:
+                        noisy_ids[i + rows[start:end]] = scores[start:end].argmin(
+                            axis=-1
+                        )
+
+                    self._map_rows(executor, argmin_rows, rows.shape[0])
+
+        self.shortlist_size = float(shortlist_sizes.mean()) if input_size > 0 else 0.0
+        return noisy_ids
+
+    def measure_savings(
+        self, embeddings: np.ndarray, sample_size: int = 1000, seed: int = 0
+    ) -> dict:
+        """Measures the memory held by the search and its speed against the exact search of the float32
+        vocabulary, on a random sample of the embeddings, and checks that both return the same ids.
+
+        Args:
+            embeddings (np.ndarray): A two-dimensional array containing embeddings, e.g., noisy embeddings.
+            sample_size (int, optional): The number of embeddings sampled. Defaults to 1000.
+            seed (int, optional): The seed of the sampling. Defaults to 0.
+
+        Returns:
+            dict: The bytes held in memory ("nbytes") and their ratio to the float32 vocabulary ("memory_ratio"),
+                the number of embeddings processed per second ("throughput", "exact_throughput"), the average
+                shortlist size and the fraction of ids equal to the exact search ("agreement").
+        """
+        rng = np.random.default_rng(seed)
+        sample_size = min(sample_size, embeddings.shape[0])
+        sample = embeddings[
+            np.sort(rng.choice(embeddings.shape[0], sample_size, replace=False))
+        ]
+
+        start = perf_counter()
+        ids = self.search(sample)
+        seconds = perf_counter() - start
+        start = perf_counter()
+        exact_ids = ExactNeighborSearch.search(self, sample)
+        exact_seconds = perf_counter() - start
+
+        float32_nbytes = self.vocab_size * self.hidden_size * 4
+        result = {
+            "nbytes": self.compressed_nbytes,
+            "memory_ratio": self.compressed_nbytes / float32_nbytes,
+            "throughput": sample_size / seconds,
+            "exact_throughput": sample_size / exact_seconds,
+            "shortlist_size": self.shortlist_size,
+            "agreement": float((ids == exact_ids).mean()),
+        }
+        print_timed(
+            f"{self.compression} vocabulary: {result['nbytes'] / 2**20:.1f} MiB against {float32_nbytes / 2**20:.1f} MiB "
+            f"in float32 ({result['memory_ratio']:.3f}x), {result['throughput']:.1f} embeddings/s against "
+            f"{result['exact_throughput']:.1f} for the exact search, shortlists of {result['shortlist_size']:.1f} "
+            f"elements, {result['agreement']:.2%} equal ids on {sample_size} embeddings"
+        )
+        return result
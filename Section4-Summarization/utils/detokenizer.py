@@ -0,0 +1,262 @@
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, exists
+from typing import TYPE_CHECKING
+from utils.backends import tokenization_gpt2
+from utils.files import print_timed
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+
+def clean_up_tokenization(text: str) -> str:
+    """Removes the spaces before punctuation and English contractions, same as
+    PreTrainedTokenizerBase.clean_up_tokenization (applied when the tokenizer has clean_up_tokenization_spaces).
+    """
+    return (
+        text.replace(" .", ".")
+        .replace(" ?", "?")
+        .replace(" !", "!")
+        .replace(" ,", ",")
+        .replace(" ' ", "'")
+        .replace(" n't", "n't")
+        .replace(" 'm", "'m")
+        .replace(" 's", "'s")
+        .replace(" 've", "'ve")
+        .replace(" 're", "'re")
+    )
+
+
+class TableDecoder:
+    """Decodes token ids of byte-level BPE tokenizers (BART, GPT-2, Llama 3) with a table of the bytes of each token,
+    instead of calling tokenizer.batch_decode. The bytes of all the tokens of a matrix of ids are gathered at once
+    into a flat buffer, and each text is then decoded from its slice of the buffer as UTF-8.
+
+    The bytes of token i are data[offsets[i]:offsets[i + 1]]. Special tokens and ids without a token (e.g., rows of
+    the embedding matrix beyond the tokenizer) have no bytes, i.e., they are skipped as with skip_special_tokens=True.
+    """
+
+    def __init__(
+        self, data: np.ndarray, offsets: np.ndarray, clean_up_spaces: bool = False
+    ) -> None:
+        """
+        Args:
+            data (np.ndarray): A one-dimensional uint8 array containing the bytes of all the tokens, see from_tokenizer.
+            offsets (np.ndarray): A one-dimensional array of size vocabulary size + 1, where the bytes of token i start.
+            clean_up_spaces (bool, optional): Apply clean_up_tokenization to the decoded texts. Defaults to False.
+        """
+        self.data = data
+        self.offsets = offsets.astype(np.int64)
+        self.lengths = np.diff(self.offsets)
+        self.clean_up_spaces = clean_up_spaces
+
+    @classmethod
+    def from_tokenizer(
+        cls, tokenizer: "AutoTokenizer", vocab_size: int | None = None
+    ) -> "TableDecoder":
+        """Builds the table of a tokenizer.
+
+        Args:
+            tokenizer (AutoTokenizer): A byte-level BPE tokenizer, slow or fast.
+            vocab_size (int | None, optional): The number of ids to decode, which may be larger than the vocabulary
+                of the tokenizer (e.g., the number of rows of the embedding matrix). Defaults to None, which uses len(tokenizer).
+
+        Returns:
+            TableDecoder: The decoder of the tokenizer.
+        """
+        if vocab_size is None:
+            vocab_size = len(tokenizer)
+        byte_decoder = {
+            char: byte for byte, char in tokenization_gpt2.bytes_to_unicode().items()
+        }
+        skipped = set(tokenizer.all_special_ids)
+        # Added tokens, e.g., "<|reserved_special_token_0|>", are not all listed in all_special_ids
+        skipped.update(
+            token_id
+            for token_id, token in tokenizer.added_tokens_decoder.items()
+            if token.special
+        )
+        added = {
+            token_id: token.content
+            for token_id, token in tokenizer.added_tokens_decoder.items()
+        }
+
+        tokens = tokenizer.convert_ids_to_tokens(
+            list(range(min(len(tokenizer), vocab_size)))
+        )
+        tokens_bytes = [b""] * vocab_size
+        for token_id, token in enumerate(tokens):
+            if token is None or token_id in skipped:
+                continue
+            if token_id in added:
+                # Added tokens are not byte-level encoded
+                tokens_bytes[token_id] = added[token_id].encode("utf-8")
+            elif all(char in byte_decoder for char in token):
+                tokens_bytes[token_id] = bytes(byte_decoder[char] for char in token)
+            else:
+                raise ValueError(
+                    f"Token {token_id} ({token!r}) is not byte-level encoded, only byte-level BPE tokenizers are supported"
+                )
+
+        offsets = np.zeros(vocab_size + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in tokens_bytes], out=offsets[1:])
+        data = np.frombuffer(b"".join(tokens_bytes), dtype=np.uint8)
+        return cls(
+            data,
+            offsets,
+            bool(getattr(tokenizer, "clean_up_tokenization_spaces", False)),
+        )
+
+    def _texts_bytes(self, texts_ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Gathers the bytes of all the texts into a flat buffer. Returns the buffer and where each text starts."""
+        lengths = self.lengths[texts_ids]
+        text_offsets = np.zeros(texts_ids.shape[0] + 1, dtype=np.int64)
+        np.cumsum(lengths.sum(axis=-1), out=text_offsets[1:])
+        lengths = lengths.ravel()
+        # Index in data of each byte of the output: the start of its token, plus its position in the token
+        token_starts = np.cumsum(lengths) - lengths
+        index = np.arange(text_offsets[-1], dtype=np.int64)
+        index += np.repeat(self.offsets[texts_ids.ravel()] - token_starts, lengths)
+        return self.data[index], text_offsets
+
+    def _decode_rows(self, texts_ids: np.ndarray) -> list[str]:
+        """See decode, without processes."""
+        if texts_ids.shape[0] == 0:
+            return []
+        buffer, text_offsets = self._texts_bytes(texts_ids)
+        buffer = buffer.tobytes()
+        texts = [
+            buffer[start:end].decode("utf-8", errors="replace")
+            for start, end in zip(text_offsets[:-1], text_offsets[1:])
+        ]
+        if self.clean_up_spaces:
+            texts = [clean_up_tokenization(text) for text in texts]
+        return texts
+
+    def decode(
+        self,
+        texts_ids: np.ndarray,
+        n_processes: int | None = None,
+        chunk_size: int = 256,
+    ) -> list[str]:
+        """Decodes texts, same as tokenizer.batch_decode(texts_ids, skip_special_tokens=True).
+
+        Args:
+            texts_ids (np.ndarray): A two-dimensional array containing the token ids of the texts, pad tokens included.
+            n_processes (int | None, optional): The number of processes decoding chunks of texts. Defaults to None,
+                which decodes in the calling process.
+            chunk_size (int, optional): The number of texts decoded at a time by a process. Defaults to 256.
+
+        Returns:
+            list[str]: The decoded texts.
+        """
+        texts_ids = np.asarray(texts_ids)
+        if n_processes is None or texts_ids.shape[0] <= chunk_size:
+            return self._decode_rows(texts_ids)
+        with ProcessPoolExecutor(n_processes) as executor:
+            chunks = executor.map(
+                self._decode_rows,
+                [
+                    texts_ids[i : i + chunk_size]
+                    for i in range(0, texts_ids.shape[0], chunk_size)
+                ],
+            )
+            return [text for chunk in chunks for text in chunk]
+
+    def save(self, filepath: str) -> None:
+        """Saves the table as a .npz file, see get_table_decoder."""
+        # np.savez appends .npz to file names without this extension, keep it for os.replace
+        tmp_filepath = f"{filepath}.tmp.npz"
+        np.savez(
+            tmp_filepath,
+            data=self.data,
+            offsets=self.offsets,
+            clean_up_spaces=self.clean_up_spaces,
+        )
+        os.replace(tmp_filepath, filepath)
+
+    @classmethod
+    def load(cls, filepath: str) -> "TableDecoder":
+        """Loads a table saved with save."""
+        with np.load(filepath) as f:
+            return cls(f["data"], f["offsets"], bool(f["clean_up_spaces"]))
+
+
+def table_decoder_filepath(folderpath: str, model_name: str, revision: str) -> str:
+    """Path of the decoding table of a tokenizer, keyed by its name and its revision."""
+    model_name = model_name.replace("/", "--")
+    return join(folderpath, f"{model_name}_{revision}_detokenizer.npz")
+
+
+def get_table_decoder(
+    tokenizer: "AutoTokenizer",
+    folderpath: str,
+    model_name: str,
+    revision: str,
+    vocab_size: int | None = None,
+) -> TableDecoder:
+    """Loads the decoding table of a tokenizer from folderpath. It is built first with TableDecoder.from_tokenizer
+    if it does not exist yet, or if it covers less than vocab_size ids.
+
+    Args:
+        tokenizer (AutoTokenizer): The tokenizer.
+        folderpath (str): The folder where tables are stored.
+        model_name (str): The name of the model, e.g., "facebook/bart-large-cnn".
+        revision (str): The revision of the model.
+        vocab_size (int | None, optional): See TableDecoder.from_tokenizer. Defaults to None.
+
+    Returns:
+        TableDecoder: The decoder of the tokenizer.
+    """
+    if not exists(folderpath):
+        os.makedirs(folderpath)
+    filepath = table_decoder_filepath(folderpath, model_name, revision)
+    if exists(filepath):
+        decoder = TableDecoder.load(filepath)
+        if vocab_size is None or decoder.lengths.shape[0] >= vocab_size:
+            return decoder
+    print_timed(f"Building the decoding table {filepath}")
+    decoder = TableDecoder.from_tokenizer(tokenizer, vocab_size)
+    decoder.save(filepath)
+    return decoder
+
+
+def check_decoder_parity(
+    decoder: TableDecoder,
+    tokenizer: "AutoTokenizer",
+    texts_ids: np.ndarray,
+    n_random_texts: int = 100,
+    seed: int = 0,
+) -> np.ndarray:
+    """Compares the texts decoded by decoder with tokenizer.batch_decode(texts_ids, skip_special_tokens=True).
+    Besides texts_ids (e.g., the tokenized corpus), random sequences of ids are checked as well, since sanitized
+    texts are made of other tokens than the original ones.
+
+    Args:
+        decoder (TableDecoder): The decoder to check.
+        tokenizer (AutoTokenizer): The tokenizer of the decoder.
+        texts_ids (np.ndarray): A two-dimensional array containing the token ids of texts.
+        n_random_texts (int, optional): The number of random sequences of ids (of the same length as the texts) checked. Defaults to 100.
+        seed (int, optional): The seed of the random sequences. Defaults to 0.
+
+    Returns:
+        np.ndarray: The indexes of the texts which are decoded differently, the random sequences being indexed after texts_ids.
+    """
+    texts_ids = np.asarray(texts_ids)
+    random_texts_ids = np.random.default_rng(seed).integers(
+        0,
+        min(len(tokenizer), decoder.lengths.shape[0]),
+        (n_random_texts, texts_ids.shape[1]),
+    )
+    all_texts_ids = np.concatenate(
+        [texts_ids, random_texts_ids.astype(texts_ids.dtype)]
+    )
+    expected = tokenizer.batch_decode(all_texts_ids.tolist(), skip_special_tokens=True)
+    mismatches = np.flatnonzero(
+        [a != b for a, b in zip(decoder.decode(all_texts_ids), expected)]
+    )
+    print_timed(
+        f"Decoding table: {len(mismatches)} of {len(expected)} texts decoded differently than batch_decode"
+    )
+    return mismatches
@@ -1,18 +1,107 @@
 import numpy as np
+import math
 from secrets import randbits
-import cupy as cp
-from cupyx.scipy.spatial import distance
-import torch
+from concurrent.futures import ThreadPoolExecutor
 from typing import Type
-from utils.tools import best_uint_type, best_chunk_size, rank_neighbors
+from utils.tools import (
+    best_uint_type,
+    nearest_neighbors_sorted,
+    nth_nearest_neighbors,
+    ray_nearest_neighbors,
+)
+from utils.search import ExactNeighborSearch
+from utils.ann import ApproximateNeighborSearch, AnnoyNeighborSearch, IVFNeighborSearch
+from utils.pruned_search import PrunedNeighborSearch
+from utils.compressed_search import CompressedNeighborSearch
+from utils.memory import get_planner
+
+# CuPy and PyTorch are imported on first use, CPU-only machines use the "numpy" backend
+from utils.backends import cp, distance, torch
+
+# "cupy" computes on GPU with cupyx's cdist, "numpy" computes on CPU with utils.search.ExactNeighborSearch
+BACKENDS = ("cupy", "numpy")
+
+# The indexes of the vocabulary available with the "numpy" backend, see prepare_vocabulary:
+# "pruned" is exact (utils.pruned_search), "annoy" and "ivf" are approximate (utils.ann)
+INDEXES = {
+    "pruned": PrunedNeighborSearch,
+    "annoy": AnnoyNeighborSearch,
+    "ivf": IVFNeighborSearch,
+}
+
+
+# The number of noise vectors drawn from each random stream of a seeded sampling, see sample_noise_vectors_np.
+# Fixed, so that the noise only depends on the seed and not on the number of threads.
+SEEDED_BLOCK_SIZE = 16384
+
+
+def derive_seed(
+    seed: np.random.SeedSequence | None, *key: int
+) -> np.random.SeedSequence | None:
+    """The seed of the random stream identified by key (non-negative integers) under seed, e.g., one stream per
+    epsilon value and chunk of tokens. The same seed and key always give the same stream, whatever the order in
+    which streams are derived. None when seed is None, i.e., fresh entropy from the OS, see random_generator.
+    """
+    if seed is None:
+        return None
+    return np.random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key + key)
+
+
+def random_generator(seed: np.random.SeedSequence | None = None) -> np.random.Generator:
+    """The random generator of a seed: the counter-based Philox generator, so that the stream of a seed is the same
+    on every machine. Defaults to None, which seeds the default generator (PCG64) with fresh entropy from the OS.
+    """
+    if seed is None:
+        return np.random.default_rng(np.random.SeedSequence(randbits(128)))
+    return np.random.Generator(np.random.Philox(seed))
+
+
+def fill_noise_vectors(
+    rng: np.random.Generator,
+    out: np.ndarray,
+    epsilon: float | np.ndarray,
+) -> None:
+    """Fill the two-dimensional array out of shape (number of vectors, dimension) with noise vectors
+    according to the definition by (Feyisetan et al., 2020) and (Qu et al., 2021). Computed in-place
+    in the dtype of out, which must be np.float32 or np.float64.
+
+    Args:
+        rng (np.random.Generator): The random generator to sample from.
+        out (np.ndarray): The C-contiguous array to fill.
+        epsilon (float | np.ndarray): The epsilon value in the dx-privacy formula, or an array of shape
+            (number of vectors) with the epsilon value of each vector.
+    """
+    number_of_vectors, dimension = out.shape
+
+    # Sample each coordinate from the standard normal distribution, directly in the output buffer.
+    # This is the multivariate normal distribution with the origin as mean and the identity matrix
+    # as covariance following (Feyisetan et al., 2020, Sec. 2.6), without factorizing the covariance matrix.
+    # https://numpy.org/doc/stable/reference/random/generated/numpy.random.Generator.standard_normal.html
+    rng.standard_normal(out=out, dtype=out.dtype)
+
+    # Norm of each vector, without allocating a temporary array of the same size as out.
+    norms = np.sqrt(np.einsum("ij,ij->i", out, out, dtype=np.float64))
+
+    # Generate an array of magnitude scalars.
+    # https://numpy.org/doc/stable/reference/random/generated/numpy.random.Generator.gamma.html
+    # shape: Shape of the gamma distribution, often noted "k". Set to the embeddings' dimension following (Feyisetan et al., 2020, Sec. 2.6) and (Qu et al., 2021, Sec. 3.2.3)
+    # scale: Scale of the distribution, often noted theta. Set to 1/epsilon following (Feyisetan et al., 2020, Sec. 2.6) and (Qu et al., 2021, Sec. 3.2.3), one scale per vector for an array of epsilon values
+    # size: Shape of the ouput. Set to the number of magnitude scalars we need.
+    magnitudes = rng.gamma(shape=dimension, scale=1.0 / epsilon, size=number_of_vectors)
+
+    # Normalize each vector by dividing it by its norm and scale it by its magnitude, in one pass.
+    out *= (magnitudes / norms).astype(out.dtype)[:, np.newaxis]
 
 
 def sample_noise_vectors_np(
     dimension: int,
     shape1: int,
     shape2: int,
-    epsilon: float,
+    epsilon: float | np.ndarray,
     dtype: Type[np.floating] = np.float32,
+    out: np.ndarray | None = None,
+    n_threads: int = 1,
+    seed: np.random.SeedSequence | None = None,
 ) -> np.ndarray:
     """Sample shape1*shape2 noise vectors of dimensions _dimension_ according to the
     definition by (Feyisetan et al., 2020) and (Qu et al., 2021).
@@ -21,61 +110,124 @@ def sample_noise_vectors_np(
         dimension (int): The number of dimensions for the noise vectors. Also called hidden size.
         shape1 (int): The first shape of the array of noise vectors
         shape2 (int): The second shape of the array of noise vectors
-        epsilon (float): The epsilon value in the dx-privacy formula.
-        dtype (Type[np.floating], optional): The data type of the vectors. Defaults to np.float32.
+        epsilon (float | np.ndarray): The epsilon value in the dx-privacy formula, or an array broadcastable to
+            (shape1, shape2) with the epsilon value of each noise vector, e.g., one value per text of shape (shape1, 1).
+        dtype (Type[np.floating], optional): The data type of the vectors, np.float32 or np.float64. Defaults to np.float32.
+        out (np.ndarray | None, optional): A C-contiguous array of shape (shape1, shape2, dimension) and dtype _dtype_
+            to write the noise vectors into, e.g., to reuse the same buffer for all batches. Defaults to None,
+            which allocates a new array.
+        n_threads (int, optional): The number of threads filling the array, each with its own independent random
+            stream spawned from the same seed. Only useful for large arrays. Defaults to 1.
+        seed (np.random.SeedSequence | None, optional): If set, the noise is reproducible: each block of
+            SEEDED_BLOCK_SIZE vectors is drawn from its own stream derived from seed (see derive_seed), so that the
+            result does not depend on n_threads. Defaults to None, which draws from fresh entropy.
 
     Returns:
         np.ndarray: The noise vector of shape (shape1, shape2, dimension)
     """
-    rng = np.random.default_rng(randbits(128))
-
-    # Generate an array of noise vectors sampled from the multivariate normal distribution
-    # https://numpy.org/doc/stable/reference/random/generated/numpy.random.Generator.multivariate_normal.html
-    # mean: Mean of the N-dimensional distribution. Chosen as the origin following (Feyisetan et al., 2020, Sec. 2.6)
-    # cov: The covariance matrix of the distribution. Chosen as the identity matrix following (Feyisetan et al., 2020, Sec. 2.6)
-    # size: Shape of the ouput. Set to the number of noise vectors we need.
-    # check_valid: raise error if the covariance matrix is not positive semidefinite.
-    # tol: Tolerance when checking the singular values in covariance matrix. Unset, default 1e-8.
-    # method: Method for computing an intermediate matrix. Only impacts performances. "cholesky" is the fastest.
-    origin = np.full(dimension, 0)
-    cov_matrix = np.identity(dimension)
-    noises = rng.multivariate_normal(
-        mean=origin,
-        cov=cov_matrix,
-        size=(shape1, shape2),
-        check_valid="raise",
-        method="cholesky",
-    ).astype(dtype)
-
-    # Normalize each noise by dividing each vector by its norm.
-    # https://numpy.org/doc/stable/reference/generated/numpy.linalg.norm.html
-    # x: The vector to be normalized
-    # ord: Order of the norm. None uses the Frobenius matrix norm, which, applied on vectors, results in the Euclidean/L2 norm.
-    # axis: Specifies the axis of x along which to compute the vector norms. We want each single vector to be normalized thus choosing the last axis i.e. -1
-    # keepdims: The normed axis are left in the result as dimensions with size one.
-    noises /= np.linalg.norm(noises, ord=None, axis=-1, keepdims=True).astype(dtype)
+    if out is None:
+        out = np.empty((shape1, shape2, dimension), dtype=dtype)
+    elif out.shape != (shape1, shape2, dimension) or out.dtype != dtype:
+        raise ValueError(
+            f"out must have shape {(shape1, shape2, dimension)} and dtype {np.dtype(dtype)}, got {out.shape} and {out.dtype}"
+        )
+    elif not out.flags.c_contiguous:
+        # reshape would return a copy, and the noise would never reach out
+        raise ValueError("out must be C-contiguous")
+    noises = out.reshape(-1, dimension)
+    number_of_vectors = noises.shape[0]
+    if np.ndim(epsilon) > 0:
+        # One epsilon value per noise vector, in the same order as noises
+        epsilon = np.broadcast_to(
+            np.asarray(epsilon, dtype=np.float64), (shape1, shape2)
+        ).reshape(-1)
+
+    if seed is not None:
+        # One stream per block of vectors, the blocks being shared among the threads
+        def fill_block(b: int) -> None:
+            start = b * SEEDED_BLOCK_SIZE
+            end = min(start + SEEDED_BLOCK_SIZE, number_of_vectors)
+            fill_noise_vectors(
+                random_generator(derive_seed(seed, b)),
+                noises[start:end],
+                epsilon if np.ndim(epsilon) == 0 else epsilon[start:end],
+            )
+
+        number_of_blocks = -(-number_of_vectors // SEEDED_BLOCK_SIZE)
+        if n_threads <= 1 or number_of_blocks == 1:
+            for b in range(number_of_blocks):
+                fill_block(b)
+        else:
+            with ThreadPoolExecutor(n_threads) as executor:
+                list(executor.map(fill_block, range(number_of_blocks)))
+        return out
+
+    seed_sequence = np.random.SeedSequence(randbits(128))
+    if n_threads <= 1 or number_of_vectors < 2 * n_threads:
+        fill_noise_vectors(np.random.default_rng(seed_sequence), noises, epsilon)
+        return out
+
+    # Each thread fills its own block of vectors with its own independent stream
+    # https://numpy.org/doc/stable/reference/random/parallel.html
+    block_size = -(-number_of_vectors // n_threads)
+    generators = [np.random.default_rng(s) for s in seed_sequence.spawn(n_threads)]
+    with ThreadPoolExecutor(n_threads) as executor:
+        list(
+            executor.map(
+                lambda k: fill_noise_vectors(
+                    generators[k],
+                    noises[k * block_size : (k + 1) * block_size],
+                    (
+                        epsilon
+                        if np.ndim(epsilon) == 0
+                        else epsilon[k * block_size : (k + 1) * block_size]
+                    ),
+                ),
+                range(n_threads),
+            )
+        )
 
-    # Generate an array of magnitude scalars.
-    # https://numpy.org/doc/stable/reference/random/generated/numpy.random.Generator.gamma.html
-    # shape: Shape of the gamma distribution, often noted "k". Set to the embeddings' dimension following (Feyisetan et al., 2020, Sec. 2.6) and (Qu et al., 2021, Sec. 3.2.3)
-    # scale: Scale of the distribution, often noted theta. Set to 1/epsilon following (Feyisetan et al., 2020, Sec. 2.6) and (Qu et al., 2021, Sec. 3.2.3)
-    # size: Shape of the ouput. Set to the number of magnitude scalars we need.
-    magnitudes = rng.gamma(
-        shape=dimension, scale=1.0 / epsilon, size=(shape1, shape2)
-    ).astype(dtype)
+    return out
 
-    noises *= magnitudes[..., np.newaxis]
 
-    return noises
+def sample_noise_rays_np(
+    dimension: int,
+    size: int,
+    dtype: Type[np.floating] = np.float32,
+    seed: np.random.SeedSequence | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Sample the directions and the base magnitudes of _size_ noise vectors, from which the noise vectors of
+    sample_noise_vectors_np are obtained for any epsilon as directions * (magnitudes / epsilon)[:, np.newaxis].
+    The directions are uniform on the unit sphere and the magnitudes follow Gamma(dimension, 1), so for each
+    epsilon taken separately, the noise follows the same distribution as with sample_noise_vectors_np. The noise
+    vectors of different epsilon values are however fully correlated (common random numbers).
+
+    Args:
+        dimension (int): The number of dimensions for the noise vectors. Also called hidden size.
+        size (int): The number of noise vectors.
+        dtype (Type[np.floating], optional): The data type of the directions, np.float32 or np.float64. Defaults to np.float32.
+        seed (np.random.SeedSequence | None, optional): The seed of the random stream, see random_generator. Defaults to None.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: The unit directions of shape (size, dimension) and the float64 base magnitudes of shape (size).
+    """
+    rng = random_generator(seed)
+    directions = rng.standard_normal(size=(size, dimension), dtype=dtype)
+    directions /= np.sqrt(
+        np.einsum("ij,ij->i", directions, directions, dtype=np.float64)
+    ).astype(dtype)[:, np.newaxis]
+    # See fill_noise_vectors, with epsilon = 1
+    magnitudes = rng.gamma(shape=dimension, scale=1.0, size=size)
+    return directions, magnitudes
 
 
 def sample_noise_vectors(
     dimension: int,
     shape1: int,
     shape2: int,
-    epsilon: float,
+    epsilon: float | np.ndarray,
     dtype: Type[np.floating] = np.float32,
-) -> torch.Tensor:
+) -> "torch.Tensor":
     """Sample shape1*shape2 noise vectors of dimensions _dimension_ according to the
     definition by (Feyisetan et al., 2020) and (Qu et al., 2021).
 
@@ -83,7 +235,8 @@ def sample_noise_vectors(
         dimension (int): The number of dimensions for the noise vectors. Also called hidden size.
         shape1 (int): The first shape of the array of noise vectors
         shape2 (int): The second shape of the array of noise vectors
-        epsilon (float): The epsilon value in the dx-privacy formula.
+        epsilon (float | np.ndarray): The epsilon value in the dx-privacy formula, or an array broadcastable to
+            (shape1, shape2), see sample_noise_vectors_np.
         dtype (Type[np.floating], optional): The data type of the vectors. Defaults to np.float32.
 
     Returns:
@@ -114,12 +267,9 @@ def noisy_embeddings_to_ids_cp_chunked(
        nearest neighbor for each embedding.
     """
     if chunk_size == -1:
-        # Calculate the ideal chunk_size for the computation. Note that
-        # cupyx.scipy.spatial.distance.cdist(x1, x2) first allocates an array of shape
-        # (x1.shape[0], x2.shape[0]) with float64 precision.
-        chunk_size = best_chunk_size(
-            vocabulary.shape[0] * vocabulary.shape[1] * 4,
-            embeddings.shape[1] * 4 + vocabulary.shape[0] * 8,
+        # Calculate the ideal chunk_size for the computation, see utils.memory.MemoryPlanner
+        chunk_size = get_planner("cupy").chunk_size(
+            "nearest", vocabulary.shape, embeddings.shape[1]
         )
 
     input_size = embeddings.shape[0]
@@ -138,6 +288,154 @@ def noisy_embeddings_to_ids_cp_chunked(
     return noisy_ids
 
 
+def noisy_embeddings_to_ids_np_chunked(
+    embeddings: np.ndarray,
+    vocabulary: np.ndarray | ExactNeighborSearch,
+    distance_metric: str = "euclidean",
+    chunk_size: int = -1,
+) -> np.ndarray:
+    """Performs a nearest neighbor search of the embeddings against the vocabulary on CPU, chunk-by-chunk.
+    Same as noisy_embeddings_to_ids_cp_chunked, without requiring a GPU.
+
+    Args:
+        embeddings (np.ndarray): A two-dimensional array containing the embeddings we want to process.
+        vocabulary (np.ndarray | ExactNeighborSearch): A two-dimensional array containing all the embeddings of the vocabulary
+            to compute the nearest neighbor search against, or the same vocabulary already prepared with prepare_vocabulary.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        chunk_size (int, optional): The number of elements in embeddings to compute at a time. Defaults to -1, which will
+            determine the best chunk size considering the RAM available.
+
+    Returns:
+        np.ndarray: A one-dimensional array of shape (embeddings.shape[0]) containing the vocabulary index of the
+       nearest neighbor for each embedding.
+    """
+    searcher = prepare_vocabulary(vocabulary, distance_metric, "numpy")
+    return searcher.search(embeddings, chunk_size)
+
+
+def prepare_vocabulary(
+    vocabulary: np.ndarray,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    index: str | None = None,
+    compression: str | None = None,
+    index_options: dict | None = None,
+):
+    """Loads the vocabulary in the form expected by the backend. Call it once before
+    processing many texts to avoid repeating this step for each of them.
+
+    Args:
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): One of BACKENDS. Defaults to "cupy".
+        index (str | None, optional): One of INDEXES to search the nearest neighbors with an index of the vocabulary,
+            either exact or approximate. Only supported by the "numpy" backend. Defaults to None.
+        compression (str | None, optional): One of utils.compressed_search.COMPRESSIONS to search the nearest neighbors
+            against a compressed vocabulary, with an exact re-ranking. The vocabulary is not copied, pass it
+            memory-mapped to only hold the compressed vocabulary in memory. Only supported by the "numpy" backend,
+            without index. Defaults to None.
+        index_options (dict | None, optional): Keyword arguments of the class of INDEXES[index], e.g., its recall/latency
+            knobs {"n_probes": 16} for "ivf" or {"n_candidates": 50, "search_k": 5000} for "annoy". Defaults to None.
+
+    Returns:
+        The vocabulary as a cupy array for the "cupy" backend, or an ExactNeighborSearch (the class of INDEXES[index]
+            if index is given, a CompressedNeighborSearch if compression is given) for the "numpy" backend.
+    """
+    # An index is searched on CPU whatever the backend, see noisy_embeddings_to_ids
+    if isinstance(vocabulary, ApproximateNeighborSearch):
+        return vocabulary
+    if index is not None and compression is not None:
+        raise ValueError("Set either index or compression")
+    if index is not None:
+        if backend != "numpy":
+            raise ValueError("Indexes are only supported by the numpy backend")
+        if index not in INDEXES:
+            raise ValueError(f"Unknown index {index}, expected one of {tuple(INDEXES)}")
+        return INDEXES[index](vocabulary, distance_metric, **(index_options or {}))
+    if compression is not None:
+        if backend != "numpy":
+            raise ValueError(
+                "Compressed vocabularies are only supported by the numpy backend"
+            )
+        if isinstance(vocabulary, CompressedNeighborSearch):
+            return vocabulary
+        return CompressedNeighborSearch(vocabulary, distance_metric, compression)
+    if backend == "cupy":
+        # Casting to float32 as distance.cdist will do it anyway, and we want to avoid a second copy.
+        return cp.asarray(vocabulary, dtype="float32")
+    if backend == "numpy":
+        if isinstance(vocabulary, ExactNeighborSearch):
+            return vocabulary
+        return ExactNeighborSearch(vocabulary, distance_metric)
+    raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+
+
+def noisy_embeddings_to_ids(
+    embeddings: np.ndarray,
+    vocabulary,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+) -> np.ndarray:
+    """Performs a nearest neighbor search of the embeddings against the vocabulary with the chosen backend.
+
+    Args:
+        embeddings (np.ndarray): A two-dimensional array containing the embeddings we want to process.
+        vocabulary: The vocabulary, either as a two-dimensional array or as returned by prepare_vocabulary. An approximate
+            index (see utils.ann) is searched on CPU whatever the backend.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): One of BACKENDS. Defaults to "cupy".
+
+    Returns:
+        np.ndarray: A one-dimensional array of shape (embeddings.shape[0]) containing the vocabulary index of the
+       nearest neighbor for each embedding.
+    """
+    if isinstance(vocabulary, ApproximateNeighborSearch):
+        return vocabulary.search(embeddings)
+    if backend == "numpy":
+        return noisy_embeddings_to_ids_np_chunked(
+            embeddings, vocabulary, distance_metric
+        )
+    if backend == "cupy":
+        return noisy_embeddings_to_ids_cp(embeddings, vocabulary, distance_metric)
+    raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+
+
+def noisy_rays_to_ids(
+    embeddings: np.ndarray,
+    directions: np.ndarray,
+    steps: np.ndarray,
+    vocabulary,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+) -> np.ndarray:
+    """Performs the nearest neighbor search of embeddings[i] + steps[i, k] * directions[i] for all k in one pass,
+    see search.ExactNeighborSearch.ray_search.
+
+    Args:
+        embeddings (np.ndarray): A two-dimensional array containing the embeddings.
+        directions (np.ndarray): A two-dimensional array of the same shape containing the unit noise directions.
+        steps (np.ndarray): A two-dimensional array of shape (embeddings.shape[0], number of steps) containing the noise magnitudes.
+        vocabulary: The vocabulary, either as a two-dimensional array or as returned by prepare_vocabulary. Indexes
+            (e.g., utils.ann) are searched exhaustively along the rays.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): One of BACKENDS. Defaults to "cupy".
+
+    Returns:
+        np.ndarray: A two-dimensional array of shape (number of steps, embeddings.shape[0]) containing the vocabulary
+            index of the nearest neighbor of each noisy embedding.
+    """
+    if isinstance(vocabulary, ExactNeighborSearch):
+        return vocabulary.ray_search(embeddings, directions, steps)
+    if backend == "numpy":
+        searcher = prepare_vocabulary(vocabulary, distance_metric, backend)
+        return searcher.ray_search(embeddings, directions, steps)
+    if backend == "cupy":
+        return ray_nearest_neighbors(
+            embeddings, directions, steps, vocabulary, distance_metric
+        )
+    raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+
+
 def noisy_embeddings_to_ids_cp(
     embeddings: np.ndarray,
     vocabulary: np.ndarray,
@@ -162,39 +460,346 @@ def dx_post_processing(
     embeddings: np.ndarray,
     vocabulary: np.ndarray,
     dx_constant: float,
-    epsilon: int,
+    epsilon: int | np.ndarray,
     distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    tail_mass: float | None = None,
+    seed: np.random.SeedSequence | None = None,
 ) -> np.ndarray:
     """Applies the post-processing fix proposed in (Asghar et al., 2024).
 
     Args:
         embeddings (np.ndarray): A two-dimensional array containing the embeddings we want to process.
         vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary
-            to compute the fix against.
+            to compute the fix against, or the same vocabulary prepared with prepare_vocabulary.
         dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
-        epsilon (int): The epsilon value in the dx-privacy formula.
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, or a one-dimensional array
+            with the epsilon value of each embedding.
         distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): One of BACKENDS. Defaults to "cupy".
+        tail_mass (float | None, optional): If set, only sample among the K nearest elements of the vocabulary, where
+            K is the smallest rank such that the probability of sampling a farther element is at most tail_mass,
+            see truncation_rank. Defaults to None, which samples among the entire vocabulary.
+        seed (np.random.SeedSequence | None, optional): The seed of the random stream, see random_generator. With
+            the "cupy" backend, the uniform samples are then drawn on CPU. Defaults to None.
 
     Returns:
         np.ndarray: A one-dimensional numpy array containing the ids of the sampled replacements.
     """
+    if tail_mass is not None:
+        return dx_post_processing_truncated(
+            embeddings,
+            vocabulary,
+            dx_constant,
+            epsilon,
+            tail_mass,
+            distance_metric,
+            backend,
+            seed,
+        )
+
+    if backend == "numpy":
+        return dx_post_processing_np(
+            embeddings, vocabulary, dx_constant, epsilon, distance_metric, seed
+        )
+
     input_size = embeddings.shape[0]
     vocab_size = vocabulary.shape[0]
 
-    # Rank the elements of the vocabulary according to their distance with each of the embeddings
-    embeddings_neighbors_ranked = cp.array(
-        rank_neighbors(embeddings, vocabulary, distance_metric)
+    # Sample the rank of each replacement on GPU. The probability of each rank does not depend on
+    # the embedding, so we do not need the rank of every element of the vocabulary.
+    if seed is None:
+        uniforms = cp.random.random(input_size)
+    else:
+        uniforms = cp.asarray(random_generator(seed).random(input_size))
+    sampled_ranks = sample_ranks(cp, uniforms, dx_constant, epsilon, vocab_size)
+
+    # Look up the element of the vocabulary having the sampled rank for each embedding.
+    # Everything stays on GPU, except for the resulting ids.
+    return nth_nearest_neighbors(embeddings, vocabulary, sampled_ranks, distance_metric)
+
+
+def dx_post_processing_np(
+    embeddings: np.ndarray,
+    vocabulary: np.ndarray | ExactNeighborSearch,
+    dx_constant: float,
+    epsilon: int | np.ndarray,
+    distance_metric: str = "euclidean",
+    seed: np.random.SeedSequence | None = None,
+) -> np.ndarray:
+    """Same as dx_post_processing, computed on CPU.
+
+    Args:
+        embeddings (np.ndarray): A two-dimensional array containing the embeddings we want to process.
+        vocabulary (np.ndarray | ExactNeighborSearch): A two-dimensional array containing all the embeddings of the vocabulary
+            to compute the fix against, or the same vocabulary already prepared with prepare_vocabulary.
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, see dx_post_processing.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        seed (np.random.SeedSequence | None, optional): The seed of the random stream, see random_generator. Defaults to None.
+
+    Returns:
+        np.ndarray: A one-dimensional numpy array containing the ids of the sampled replacements.
+    """
+    searcher = prepare_vocabulary(vocabulary, distance_metric, "numpy")
+    input_size = embeddings.shape[0]
+    rng = random_generator(seed)
+
+    # Sample the rank of each replacement, then look up the corresponding element of the vocabulary.
+    sampled_ranks = sample_ranks(
+        np, rng.random(input_size), dx_constant, epsilon, searcher.vocab_size
+    )
+    return searcher.nth_nearest_neighbors(embeddings, sampled_ranks)
+
+
+def sample_ranks(
+    xp,
+    uniforms,
+    dx_constant: float,
+    epsilon: int | np.ndarray,
+    vocab_size: int | np.ndarray,
+):
+    """Transforms uniform samples into ranks following the distribution of the post-processing fix of
+    (Asghar et al., 2024), where the probability of the rank r in [0, vocab_size) is proportional to
+    q^r with q = exp(-dx_constant * epsilon). Uses the inverse of its cumulative distribution function
+    (1 - q^(r+1)) / (1 - q^V), which gives all the ranks at once without computing any probability.
+    Sampling a rank then looking up the element of the vocabulary having this rank is the same as
+    sampling among the vocabulary with probabilities exp(-dx_constant * epsilon * rank).
+
+    Args:
+        xp: The array module of uniforms, i.e., numpy or cupy.
+        uniforms: A one-dimensional array of samples from the uniform distribution over [0, 1).
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, or an array of the same shape as
+            uniforms with the epsilon value of each sample.
+        vocab_size (int | np.ndarray): The number of ranks, i.e., the number of elements in the vocabulary, or an
+            array of the same shape as uniforms with the number of ranks of each sample.
+
+    Returns:
+        A one-dimensional array of int64 ranks, of the same shape and module as uniforms.
+    """
+    if np.ndim(epsilon) == 0 and np.ndim(vocab_size) == 0:
+        rate = dx_constant * epsilon
+        if rate <= 0:
+            # Uniform distribution over the ranks
+            ranks = xp.floor(uniforms * vocab_size)
+        else:
+            # 1 - q^V, computed with expm1 to remain accurate for small rates
+            normalization = -math.expm1(-rate * vocab_size)
+            ranks = xp.floor(-xp.log1p(-uniforms * normalization) / rate)
+    else:
+        # Same as above for each sample, with its own rate and number of ranks
+        rate = xp.asarray(dx_constant * np.asarray(epsilon, dtype=np.float64))
+        vocab_size = xp.asarray(vocab_size)
+        normalization = -xp.expm1(-rate * vocab_size)
+        positive = rate > 0
+        ranks = xp.where(
+            positive,
+            xp.floor(
+                -xp.log1p(-uniforms * normalization) / xp.where(positive, rate, 1.0)
+            ),
+            xp.floor(uniforms * vocab_size),
+        )
+    # Guard against rounding errors for uniforms close to 1
+    return xp.minimum(ranks, vocab_size - 1).astype(xp.int64)
+
+
+def truncation_rank(
+    dx_constant: float,
+    epsilon: int,
+    vocab_size: int,
+    tail_mass: float,
+) -> tuple[int, float]:
+    """In the post-processing fix of (Asghar et al., 2024), the probability of sampling the element of rank r
+    is proportional to q^r with q = exp(-dx_constant * epsilon). The probability of sampling an element of rank
+    K or higher is thus (q^K - q^V) / (1 - q^V), V being the size of the vocabulary. This function returns the
+    smallest K such that this probability is at most tail_mass.
+
+    Args:
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilon (int): The epsilon value in the dx-privacy formula.
+        vocab_size (int): The number of elements in the vocabulary.
+        tail_mass (float): The maximal probability of sampling an element of rank K or higher.
+
+    Returns:
+        tuple[int, float]: K, and the exact probability of sampling an element of rank K or higher.
+    """
+    rate = dx_constant * epsilon
+    if rate <= 0:
+        # Uniform distribution over the vocabulary, nothing can be dropped
+        return vocab_size, 0.0
+
+    # q^V and 1 - q^V, the latter computed with expm1 to remain accurate for small rates
+    q_vocab_size = math.exp(-rate * vocab_size)
+    normalization = -math.expm1(-rate * vocab_size)
+
+    def dropped_mass(k: int) -> float:
+        return max(0.0, (math.exp(-rate * k) - q_vocab_size) / normalization)
+
+    k = math.ceil(-math.log(tail_mass * normalization + q_vocab_size) / rate)
+    k = min(max(k, 1), vocab_size)
+    # Guard against rounding errors in the closed form
+    while k < vocab_size and dropped_mass(k) > tail_mass:
+        k += 1
+
+    return k, dropped_mass(k)
+
+
+def truncation_ranks(
+    dx_constant: float,
+    epsilon: int | np.ndarray,
+    vocab_size: int,
+    tail_mass: float,
+) -> int | np.ndarray:
+    """K as given by truncation_rank, for a single epsilon value or for each value of an array of epsilon values
+    (computed once per distinct value).
+
+    Args:
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, or an array of epsilon values.
+        vocab_size (int): The number of elements in the vocabulary.
+        tail_mass (float): The maximal probability of sampling an element of rank K or higher.
+
+    Returns:
+        int | np.ndarray: K, or an int64 array of the same shape as epsilon containing K for each epsilon value.
+    """
+    if np.ndim(epsilon) == 0:
+        return truncation_rank(dx_constant, epsilon, vocab_size, tail_mass)[0]
+    unique_epsilons, inverse = np.unique(epsilon, return_inverse=True)
+    ranks = np.array(
+        [
+            truncation_rank(dx_constant, e, vocab_size, tail_mass)[0]
+            for e in unique_epsilons.tolist()
+        ],
+        dtype=np.int64,
+    )
+    return ranks[inverse].reshape(np.shape(epsilon))
+
+
+def dx_post_processing_truncated(
+    embeddings: np.ndarray,
+    vocabulary,
+    dx_constant: float,
+    epsilon: int | np.ndarray,
+    tail_mass: float,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    seed: np.random.SeedSequence | None = None,
+) -> np.ndarray:
+    """Applies the post-processing fix proposed in (Asghar et al., 2024), only sampling among the K nearest
+    elements of the vocabulary, K being given by truncation_rank. The probabilities of the ranks do not depend on
+    the embedding, so the rank of each replacement is sampled first, before looking up the element with this rank
+    among the K nearest neighbors. Only the K nearest neighbors are sorted and no probability is computed for the
+    other elements of the vocabulary.
+
+    Args:
+        embeddings (np.ndarray): A two-dimensional array containing the embeddings we want to process.
+        vocabulary: A two-dimensional array containing all the embeddings of the vocabulary
+            to compute the fix against, or the same vocabulary prepared with prepare_vocabulary.
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, see dx_post_processing. For an
+            array, each embedding samples among its own K nearest neighbors.
+        tail_mass (float): The maximal probability of sampling an element of rank K or higher, see truncation_rank.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): One of BACKENDS. Defaults to "cupy".
+        seed (np.random.SeedSequence | None, optional): The seed of the random stream, see random_generator. Defaults to None.
+
+    Returns:
+        np.ndarray: A one-dimensional numpy array containing the ids of the sampled replacements.
+    """
+    input_size = embeddings.shape[0]
+    if backend == "numpy":
+        searcher = prepare_vocabulary(vocabulary, distance_metric, backend)
+        vocab_size = searcher.vocab_size
+    else:
+        vocab_size = vocabulary.shape[0]
+    number_of_ranks = truncation_ranks(dx_constant, epsilon, vocab_size, tail_mass)
+    # The neighbors of the smallest epsilon value are enough for all embeddings
+    k = int(np.max(number_of_ranks))
+
+    # The ids of the K nearest neighbors of each embedding, sorted by distance.
+    if backend == "numpy":
+        embeddings_nearest_neighbors = searcher.nearest_neighbors_sorted(embeddings, k)
+    else:
+        embeddings_nearest_neighbors = nearest_neighbors_sorted(
+            embeddings, vocabulary, k, distance_metric
+        )
+
+    # Sample the ranks of all replacements at once among the K first ranks, then look up the corresponding ids
+    rng = random_generator(seed)
+    sampled_ranks = sample_ranks(
+        np, rng.random(input_size), dx_constant, epsilon, number_of_ranks
     )
 
-    # Compute probabilities
-    probabilities = cp.exp(-dx_constant * epsilon * embeddings_neighbors_ranked)
+    return embeddings_nearest_neighbors[np.arange(input_size), sampled_ranks]
+
+
+def dx_post_processing_from_ids(
+    ids: np.ndarray,
+    neighbor_table: np.ndarray,
+    vocabulary,
+    dx_constant: float,
+    epsilon: int | np.ndarray,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    tail_mass: float | None = None,
+    seed: np.random.SeedSequence | None = None,
+) -> np.ndarray:
+    """Applies the post-processing fix proposed in (Asghar et al., 2024) on elements of the vocabulary given by their ids.
+    Same as dx_post_processing on vocabulary[ids], but the neighbors of each element are looked up in a table built
+    with utils.neighbor_table instead of being computed. Only the embeddings whose sampled rank is beyond the
+    neighbors kept in the table are computed, with dx_post_processing's look up.
+
+    Args:
+        ids (np.ndarray): A one-dimensional array containing the ids of the elements of the vocabulary we want to process.
+        neighbor_table (np.ndarray): A two-dimensional array where neighbor_table[i][r] contains the id of the element
+            with rank r in the list of neighbors of the i-th element of the vocabulary.
+        vocabulary: A two-dimensional array containing all the embeddings of the vocabulary
+            to compute the fix against, or the same vocabulary prepared with prepare_vocabulary.
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, or a one-dimensional array
+            with the epsilon value of each id.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): One of BACKENDS, only used for ranks beyond the table. Defaults to "cupy".
+        tail_mass (float | None, optional): If set, only sample among the K nearest elements of the vocabulary, see
+            truncation_rank. Defaults to None, which samples among the entire vocabulary.
+        seed (np.random.SeedSequence | None, optional): The seed of the random stream, see random_generator. Defaults to None.
 
-    # Normalize probabilities along the last axis
-    probabilities /= probabilities.sum(axis=-1, keepdims=True)
+    Returns:
+        np.ndarray: A one-dimensional numpy array containing the ids of the sampled replacements.
+    """
+    input_size = ids.shape[0]
+    vocab_size = vocabulary.shape[0]
+    number_of_ranks = vocab_size
+    if tail_mass is not None:
+        number_of_ranks = truncation_ranks(dx_constant, epsilon, vocab_size, tail_mass)
+
+    rng = random_generator(seed)
+    sampled_ranks = sample_ranks(
+        np, rng.random(input_size), dx_constant, epsilon, number_of_ranks
+    )
 
-    # Sample one element for each embedding and return their ids
     noisy_ids = np.empty((input_size), dtype=best_uint_type(vocab_size))
-    for i in range(input_size):
-        noisy_ids[i] = cp.random.choice(vocab_size, size=1, p=probabilities[i]).item()
+    in_table = sampled_ranks < neighbor_table.shape[1]
+    noisy_ids[in_table] = neighbor_table[ids[in_table], sampled_ranks[in_table]]
+
+    # The few ranks beyond the table are looked up by computing the distances
+    beyond_table = np.flatnonzero(~in_table)
+    if beyond_table.shape[0] > 0:
+        if backend == "numpy":
+            searcher = prepare_vocabulary(vocabulary, distance_metric, backend)
+            # For the cosine distance, searcher.vocabulary is normalized, which does not change the ranking.
+            noisy_ids[beyond_table] = searcher.nth_nearest_neighbors(
+                searcher.vocabulary[ids[beyond_table]], sampled_ranks[beyond_table]
+            )
+        else:
+            # vocabulary can either be on RAM or already copied to GPU
+            xp = cp.get_array_module(vocabulary)
+            noisy_ids[beyond_table] = nth_nearest_neighbors(
+                vocabulary[xp.asarray(ids[beyond_table])],
+                vocabulary,
+                sampled_ranks[beyond_table],
+                distance_metric,
+            )
 
     return noisy_ids
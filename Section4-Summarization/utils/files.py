@@ -0,0 +1,28 @@
+from datetime import datetime
+import pickle
+from os.path import join
+from typing import Any
+
+# Only the standard library is imported here, so that the analysis scripts which only load and save results
+# (e.g., Regression.py, Similarities.py) start quickly, even on machines without CuPy or PyTorch.
+
+
+def print_timed(*args, **kwargs) -> None:
+    print(datetime.now().strftime("%Hh%Mm%Ss"), *args, **kwargs)
+
+
+def save_pickle(
+    folderpath: str, filename: str, toBeSaved, datetime_prefix: bool = False
+) -> None:
+    if datetime_prefix:
+        filename = f"{datetime.now().strftime('%Y-%m-%d_%H.%M.%S')}_{filename}"
+    filepath = join(folderpath, filename)
+
+    with open(filepath, "wb") as f:
+        pickle.dump(toBeSaved, f)
+
+
+def load_pickle(folderpath: str, filename: str) -> Any:
+    with open(join(folderpath, filename), "rb") as f:
+        result = pickle.load(f)
+    return result
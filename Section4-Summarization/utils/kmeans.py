@@ -0,0 +1,38 @@
+import numpy as np
+
+
+def kmeans(
+    points: np.ndarray, n_clusters: int, iterations: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Lloyd's algorithm initialized with random points. Returns the centroids as a float32 array of shape
+    (n_clusters, points.shape[1]). A centroid whose cluster becomes empty keeps its previous position.
+    """
+    centroids = points[rng.choice(points.shape[0], n_clusters, replace=False)]
+    for _ in range(iterations):
+        assignment = nearest_centroids(points, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        # The sums of the points of each cluster, as the product of their one-hot assignments with the points
+        # (one GEMM per block of points, bounding the memory of the one-hot matrix)
+        sums = np.zeros((n_clusters, points.shape[1]), dtype=np.float32)
+        for i in range(0, points.shape[0], 8192):
+            block_assignment = assignment[i : i + 8192]
+            one_hot = np.zeros(
+                (block_assignment.shape[0], n_clusters), dtype=np.float32
+            )
+            one_hot[np.arange(block_assignment.shape[0]), block_assignment] = 1
+            sums += one_hot.T @ points[i : i + 8192]
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+    return centroids
+
+
+def centroids_scores(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """The squared euclidean distances between points and centroids, up to a constant on each row."""
+    scores = np.matmul(-2 * points, centroids.T)
+    scores += np.einsum("ij,ij->i", centroids, centroids)
+    return scores
+
+
+def nearest_centroids(points: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """The index of the nearest centroid of each point (euclidean distance)."""
+    return centroids_scores(points, centroids).argmin(axis=-1)
@@ -0,0 +1,151 @@
+import math
+import os
+
+from utils.backends import cp
+
+# The kernels whose working set is modeled by MemoryPlanner:
+# - "nearest": distances to the vocabulary followed by an argmin (nearest neighbor search)
+# - "rank": distances followed by an argsort and the inverse permutation (rank of every element)
+# - "nth": distances followed by the look up of one rank per embedding (post-processing fix)
+# - "top_k": distances followed by a partition and the sort of the k nearest elements
+KERNELS = ("nearest", "rank", "nth", "top_k")
+
+
+def available_memory(backend: str) -> int:
+    """The number of bytes currently available on the device used by backend: VRAM for "cupy"
+    (unallocated, plus allocated to CuPy's memory pool but unused), RAM for "numpy"."""
+    if backend == "cupy":
+        mempool = cp.get_default_memory_pool()
+        return (
+            cp.cuda.runtime.memGetInfo()[0]
+            + mempool.total_bytes()
+            - mempool.used_bytes()
+        )
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+class MemoryPlanner:
+    """Computes how many embeddings the kernels of a backend can process at the same time, given an explicit
+    memory budget. The budget is fixed when the planner is created, and the working set of each kernel is
+    modeled from its actual allocations, so chunk sizes are predictable and do not depend on the state of the
+    memory pool at the time of the call. Chunk sizes are cached per kernel and shapes.
+
+    Example:
+        planner = MemoryPlanner("numpy", budget=8 * 2**30)  # 8 GiB of RAM
+        chunk_size = planner.chunk_size("nearest", vocabulary.shape, embeddings.shape[1])
+    """
+
+    def __init__(self, backend: str = "cupy", budget: int | float = 0.9) -> None:
+        """
+        Args:
+            backend (str, optional): "cupy" to plan VRAM, "numpy" to plan RAM. Defaults to "cupy".
+            budget (int | float, optional): Either a number of bytes (int), or a fraction of the memory
+                available on the device when the planner is created (float). Defaults to 0.9.
+        """
+        self.backend = backend
+        if isinstance(budget, float):
+            budget = math.floor(available_memory(backend) * budget)
+        self.budget = budget
+        self._chunk_sizes: dict[tuple, int] = {}
+
+    def working_set(
+        self,
+        kernel: str,
+        vocab_shape: tuple[int, int],
+        query_dim: int,
+        k: int = 0,
+        n_threads: int | None = None,
+    ) -> tuple[int, int]:
+        """Models the memory needed by a kernel.
+
+        Args:
+            kernel (str): One of KERNELS.
+            vocab_shape (tuple[int, int]): The shape of the vocabulary.
+            query_dim (int): The number of dimensions of the embeddings.
+            k (int, optional): The number of nearest neighbors kept by the "top_k" kernel. Defaults to 0.
+            n_threads (int | None, optional): The number of threads processing rows at the same time with the "numpy"
+                backend, e.g., ExactNeighborSearch.n_threads. Defaults to None, which assumes all available cores.
+
+        Returns:
+            tuple[int, int]: The number of bytes allocated once for all chunks, and the number of bytes
+                allocated for each embedding of a chunk.
+        """
+        if kernel not in KERNELS:
+            raise ValueError(f"Unknown kernel {kernel}, expected one of {KERNELS}")
+        vocab_size, hidden_size = vocab_shape
+        ids_size = 2 if vocab_size < 2**16 else 4  # See tools.best_uint_type
+
+        if self.backend == "cupy":
+            # The vocabulary is copied to GPU in float32.
+            fixed = vocab_size * hidden_size * 4
+            # The embedding copied to GPU in float32, and its row of distances: cupyx.scipy.spatial.distance.cdist
+            # allocates its output with np.float64 precision.
+            per_row = query_dim * 4 + vocab_size * 8
+            # Sorting (argsort, argpartition) returns int64 indices and its radix sort needs
+            # double buffers for both the keys (float64) and the indices (int64).
+            sort = vocab_size * 8 + 2 * (vocab_size * 8 + vocab_size * 8)
+            if kernel == "nearest":
+                per_row += 8  # int64 argmin
+            elif kernel == "rank":
+                per_row += sort + vocab_size * ids_size  # and the scattered ranks
+            elif kernel == "nth":
+                per_row += sort + 8
+            else:
+                # and the k candidates, their distances and order
+                per_row += sort + k * 8 * 3
+            return fixed, per_row
+
+        # numpy: the vocabulary already is in RAM, only its squared norms are allocated.
+        fixed = vocab_size * 4
+        # The embedding converted to float32 and multiplied by -2, and its row of float32 scores.
+        per_row = query_dim * 4 * 2 + vocab_size * 4
+        if kernel == "nearest":
+            per_row += 8  # int64 argmin
+        elif kernel == "rank":
+            # int64 argsort (sorted in place), and the ranks of the result
+            per_row += vocab_size * 8 + vocab_size * ids_size
+        elif kernel == "nth":
+            # Rows are partitioned one at a time by each thread
+            fixed += (n_threads or os.cpu_count()) * vocab_size * 8
+            per_row += 8
+        else:
+            # int64 argpartition of the whole row, then the k candidates, their scores and order
+            per_row += vocab_size * 8 + k * (8 + 4 + 8 + ids_size)
+        return fixed, per_row
+
+    def chunk_size(
+        self,
+        kernel: str,
+        vocab_shape: tuple[int, int],
+        query_dim: int,
+        k: int = 0,
+        n_threads: int | None = None,
+    ) -> int:
+        """The number of embeddings a kernel can process at the same time within the budget, at least 1.
+        See working_set for the arguments."""
+        key = (kernel, tuple(vocab_shape), query_dim, k, n_threads)
+        if key not in self._chunk_sizes:
+            fixed, per_row = self.working_set(
+                kernel, vocab_shape, query_dim, k, n_threads
+            )
+            self._chunk_sizes[key] = max(1, (self.budget - fixed) // per_row)
+        return self._chunk_sizes[key]
+
+
+# Default planners, created on first use, see get_planner and set_memory_budget
+_planners: dict[str, MemoryPlanner] = {}
+DEFAULT_BUDGETS = {"cupy": 0.9, "numpy": 0.5}
+
+
+def set_memory_budget(backend: str, budget: int | float) -> MemoryPlanner:
+    """Replaces the default planner of backend by a planner with the given budget, see MemoryPlanner."""
+    _planners[backend] = MemoryPlanner(backend, budget)
+    return _planners[backend]
+
+
+def get_planner(backend: str) -> MemoryPlanner:
+    """The default planner of backend. Unless set_memory_budget was called before, its budget is
+    90% of the available VRAM for "cupy" and 50% of the available RAM for "numpy"."""
+    if backend not in _planners:
+        set_memory_budget(backend, DEFAULT_BUDGETS[backend])
+    return _planners[backend]
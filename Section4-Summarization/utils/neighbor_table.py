@@ -0,0 +1,204 @@
+import numpy as np
+import os
+from os.path import join, exists
+from utils.dx import prepare_vocabulary
+from utils.tools import best_uint_type, nearest_neighbors_sorted, print_timed
+
+
+def neighbor_table_filepath(
+    folderpath: str, model_name: str, revision: str, distance_metric: str
+) -> str:
+    """Path of the neighbor table of a model, keyed by its name, its revision and the distance metric."""
+    model_name = model_name.replace("/", "--")
+    return join(folderpath, f"{model_name}_{revision}_{distance_metric}_neighbors.npy")
+
+
+def build_neighbor_table(
+    vocabulary: np.ndarray,
+    k: int,
+    filepath: str,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    batch_size: int = 4096,
+) -> np.ndarray:
+    """Computes, for each element of the vocabulary, the ids of its k nearest elements in the vocabulary
+    sorted by distance, and saves them as a .npy file which can be memory-mapped.
+    table[i][r] thus contains the id of the element with rank r in the list of neighbors of the i-th element.
+
+    Args:
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        k (int): The number of neighbors to keep for each element of the vocabulary.
+        filepath (str): Where to save the table. The file only appears once the table is complete.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+        batch_size (int, optional): The number of elements of the vocabulary processed between two writes to disk. Defaults to 4096.
+
+    Returns:
+        np.ndarray: The table of shape (vocabulary.shape[0], k), memory-mapped in read-only mode.
+    """
+    vocab_size = vocabulary.shape[0]
+    k = min(k, vocab_size)
+    if backend == "numpy":
+        searcher = prepare_vocabulary(vocabulary, distance_metric, backend)
+
+    # Write in a temporary file so that an interrupted build is never mistaken for a complete table.
+    tmp_filepath = f"{filepath}.tmp"
+    table = np.lib.format.open_memmap(
+        tmp_filepath, mode="w+", dtype=best_uint_type(vocab_size), shape=(vocab_size, k)
+    )
+    for i in range(0, vocab_size, batch_size):
+        j = min(i + batch_size, vocab_size)
+        print_timed(f"Neighbor table: {i}/{vocab_size}")
+        if backend == "numpy":
+            table[i:j] = searcher.nearest_neighbors_sorted(vocabulary[i:j], k)
+        else:
+            table[i:j] = nearest_neighbors_sorted(
+                vocabulary[i:j], vocabulary, k, distance_metric
+            )
+    table.flush()
+    del table
+    os.replace(tmp_filepath, filepath)
+
+    return np.load(filepath, mmap_mode="r")
+
+
+def get_neighbor_table(
+    vocabulary: np.ndarray,
+    k: int,
+    folderpath: str,
+    model_name: str,
+    revision: str,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+) -> np.ndarray:
+    """Loads the neighbor table of a model from folderpath, memory-mapped. The table is built first
+    with build_neighbor_table if it does not exist yet, or if it has less than k neighbors per element.
+
+    Args:
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        k (int): The number of neighbors needed for each element of the vocabulary.
+        folderpath (str): The folder where tables are stored.
+        model_name (str): The name of the model, e.g., "facebook/bart-large-cnn".
+        revision (str): The revision of the model.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+
+    Returns:
+        np.ndarray: The table of shape (vocabulary.shape[0], k), memory-mapped in read-only mode.
+    """
+    k = min(k, vocabulary.shape[0])
+    filepath = neighbor_table_filepath(
+        folderpath, model_name, revision, distance_metric
+    )
+    if exists(filepath):
+        table = np.load(filepath, mmap_mode="r")
+        if table.shape[0] == vocabulary.shape[0] and table.shape[1] >= k:
+            return table[:, :k]
+        del table
+
+    if not exists(folderpath):
+        os.makedirs(folderpath)
+    print_timed(f"Building the neighbor table {filepath}")
+    return build_neighbor_table(vocabulary, k, filepath, distance_metric, backend)
+
+
+def safe_radii_filepath(folderpath: str, model_name: str, revision: str) -> str:
+    """Path of the safe radii of a model, keyed by its name and its revision."""
+    model_name = model_name.replace("/", "--")
+    return join(folderpath, f"{model_name}_{revision}_safe_radii.npy")
+
+
+def build_safe_radii(
+    vocabulary: np.ndarray,
+    filepath: str,
+    backend: str = "cupy",
+    tolerance: float = 1e-4,
+    batch_size: int = 4096,
+) -> np.ndarray:
+    """Computes the safe radius of each element of the vocabulary for the euclidean distance, and saves them as a .npy file.
+
+    If the distance between an element e and its nearest other element is 2r, any point at distance n < r from e is
+    strictly closer to e than to any other element, since its distance to another element is at least 2r - n > n.
+    The nearest neighbor of e + noise is thus e whenever ||noise|| < r. The saved radius is slightly smaller than r,
+    so that this also holds for the distances computed in float32: the gap between the squared distances to e and to
+    its nearest other element is at least 4r(r - n), which must exceed the rounding errors, bounded by
+    tolerance * (2 * max_norm + n)² where max_norm is the largest norm of the vocabulary.
+
+    Args:
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        filepath (str): Where to save the radii.
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+        tolerance (float, optional): Relative margin accounting for float32 rounding, about d * 2^-24 for a few
+            thousand dimensions d. Defaults to 1e-4.
+        batch_size (int, optional): The number of elements of the vocabulary processed at a time. Defaults to 4096.
+
+    Returns:
+        np.ndarray: The float32 safe radii, of shape (vocabulary.shape[0]).
+    """
+    vocab_size = vocabulary.shape[0]
+    if backend == "numpy":
+        searcher = prepare_vocabulary(vocabulary, "euclidean", backend)
+
+    half_distances = np.empty(vocab_size, dtype=np.float64)
+    for i in range(0, vocab_size, batch_size):
+        j = min(i + batch_size, vocab_size)
+        print_timed(f"Safe radii: {i}/{vocab_size}")
+        # The nearest other element is one of the two nearest elements
+        if backend == "numpy":
+            neighbors = searcher.nearest_neighbors_sorted(vocabulary[i:j], 2)
+        else:
+            neighbors = nearest_neighbors_sorted(
+                vocabulary[i:j], vocabulary, 2, "euclidean"
+            )
+        distances = np.linalg.norm(
+            vocabulary[neighbors].astype(np.float64)
+            - vocabulary[i:j, np.newaxis].astype(np.float64),
+            axis=-1,
+        )
+        distances[neighbors == np.arange(i, j)[:, np.newaxis]] = np.inf
+        half_distances[i:j] = distances.min(axis=-1) / 2
+
+    max_norm = np.linalg.norm(vocabulary, axis=-1).max()
+    margins = np.divide(
+        tolerance * (2 * max_norm + half_distances) ** 2,
+        4 * half_distances,
+        out=np.full(vocab_size, np.inf),
+        where=half_distances > 0,
+    )
+    radii = np.maximum(half_distances - margins, 0)
+    # Round down when casting to float32
+    radii = np.nextafter(radii.astype(np.float32), np.float32(0))
+    radii = np.maximum(radii, 0)
+    np.save(filepath, radii)
+    return radii
+
+
+def get_safe_radii(
+    vocabulary: np.ndarray,
+    folderpath: str,
+    model_name: str,
+    revision: str,
+    backend: str = "cupy",
+) -> np.ndarray:
+    """Loads the safe radii of a model from folderpath, see build_safe_radii. They are computed first if they do not exist yet.
+
+    Args:
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        folderpath (str): The folder where safe radii are stored.
+        model_name (str): The name of the model, e.g., "facebook/bart-large-cnn".
+        revision (str): The revision of the model.
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+
+    Returns:
+        np.ndarray: The float32 safe radii, of shape (vocabulary.shape[0]).
+    """
+    filepath = safe_radii_filepath(folderpath, model_name, revision)
+    if exists(filepath):
+        radii = np.load(filepath)
+        if radii.shape[0] == vocabulary.shape[0]:
+            return radii
+
+    if not exists(folderpath):
+        os.makedirs(folderpath)
+    print_timed(f"Computing the safe radii {filepath}")
+    return build_safe_radii(vocabulary, filepath, backend)
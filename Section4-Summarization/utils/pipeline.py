@@ -0,0 +1,99 @@
+import threading
+from queue import Queue, Empty, Full
+from typing import Any, Callable, Iterable
+
+# How often a blocked stage checks whether another stage failed, in seconds
+_POLL_INTERVAL = 0.1
+# Marks the end of the items in a queue
+_END = object()
+
+
+def run_pipeline(
+    items: Iterable,
+    stages: list[Callable[[Any], Any]],
+    queue_size: int = 1,
+) -> list:
+    """Runs items through a pipeline of stages, each stage in its own thread, so that the stages overlap: while
+    stage s processes item k, stage s - 1 processes item k + 1 and stage s + 1 item k - 1. E.g., the noise of a
+    batch is sampled while the previous batch is searched on GPU and the one before is written to disk.
+
+    Stages are connected by queues of at most queue_size items: a stage ahead of the next one blocks (back-pressure),
+    which bounds the memory held by items in flight. Each stage processes the items in order, so the results are the
+    same as applying the stages one after another. Iterating over items also runs in its own thread, e.g., for a
+    generator doing the computation. Numpy, CuPy and file operations release the GIL, so stages run concurrently.
+
+    Stages running at the same time each size their working memory on their own: two stages which chunk their
+    computation with the planner of a backend (see utils.memory) would together ask for twice its budget. Such stages
+    must share a lock (see text_lm.PackedSanitizationStages) or split the budget between them.
+
+    Args:
+        items (Iterable): The inputs of the first stage.
+        stages (list[Callable[[Any], Any]]): The stages, each one called with the output of the previous one.
+        queue_size (int, optional): The number of items waiting between two stages. Defaults to 1.
+
+    Raises:
+        Exception: The first exception raised by a stage or by items, after all threads stopped.
+
+    Returns:
+        list: The outputs of the last stage, in the order of items.
+    """
+    queues = [Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    failed = threading.Event()
+    errors: list[BaseException] = []
+    results = []
+
+    def put(queue: Queue, item) -> bool:
+        """Puts item in queue once it has room, False if another stage failed in the meantime."""
+        while not failed.is_set():
+            try:
+                queue.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except Full:
+                continue
+        return False
+
+    def get(queue: Queue):
+        """The next item of queue, _END if another stage failed in the meantime."""
+        while not failed.is_set():
+            try:
+                return queue.get(timeout=_POLL_INTERVAL)
+            except Empty:
+                continue
+        return _END
+
+    def run_source() -> None:
+        try:
+            for item in items:
+                if not put(queues[0], item):
+                    return
+            put(queues[0], _END)
+        except BaseException as error:
+            errors.append(error)
+            failed.set()
+
+    def run_stage(stage: Callable, input_queue: Queue, output_queue: Queue) -> None:
+        try:
+            while (item := get(input_queue)) is not _END:
+                if not put(output_queue, stage(item)):
+                    return
+            put(output_queue, _END)
+        except BaseException as error:
+            errors.append(error)
+            failed.set()
+
+    threads = [threading.Thread(target=run_source, daemon=True)] + [
+        threading.Thread(
+            target=run_stage, args=(stage, queues[s], queues[s + 1]), daemon=True
+        )
+        for s, stage in enumerate(stages)
+    ]
+    for thread in threads:
+        thread.start()
+    # The results are drained from the last queue in this thread
+    while (result := get(queues[-1])) is not _END:
+        results.append(result)
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return results
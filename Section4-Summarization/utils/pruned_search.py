@@ -0,0 +1,190 @@
+import numpy as np
+from utils.search import ExactNeighborSearch
+from utils.kmeans import kmeans, centroids_scores, nearest_centroids
+
+
+class PrunedNeighborSearch(ExactNeighborSearch):
+    """Exact nearest neighbor search of embeddings against a vocabulary partitioned with k-means, on CPU.
+    It returns the same ids as ExactNeighborSearch, but only scans the parts of the vocabulary which can
+    hold the nearest neighbor of each embedding.
+
+    Each cluster stores its centroid μ, its radius R (the largest distance between μ and one of its
+    elements) and its elements sorted by their distance to μ. For an embedding x whose best candidate so
+    far is at distance b, the triangle inequality gives ||x - v|| >= ||x - μ|| - ||v - μ|| and
+    ||x - v|| >= ||v - μ|| - ||x - μ|| for any element v of the cluster. Therefore, a cluster with
+    ||x - μ|| - R > b is skipped, and in the other clusters only the elements with ||v - μ|| between
+    ||x - μ|| - b and ||x - μ|| + b are scanned, which is a contiguous range of the sorted elements.
+
+    The nearest cluster of each embedding is scanned first to get b. As noisy embeddings land close to
+    their original token when epsilon is large, b is small and most of the vocabulary is pruned, while
+    for small epsilon the bounds are loose and most of the vocabulary is scanned. The fraction of the
+    vocabulary scanned for each embedding of the last search is kept in scanned_fractions.
+    For the cosine distance, the embeddings and the vocabulary are normalized so that the bounds apply.
+    """
+
+    def __init__(
+        self,
+        vocabulary: np.ndarray,
+        distance_metric: str = "euclidean",
+        n_threads: int | None = None,
+        n_clusters: int | None = None,
+        sample_size: int = 65536,
+        iterations: int = 10,
+        seed: int = 0,
+        tolerance: float = 1e-5,
+    ) -> None:
+        """
+        Args:
+            vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+            distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary.
+                One of "euclidean", "sqeuclidean" or "cosine". Defaults to "euclidean".
+            n_threads (int | None, optional): The number of threads used for row-wise operations. Defaults to None,
+                which uses all available cores.
+            n_clusters (int | None, optional): The number of clusters. Defaults to None, which uses the square root of the vocabulary size.
+            sample_size (int, optional): The number of elements of the vocabulary used to train k-means. Defaults to 65536.
+            iterations (int, optional): The number of k-means iterations. Defaults to 10.
+            seed (int, optional): The seed of the k-means initialization. Defaults to 0.
+            tolerance (float, optional): Relative margin added to the bounds to account for float32 rounding. Defaults to 1e-5.
+        """
+        super().__init__(vocabulary, distance_metric, n_threads)
+        self.tolerance = tolerance
+        rng = np.random.default_rng(seed)
+        if n_clusters is None:
+            n_clusters = int(np.sqrt(self.vocab_size))
+        sample_size = max(min(sample_size, self.vocab_size), n_clusters)
+        sample = self.vocabulary[
+            np.sort(rng.choice(self.vocab_size, sample_size, replace=False))
+        ]
+        centroids = kmeans(sample, n_clusters, iterations, rng)
+
+        assignment = np.concatenate(
+            [
+                nearest_centroids(self.vocabulary[i : i + 8192], centroids)
+                for i in range(0, self.vocab_size, 8192)
+            ]
+        )
+        # Remove the empty clusters, their elements are assigned to the same centroids anyway
+        counts = np.bincount(assignment, minlength=n_clusters)
+        self.centroids = centroids[counts > 0]
+        assignment = np.cumsum(counts > 0)[assignment] - 1
+        counts = counts[counts > 0]
+
+        # Distance between each element and its centroid
+        distances = np.linalg.norm(
+            self.vocabulary - self.centroids[assignment], axis=-1
+        )
+        # The elements of cluster c are order[offsets[c]:offsets[c + 1]], sorted by distance to the centroid
+        self.order = np.lexsort((distances, assignment)).astype(self.ids_dtype)
+        self.member_distances = distances[self.order]
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.radii = self.member_distances[self.offsets[1:] - 1]
+        self.max_norm = float(np.linalg.norm(self.vocabulary, axis=-1).max())
+
+        self.scanned_fractions = np.empty(0, dtype=np.float64)
+
+    def _scan(
+        self,
+        embeddings: np.ndarray,
+        rows: np.ndarray,
+        cluster: int,
+        start: int,
+        end: int,
+        best_scores: np.ndarray,
+        best_ids: np.ndarray,
+        scanned: np.ndarray,
+    ) -> None:
+        """Scores the elements start to end (in distance order) of a cluster for the embeddings rows,
+        and updates their best candidates."""
+        if start >= end:
+            return
+        ids = self.order[self.offsets[cluster] + start : self.offsets[cluster] + end]
+        scores = self.scores(embeddings[rows], ids=ids)
+        nearest = scores.argmin(axis=-1)
+        nearest_scores = scores[np.arange(rows.shape[0]), nearest]
+        better = nearest_scores < best_scores[rows]
+        best_scores[rows[better]] = nearest_scores[better]
+        best_ids[rows[better]] = ids[nearest[better]]
+        scanned[rows] += end - start
+
+    def search(self, embeddings: np.ndarray, chunk_size: int = 16384) -> np.ndarray:
+        """Performs an exact nearest neighbor search of the embeddings against the vocabulary, chunk-by-chunk.
+
+        Args:
+            embeddings (np.ndarray): A two-dimensional array containing the embeddings we want to process.
+            chunk_size (int, optional): The number of elements in embeddings to compute at a time. Defaults to 16384,
+                -1 is accepted for compatibility with ExactNeighborSearch.search and uses the default.
+
+        Returns:
+            np.ndarray: A one-dimensional array of shape (embeddings.shape[0]) containing the vocabulary index of the
+                nearest neighbor for each embedding.
+        """
+        input_size = embeddings.shape[0]
+        if chunk_size == -1:
+            chunk_size = 16384
+        chunk_size = min(chunk_size, max(1, input_size))
+        noisy_ids = np.empty((input_size), dtype=self.ids_dtype)
+        scanned = np.zeros((input_size), dtype=np.int64)
+
+        for i in range(0, input_size, chunk_size):
+            j = min(i + chunk_size, input_size)
+            noisy_ids[i:j] = self._search_chunk(
+                np.asarray(embeddings[i:j], dtype=np.float32), scanned[i:j]
+            )
+
+        self.scanned_fractions = scanned / self.vocab_size
+        return noisy_ids
+
+    def _search_chunk(self, embeddings: np.ndarray, scanned: np.ndarray) -> np.ndarray:
+        """See search, scanned is incremented by the number of elements scanned for each embedding."""
+        if self.distance_metric == "cosine":
+            norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+            embeddings = embeddings / np.maximum(norms, np.finfo(np.float32).tiny)
+        sq_norms = np.einsum("ij,ij->i", embeddings, embeddings)
+        margins = self.tolerance * (np.sqrt(sq_norms) + self.max_norm)
+
+        # Distances between the embeddings and the centroids
+        centroid_distances = np.sqrt(
+            np.maximum(
+                centroids_scores(embeddings, self.centroids) + sq_norms[:, np.newaxis],
+                0,
+            )
+        )
+        best_scores = np.full(embeddings.shape[0], np.inf, dtype=np.float32)
+        best_ids = np.empty(embeddings.shape[0], dtype=self.ids_dtype)
+
+        # Scan the nearest cluster of each embedding entirely
+        nearest_clusters = centroid_distances.argmin(axis=-1)
+        for cluster in np.unique(nearest_clusters):
+            rows = np.flatnonzero(nearest_clusters == cluster)
+            size = self.offsets[cluster + 1] - self.offsets[cluster]
+            self._scan(
+                embeddings, rows, cluster, 0, size, best_scores, best_ids, scanned
+            )
+
+        # Distance to the best candidate: for the cosine distance, the scores are -x·v and
+        # ||x - v||² = 2 + 2 * score for normalized x and v (and overestimates it for null elements).
+        if self.distance_metric == "cosine":
+            best_distances = np.sqrt(np.maximum(2 + 2 * best_scores, 0))
+        else:
+            best_distances = np.sqrt(np.maximum(best_scores + sq_norms, 0))
+        best_distances += margins
+
+        # Scan the rings of the other clusters which may hold a closer element
+        remaining = centroid_distances - self.radii <= best_distances[:, np.newaxis]
+        remaining[np.arange(embeddings.shape[0]), nearest_clusters] = False
+        for cluster in np.flatnonzero(remaining.any(axis=0)):
+            rows = np.flatnonzero(remaining[:, cluster])
+            members = self.member_distances[
+                self.offsets[cluster] : self.offsets[cluster + 1]
+            ]
+            distances = centroid_distances[rows, cluster]
+            start = np.searchsorted(members, (distances - best_distances[rows]).min())
+            end = np.searchsorted(
+                members, (distances + best_distances[rows]).max(), side="right"
+            )
+            self._scan(
+                embeddings, rows, cluster, start, end, best_scores, best_ids, scanned
+            )
+
+        return best_ids
@@ -0,0 +1,301 @@
+import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
+from utils.tools import best_uint_type
+from utils.memory import get_planner
+
+SUPPORTED_METRICS = ("euclidean", "sqeuclidean", "cosine")
+
+
+class ExactNeighborSearch:
+    """Exact nearest neighbor search of embeddings against a vocabulary, on CPU.
+
+    Distances are never materialized as such. For the (squared) euclidean distance,
+    ||x - v||² = ||x||² - 2x·v + ||v||² and ||x||² is constant along a row of the
+    distance matrix, so it does not change the argmin nor the ranking of the vocabulary.
+    The remaining terms are computed with one BLAS GEMM per chunk and the vocabulary
+    squared norms, which are computed once here. For the cosine distance, the vocabulary
+    is normalized once and the closest element is the one with the highest dot product.
+    Everything is computed in float32. The GEMM is parallelized by BLAS, the remaining
+    row-wise operations (argmin, argsort) are spread over a pool of threads.
+    """
+
+    def __init__(
+        self,
+        vocabulary: np.ndarray,
+        distance_metric: str = "euclidean",
+        n_threads: int | None = None,
+    ) -> None:
+        """
+        Args:
+            vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+            distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary.
+                One of "euclidean", "sqeuclidean" or "cosine". Defaults to "euclidean".
+            n_threads (int | None, optional): The number of threads used for row-wise operations. Defaults to None,
+                which uses all available cores.
+        """
+        if distance_metric not in SUPPORTED_METRICS:
+            raise ValueError(
+                f"Unsupported distance metric {distance_metric}, expected one of {SUPPORTED_METRICS}"
+            )
+        self.distance_metric = distance_metric
+        self.n_threads = n_threads or os.cpu_count()
+
+        vocabulary = np.ascontiguousarray(vocabulary, dtype=np.float32)
+        if distance_metric == "cosine":
+            norms = np.linalg.norm(vocabulary, axis=-1, keepdims=True)
+            # Avoid dividing by zero for null vectors, they stay null.
+            self.vocabulary = vocabulary / np.maximum(norms, np.finfo(np.float32).tiny)
+            self.vocab_sq_norms = None
+        else:
+            self.vocabulary = vocabulary
+            self.vocab_sq_norms = np.einsum("ij,ij->i", vocabulary, vocabulary)
+
+        self.vocab_size, self.hidden_size = self.vocabulary.shape
+        self.ids_dtype = best_uint_type(self.vocab_size)
+
+    @property
+    def shape(self) -> tuple[int, int]:
+        """Shape of the vocabulary, so that this class can be used where the vocabulary array is expected."""
+        return self.vocabulary.shape
+
+    def best_chunk_size(self, kernel: str, k: int = 0) -> int:
+        """The number of embeddings to process at the same time with a kernel, see utils.memory.MemoryPlanner."""
+        return get_planner("numpy").chunk_size(
+            kernel, self.shape, self.hidden_size, k, self.n_threads
+        )
+
+    def scores(
+        self,
+        embeddings: np.ndarray,
+        out: np.ndarray | None = None,
+        ids: np.ndarray | None = None,
+    ) -> np.ndarray:
+        """Compute a two-dimensional float32 array of shape (embeddings.shape[0], vocab_size) sorted
+        like the distances between the embeddings and the vocabulary (lower is closer), up to a
+        constant on each row. If ids is given, only the scores of these elements of the vocabulary
+        are computed, e.g., to verify a list of candidates."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        vocabulary = self.vocabulary if ids is None else self.vocabulary[ids]
+        if self.distance_metric == "cosine":
+            # -x·v is sorted like 1 - x·v/(||x|| ||v||) as ||x|| is constant along a row.
+            return np.matmul(-embeddings, vocabulary.T, out=out)
+
+        # -2x·v + ||v||², the -2 factor is applied on the (smaller) embeddings.
+        out = np.matmul(-2 * embeddings, vocabulary.T, out=out)
+        out += self.vocab_sq_norms if ids is None else self.vocab_sq_norms[ids]
+        return out
+
+    def _map_rows(
+        self, executor: ThreadPoolExecutor, function, number_of_rows: int
+    ) -> None:
+        """Call function(start, end) on contiguous blocks of rows, one block per thread."""
+        block_size = -(-number_of_rows // self.n_threads)
+        list(
+            executor.map(
+                lambda start: function(start, min(start + block_size, number_of_rows)),
+                range(0, number_of_rows, block_size),
+            )
+        )
+
+    def search(self, embeddings: np.ndarray, chunk_size: int = -1) -> np.ndarray:
+        """Performs a nearest neighbor search of the embeddings against the vocabulary, chunk-by-chunk.
+
+        Args:
+            embeddings (np.ndarray): A two-dimensional array containing the embeddings we want to process.
+            chunk_size (int, optional): The number of elements in embeddings to compute at a time. Defaults to -1,
+                which will determine the best chunk size considering the RAM available.
+
+        Returns:
+            np.ndarray: A one-dimensional array of shape (embeddings.shape[0]) containing the vocabulary index of the
+                nearest neighbor for each embedding.
+        """
+        input_size = embeddings.shape[0]
+        if chunk_size == -1:
+            chunk_size = self.best_chunk_size("nearest")
+        chunk_size = min(chunk_size, max(1, input_size))
+
+        noisy_ids = np.empty((input_size), dtype=self.ids_dtype)
+        # Reuse the same buffer for the scores of all chunks
+        buffer = np.empty((chunk_size, self.vocab_size), dtype=np.float32)
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            for i in range(0, input_size, chunk_size):
+                j = min(i + chunk_size, input_size)
+                scores = self.scores(embeddings[i:j], out=buffer[: j - i])
+
+                def argmin_rows(start: int, end: int) -> None:
+                    noisy_ids[i + start : i + end] = scores[start:end].argmin(axis=-1)
+
+                self._map_rows(executor, argmin_rows, j - i)
+
+        return noisy_ids
+
+    def rank(self, embeddings: np.ndarray, chunk_size: int = -1) -> np.ndarray:
+        """For each embedding, ranks the elements in the vocabulary according to their distance
+        with the embedding. Returns a numpy array of shape (embeddings.shape[0], vocab_size)
+        where array[i][j] contains the rank of the j-th vocabulary element in the list of neighbors of
+        the i-th embedding."""
+        input_size = embeddings.shape[0]
+        if chunk_size == -1:
+            chunk_size = self.best_chunk_size("rank")
+        chunk_size = min(chunk_size, max(1, input_size))
+
+        words_neighbors_ranked = np.empty(
+            (input_size, self.vocab_size), dtype=self.ids_dtype
+        )
+        buffer = np.empty((chunk_size, self.vocab_size), dtype=np.float32)
+        ranks_values = np.arange(self.vocab_size, dtype=self.ids_dtype)
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            for i in range(0, input_size, chunk_size):
+                j = min(i + chunk_size, input_size)
+                scores = self.scores(embeddings[i:j], out=buffer[: j - i])
+
+                def rank_rows(start: int, end: int) -> None:
+                    # Scatter the ranks at the position of each vocabulary element, this inverts
+                    # the permutation returned by argsort in O(vocab_size) instead of sorting twice.
+                    np.put_along_axis(
+                        words_neighbors_ranked[i + start : i + end],
+                        scores[start:end].argsort(axis=-1),
+                        ranks_values,
+                        axis=-1,
+                    )
+
+                self._map_rows(executor, rank_rows, j - i)
+
+        return words_neighbors_ranked
+
+    def nearest_neighbors_sorted(
+        self, embeddings: np.ndarray, k: int, chunk_size: int = -1
+    ) -> np.ndarray:
+        """For each embedding, returns the ids of its k nearest elements in the vocabulary sorted
+        by distance, as a numpy array of shape (embeddings.shape[0], k). Only the k nearest are
+        sorted, after a partition of the scores in O(vocab_size)."""
+        input_size = embeddings.shape[0]
+        if chunk_size == -1:
+            chunk_size = self.best_chunk_size("top_k", k)
+        chunk_size = min(chunk_size, max(1, input_size))
+
+        words_nearest_neighbors = np.empty((input_size, k), dtype=self.ids_dtype)
+        buffer = np.empty((chunk_size, self.vocab_size), dtype=np.float32)
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            for i in range(0, input_size, chunk_size):
+                j = min(i + chunk_size, input_size)
+                scores = self.scores(embeddings[i:j], out=buffer[: j - i])
+
+                def sort_nearest_rows(start: int, end: int) -> None:
+                    rows_scores = scores[start:end]
+                    candidates = np.argpartition(rows_scores, k - 1, axis=-1)[:, :k]
+                    order = np.take_along_axis(
+                        rows_scores, candidates, axis=-1
+                    ).argsort(axis=-1)
+                    words_nearest_neighbors[i + start : i + end] = np.take_along_axis(
+                        candidates, order, axis=-1
+                    )
+
+                self._map_rows(executor, sort_nearest_rows, j - i)
+
+        return words_nearest_neighbors
+
+    def nth_nearest_neighbors(
+        self, embeddings: np.ndarray, ranks: np.ndarray, chunk_size: int = -1
+    ) -> np.ndarray:
+        """For each embedding, returns the id of the vocabulary element whose rank in the list
+        of neighbors of the i-th embedding is ranks[i]. Each look up is a partition of the
+        scores in O(vocab_size) instead of a full sort.
+
+        The rows are partitioned one at a time, each thread looping over its block of rows in
+        Python: the partition of a row of the BART vocabulary takes about 200 microseconds, against
+        about a microsecond for the loop. Partitioning the rows of the same rank together with
+        np.argpartition(scores[rows], rank, axis=-1) was measured slower, since the rows are
+        gathered into a copy first and the partition still runs row by row."""
+        input_size = embeddings.shape[0]
+        if chunk_size == -1:
+            chunk_size = self.best_chunk_size("nth")
+        chunk_size = min(chunk_size, max(1, input_size))
+
+        words_neighbors = np.empty((input_size), dtype=self.ids_dtype)
+        buffer = np.empty((chunk_size, self.vocab_size), dtype=np.float32)
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            for i in range(0, input_size, chunk_size):
+                j = min(i + chunk_size, input_size)
+                scores = self.scores(embeddings[i:j], out=buffer[: j - i])
+
+                def select_rows(start: int, end: int) -> None:
+                    # One O(vocab_size) partition per row, see the docstring for the cost
+                    for row in range(start, end):
+                        rank = ranks[i + row]
+                        words_neighbors[i + row] = np.argpartition(scores[row], rank)[
+                            rank
+                        ]
+
+                self._map_rows(executor, select_rows, j - i)
+
+        return words_neighbors
+
+    def ray_search(
+        self,
+        origins: np.ndarray,
+        directions: np.ndarray,
+        steps: np.ndarray,
+        chunk_size: int = -1,
+    ) -> np.ndarray:
+        """For each ray origins[i] + s * directions[i] with unit directions, returns the nearest neighbor in the
+        vocabulary of the points at distances s = steps[i, k] from the origin.
+
+        Along a ray, the scores of the vocabulary are linear in s: -2(o + s u)·v + ||v||² = (-2o·v + ||v||²) + s (-2u·v),
+        and -(o + s u)·v for the cosine distance. Both terms are computed once with two GEMMs, and the nearest neighbor
+        of each point is read from these lines in O(vocab_size), instead of one GEMM per point.
+
+        Args:
+            origins (np.ndarray): A two-dimensional array containing the origins of the rays.
+            directions (np.ndarray): A two-dimensional array of the same shape containing their unit directions.
+            steps (np.ndarray): A two-dimensional array of shape (origins.shape[0], number of steps).
+            chunk_size (int, optional): The number of rays to compute at a time. Defaults to -1, which will determine
+                the best chunk size considering the RAM available.
+
+        Returns:
+            np.ndarray: A two-dimensional array of shape (number of steps, origins.shape[0]) containing the
+                vocabulary index of the nearest neighbor of each point.
+        """
+        input_size, number_of_steps = steps.shape
+        if chunk_size == -1:
+            # Three rows of scores per ray instead of one
+            chunk_size = max(1, self.best_chunk_size("nearest") // 3)
+        chunk_size = min(chunk_size, max(1, input_size))
+
+        noisy_ids = np.empty((number_of_steps, input_size), dtype=self.ids_dtype)
+        offsets = np.empty((chunk_size, self.vocab_size), dtype=np.float32)
+        slopes = np.empty((chunk_size, self.vocab_size), dtype=np.float32)
+        buffer = np.empty((chunk_size, self.vocab_size), dtype=np.float32)
+        factor = -1 if self.distance_metric == "cosine" else -2
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            for i in range(0, input_size, chunk_size):
+                j = min(i + chunk_size, input_size)
+                self.scores(origins[i:j], out=offsets[: j - i])
+                np.matmul(
+                    factor * np.asarray(directions[i:j], dtype=np.float32),
+                    self.vocabulary.T,
+                    out=slopes[: j - i],
+                )
+
+                def argmin_rows(start: int, end: int) -> None:
+                    rows = slice(start, end)
+                    for k in range(number_of_steps):
+                        scores = np.multiply(
+                            slopes[rows],
+                            steps[i + start : i + end, k, np.newaxis].astype(
+                                np.float32
+                            ),
+                            out=buffer[rows],
+                        )
+                        scores += offsets[rows]
+                        noisy_ids[k, i + start : i + end] = scores.argmin(axis=-1)
+
+                self._map_rows(executor, argmin_rows, j - i)
+
+        return noisy_ids
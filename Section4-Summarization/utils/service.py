@@ -0,0 +1,351 @@
+import asyncio
+import json
+import math
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from time import perf_counter
+from typing import TYPE_CHECKING
+from utils.dx import prepare_vocabulary
+from utils.text_lm import sanitize_texts_packed, ids_to_texts
+from utils.detokenizer import TableDecoder
+from utils.candidates import CandidateVocabulary
+from utils.files import print_timed
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer
+
+# The reason phrases of the HTTP statuses returned by the service
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    500: "Internal Server Error",
+}
+
+
+class ServiceMetrics:
+    """The latency of the last requests of a SanitizationService and its throughput since it started."""
+
+    def __init__(self, window: int = 10000) -> None:
+        """
+        Args:
+            window (int, optional): The number of last requests whose latency is kept for the percentiles. Defaults to 10000.
+        """
+        self.latencies = deque(maxlen=window)
+        self.start_time = perf_counter()
+        self.requests = 0
+        self.tokens = 0
+        self.batches = 0
+
+    def record_batch(self, latencies: list[float], tokens: int) -> None:
+        """Records a batch of requests, given the latency of each request in seconds and the number of tokens sanitized."""
+        self.latencies.extend(latencies)
+        self.requests += len(latencies)
+        self.tokens += tokens
+        self.batches += 1
+
+    def snapshot(self) -> dict:
+        """The metrics, as served by the /metrics endpoint."""
+        elapsed = perf_counter() - self.start_time
+        latencies = np.array(self.latencies) * 1000
+        p50, p99 = (
+            np.percentile(latencies, [50, 99]) if len(latencies) > 0 else (None, None)
+        )
+        return {
+            "requests": self.requests,
+            "tokens": self.tokens,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / max(1, self.batches),
+            "latency_p50_ms": None if p50 is None else float(p50),
+            "latency_p99_ms": None if p99 is None else float(p99),
+            "requests_per_second": self.requests / elapsed,
+            "tokens_per_second": self.tokens / elapsed,
+            "uptime_seconds": elapsed,
+        }
+
+
+@dataclass
+class _Request:
+    texts_ids: list[int]
+    epsilon: float
+    future: asyncio.Future
+    arrival_time: float = field(default_factory=perf_counter)
+
+
+class SanitizationService:
+    """Sanitizes texts on request, with the tokenizer and the prepared vocabulary kept in memory between requests.
+
+    Requests arriving together are coalesced into micro-batches: a batch is closed when max_wait seconds passed since
+    its first request, or when the next request would exceed max_batch_tokens tokens. All the texts of a batch, each with
+    its own epsilon value, are then sanitized in one packed pass (see text_lm.sanitize_texts_packed) by a worker thread,
+    while the event loop keeps accepting requests for the next batch. Requests are served over HTTP, on a TCP port or a
+    Unix socket (see serve), and the "numpy" backend runs without GPU.
+    """
+
+    def __init__(
+        self,
+        tokenizer: "AutoTokenizer",
+        vocabulary: np.ndarray,
+        pad_token_id: int,
+        dx_constant: float,
+        distance_metric: str = "euclidean",
+        backend: str = "numpy",
+        tail_mass: float | None = None,
+        neighbor_table: np.ndarray | None = None,
+        vocab_backend=None,
+        safe_radii: np.ndarray | None = None,
+        candidates: CandidateVocabulary | None = None,
+        decoder: TableDecoder | None = None,
+        max_wait: float = 0.01,
+        max_batch_tokens: int = 65536,
+        metrics_window: int = 10000,
+        max_body_bytes: int = 1 << 20,
+    ) -> None:
+        """
+        Args:
+            tokenizer (AutoTokenizer): The tokenizer of the model, see load_model_vocabulary for vocabulary.
+            max_wait (float, optional): The longest time in seconds a request waits for others to join its batch. Defaults to 0.01.
+            max_batch_tokens (int, optional): The largest number of tokens of a batch, a longer text being sanitized alone. Defaults to 65536.
+            metrics_window (int, optional): See ServiceMetrics. Defaults to 10000.
+            max_body_bytes (int, optional): The largest body of an HTTP request, larger requests are rejected
+                before reading their body. Defaults to 1 MiB.
+
+        See sanitize_texts_packed and ids_to_texts for the other arguments.
+        """
+        self.tokenizer = tokenizer
+        self.vocabulary = vocabulary
+        self.pad_token_id = pad_token_id
+        self.dx_constant = dx_constant
+        self.distance_metric = distance_metric
+        self.backend = backend
+        self.tail_mass = tail_mass
+        self.neighbor_table = neighbor_table
+        if vocab_backend is None:
+            # Prepared once for all requests (copied to GPU for cupy)
+            vocab_backend = prepare_vocabulary(
+                vocabulary if candidates is None else candidates.embeddings,
+                distance_metric,
+                backend,
+            )
+        self.vocab_backend = vocab_backend
+        self.safe_radii = safe_radii
+        self.candidates = candidates
+        self.decoder = decoder
+        self.max_wait = max_wait
+        self.max_batch_tokens = max_batch_tokens
+        self.max_body_bytes = max_body_bytes
+        self.metrics = ServiceMetrics(metrics_window)
+        self._queue: asyncio.Queue | None = None
+        self._batcher: asyncio.Task | None = None
+        # Batches run one at a time, next to the event loop
+        self._executor = ThreadPoolExecutor(1)
+
+    async def sanitize(self, text: str, epsilon: float) -> str:
+        """Sanitizes a text with the dx-privacy mechanism, batched with the other requests (see the class)."""
+        # A NaN or infinite epsilon gives NaN noise, whose nearest neighbor is always the first token
+        if not (math.isfinite(epsilon) and epsilon > 0):
+            raise ValueError("epsilon must be a positive finite number")
+        texts_ids = self.tokenizer(text, add_special_tokens=False)["input_ids"]
+        if len(texts_ids) == 0:
+            return ""
+        if self._batcher is None:
+            self._queue = asyncio.Queue()
+            self._batcher = asyncio.create_task(self._run_batches())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Request(texts_ids, epsilon, future))
+        return await future
+
+    async def _next_batch(self, batch: list[_Request]) -> _Request | None:
+        """Collects the requests joining the batch of its first request, appending them to batch as they arrive.
+        Returns the request which did not fit, if any."""
+        loop = asyncio.get_running_loop()
+        tokens = len(batch[0].texts_ids)
+        deadline = loop.time() + self.max_wait
+        while (timeout := deadline - loop.time()) > 0:
+            try:
+                request = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if tokens + len(request.texts_ids) > self.max_batch_tokens:
+                return request
+            batch.append(request)
+            tokens += len(request.texts_ids)
+        return None
+
+    @staticmethod
+    def _fail(requests: list[_Request], error: BaseException) -> None:
+        """Sets error on the requests still waiting for their result."""
+        for r in requests:
+            if not r.future.done():
+                r.future.set_exception(error)
+
+    async def _run_batches(self) -> None:
+        loop = asyncio.get_running_loop()
+        request = None
+        batch = []
+        try:
+            while True:
+                try:
+                    if request is None:
+                        request = await self._queue.get()
+                    batch = [request]
+                    request = None
+                    request = await self._next_batch(batch)
+                    texts = await loop.run_in_executor(
+                        self._executor, self._sanitize_batch, batch
+                    )
+                    end_time = perf_counter()
+                    for r, text in zip(batch, texts):
+                        if not r.future.done():
+                            r.future.set_result(text)
+                    self.metrics.record_batch(
+                        [end_time - r.arrival_time for r in batch],
+                        sum(len(r.texts_ids) for r in batch),
+                    )
+                except Exception as error:
+                    # The requests of the batch fail, the next batches are still served
+                    self._fail(batch, error)
+                batch = []
+        except BaseException:
+            # Cancelled with the service: no request is left waiting for a result that will never come
+            pending = batch + ([] if request is None else [request])
+            while not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+            self._fail(pending, RuntimeError("The sanitization service stopped"))
+            raise
+
+    def _sanitize_batch(self, batch: list[_Request]) -> list[str]:
+        """Sanitizes the texts of a batch in one packed pass, in the worker thread."""
+        lengths = [len(r.texts_ids) for r in batch]
+        texts_ids = np.full((len(batch), max(lengths)), self.pad_token_id)
+        attention_mask = np.zeros(texts_ids.shape, dtype=np.int64)
+        for i, r in enumerate(batch):
+            texts_ids[i, : lengths[i]] = r.texts_ids
+            attention_mask[i, : lengths[i]] = 1
+        # One epsilon value per text, broadcast to its tokens
+        epsilon = np.array([r.epsilon for r in batch], dtype=np.float64)[:, np.newaxis]
+        noisy_texts_ids = sanitize_texts_packed(
+            texts_ids,
+            attention_mask,
+            self.vocabulary,
+            self.pad_token_id,
+            self.dx_constant,
+            epsilon,
+            self.distance_metric,
+            self.backend,
+            self.tail_mass,
+            self.neighbor_table,
+            self.vocab_backend,
+            self.safe_radii,
+            None,
+            self.candidates,
+        )
+        # Pad tokens are skipped by the decoding, as special tokens
+        return ids_to_texts(noisy_texts_ids, self.tokenizer, self.decoder)
+
+    async def _route(self, method: str, path: str, body: bytes) -> tuple[int, dict]:
+        """The status and the JSON response of an HTTP request."""
+        if path == "/metrics":
+            if method != "GET":
+                return 405, {"error": "use GET"}
+            return 200, self.metrics.snapshot()
+        if path != "/sanitize":
+            return 404, {"error": f"no endpoint {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        try:
+            request = json.loads(body)
+            text, epsilon = request["text"], float(request["epsilon"])
+            if not isinstance(text, str):
+                raise TypeError("text must be a string")
+        except (ValueError, KeyError, TypeError) as error:
+            return 400, {
+                "error": f'expected {{"text": str, "epsilon": float}}: {error!r}'
+            }
+        if not (math.isfinite(epsilon) and epsilon > 0):
+            return 400, {"error": "epsilon must be a positive finite number"}
+        try:
+            return 200, {"text": await self.sanitize(text, epsilon)}
+        except Exception as error:
+            print_timed(f"Sanitization failed: {error!r}")
+            return 500, {"error": repr(error)}
+
+    async def _handle_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Serves one HTTP/1.1 request per connection."""
+        try:
+            try:
+                method, path, _ = (await reader.readline()).decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get("content-length", 0))
+                if content_length < 0:
+                    raise ValueError("negative Content-Length")
+                # The body of a request too large is not read, so that it is never held in memory
+                body = None
+                if content_length <= self.max_body_bytes:
+                    body = await reader.readexactly(content_length)
+            except (ValueError, asyncio.IncompleteReadError):
+                status, response = 400, {"error": "malformed HTTP request"}
+            else:
+                if body is None:
+                    status, response = 400, {
+                        "error": f"request body larger than {self.max_body_bytes} bytes"
+                    }
+                else:
+                    status, response = await self._route(method, path, body)
+            payload = json.dumps(response).encode()
+            writer.write(
+                f"HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode()
+                + payload
+            )
+            await writer.drain()
+        except ConnectionError:
+            # The client left before its response
+            pass
+        finally:
+            writer.close()
+
+    async def serve(
+        self,
+        host: str | None = "127.0.0.1",
+        port: int | None = 8000,
+        unix_socket: str | None = None,
+    ) -> None:
+        """Serves requests until cancelled, on a TCP port and/or a Unix socket:
+            POST /sanitize with {"text": str, "epsilon": float} returns {"text": the sanitized text}
+            GET /metrics returns ServiceMetrics.snapshot
+
+        Args:
+            host (str | None, optional): The host of the TCP server, None for no TCP server. Defaults to "127.0.0.1".
+            port (int | None, optional): The port of the TCP server. Defaults to 8000.
+            unix_socket (str | None, optional): The path of a Unix socket to listen on as well. Defaults to None.
+        """
+        servers = []
+        if host is not None:
+            servers.append(
+                await asyncio.start_server(self._handle_connection, host, port)
+            )
+            print_timed(f"Listening on http://{host}:{port}")
+        if unix_socket is not None:
+            servers.append(
+                await asyncio.start_unix_server(self._handle_connection, unix_socket)
+            )
+            print_timed(f"Listening on the Unix socket {unix_socket}")
+        if len(servers) == 0:
+            raise ValueError("Set host or unix_socket")
+        try:
+            await asyncio.gather(*(server.serve_forever() for server in servers))
+        finally:
+            for server in servers:
+                server.close()
+            if self._batcher is not None:
+                self._batcher.cancel()
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,262 @@
+import numpy as np
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from utils.search import ExactNeighborSearch
+from utils.memory import get_planner, set_memory_budget
+from utils.candidates import CandidateVocabulary
+from utils.text_lm import sanitize_texts_packed, task_seed
+from utils.tools import best_uint_type, print_timed
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    # Only the environment variables below cap the BLAS threads
+    threadpool_limits = None
+
+# Environment variables read by the BLAS and OpenMP libraries when they are loaded
+BLAS_THREADS_VARIABLES = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+)
+
+# Arrays and shared memory blocks attached by each worker process, see _init_worker
+_worker_arrays: dict[str, np.ndarray] = {}
+_worker_blocks: list[shared_memory.SharedMemory] = []
+
+
+def create_shared_array(
+    shape: tuple[int, ...], dtype, blocks: list[shared_memory.SharedMemory]
+) -> tuple[np.ndarray, tuple]:
+    """Allocates an array in a new shared memory block, which is appended to blocks. Returns the array and
+    the descriptor that attach_array needs to access it from another process."""
+    dtype = np.dtype(dtype)
+    block = shared_memory.SharedMemory(
+        create=True, size=max(1, int(np.prod(shape)) * dtype.itemsize)
+    )
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf), (
+        "shm",
+        block.name,
+        shape,
+        dtype.str,
+    )
+
+
+def share_array(array: np.ndarray, blocks: list[shared_memory.SharedMemory]) -> tuple:
+    """Places array in shared memory, unless it is memory-mapped from a .npy file (e.g., a neighbor table) which
+    workers can map themselves. Returns the descriptor that attach_array needs to access the array from another
+    process without copying it."""
+    if isinstance(array, np.memmap) and array.filename is not None:
+        # np.load(filename, mmap_mode="r") sliced along its leading axes, see neighbor_table.get_neighbor_table
+        return ("npy", array.filename, array.shape)
+    shared, descriptor = create_shared_array(array.shape, array.dtype, blocks)
+    shared[:] = array
+    return descriptor
+
+
+def attach_array(
+    descriptor: tuple, blocks: list[shared_memory.SharedMemory]
+) -> np.ndarray:
+    """The array described by a descriptor returned by share_array. Attached blocks are appended to blocks,
+    which must be kept alive as long as the array is used."""
+    if descriptor[0] == "npy":
+        _, filename, shape = descriptor
+        return np.load(filename, mmap_mode="r")[tuple(slice(0, s) for s in shape)]
+    _, name, shape, dtype = descriptor
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+
+def _init_worker(
+    descriptors: dict[str, tuple],
+    distance_metric: str,
+    blas_threads: int,
+    candidates_name: str | None,
+    memory_budget: int,
+) -> None:
+    """Attaches the shared arrays, caps the BLAS threads, sets the memory budget of the worker and prepares the
+    vocabulary once per worker."""
+    for variable in BLAS_THREADS_VARIABLES:
+        os.environ[variable] = str(blas_threads)
+    if threadpool_limits is not None:
+        # The BLAS library may already be loaded (forked workers), limit its thread pools directly
+        threadpool_limits(blas_threads)
+    # Each worker plans its chunks within its share of the budget of the parent, see utils.memory
+    set_memory_budget("numpy", memory_budget)
+
+    for key, descriptor in descriptors.items():
+        _worker_arrays[key] = attach_array(descriptor, _worker_blocks)
+    search_vocabulary = _worker_arrays["vocabulary"]
+    if candidates_name is not None:
+        # The shared candidate matrix is searched instead of the whole vocabulary
+        _worker_arrays["candidates"] = CandidateVocabulary(
+            _worker_arrays["candidates_token_ids"],
+            _worker_arrays["candidates_embeddings"],
+            search_vocabulary.shape[0],
+            candidates_name,
+        )
+        search_vocabulary = _worker_arrays["candidates_embeddings"]
+    # The shared float32 vocabulary is used without any copy (except the normalized copy for cosine)
+    _worker_arrays["vocab_backend"] = ExactNeighborSearch(
+        search_vocabulary, distance_metric, blas_threads
+    )
+
+
+def _sanitize_shard(
+    epsilon_index: int,
+    epsilon: int,
+    start: int,
+    end: int,
+    pad_token_id: int,
+    dx_constant: float,
+    distance_metric: str,
+    tail_mass: float | None,
+    master_seed: int | None = None,
+) -> tuple[int, int, int]:
+    """Sanitizes the texts start to end for one epsilon in a worker, and writes the result in the shared output."""
+    _worker_arrays["output"][epsilon_index, start:end] = sanitize_texts_packed(
+        _worker_arrays["texts_ids"][start:end],
+        _worker_arrays["attention_mask"][start:end],
+        _worker_arrays["vocabulary"],
+        pad_token_id,
+        dx_constant,
+        epsilon,
+        distance_metric,
+        "numpy",
+        tail_mass,
+        _worker_arrays.get("neighbor_table"),
+        _worker_arrays["vocab_backend"],
+        _worker_arrays.get("safe_radii"),
+        candidates=_worker_arrays.get("candidates"),
+        seed=None if master_seed is None else task_seed(master_seed, start, end),
+    )
+    return epsilon_index, start, end
+
+
+def sanitize_texts_sharded(
+    texts_ids: np.ndarray,
+    attention_mask: np.ndarray,
+    vocabulary: np.ndarray,
+    pad_token_id: int,
+    dx_constant: float,
+    epsilons: list[int],
+    distance_metric: str = "euclidean",
+    tail_mass: float | None = None,
+    neighbor_table: np.ndarray | None = None,
+    safe_radii: np.ndarray | None = None,
+    n_processes: int | None = None,
+    shard_size: int = 1000,
+    blas_threads: int = 1,
+    candidates: CandidateVocabulary | None = None,
+    master_seed: int | None = None,
+) -> np.ndarray:
+    """Applies the whole dx-privacy mechanism on padded texts for several epsilon values with a pool of CPU processes.
+    The texts are split into shards of shard_size texts, and each (shard, epsilon) pair is processed by a worker
+    with sanitize_texts_packed and the "numpy" backend.
+
+    The vocabulary, the token ids, the attention mask and the output are placed once in shared memory (the neighbor
+    table is memory-mapped by each worker when it is loaded from a file), so that workers never copy them. Each worker
+    writes its results straight into the shared output. The BLAS libraries of each worker are limited to blas_threads
+    threads, so that n_processes * blas_threads should not exceed the number of cores. Likewise, the RAM budget of the
+    "numpy" planner of this process (see utils.memory.set_memory_budget) is split evenly between the workers, which
+    size their chunks within their share.
+
+    Args:
+        texts_ids (np.ndarray): A two-dimensional array containing the token ids of the padded texts.
+        attention_mask (np.ndarray): A two-dimensional array of the same shape as texts_ids, where a 0 marks the position of a pad token.
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        pad_token_id (int): The token id of a pad token (depends on the tokenizer)
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilons (list[int]): The epsilon values in the dx-privacy formula.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        tail_mass (float | None, optional): See text_lm.apply_post_processing_on_textsV2. Defaults to None.
+        neighbor_table (np.ndarray | None, optional): See text_lm.sanitize_packed_ids. Defaults to None.
+        safe_radii (np.ndarray | None, optional): See text_lm.sanitize_packed_ids. Defaults to None.
+        n_processes (int | None, optional): The number of worker processes. Defaults to None, which uses
+            os.cpu_count() // blas_threads processes.
+        shard_size (int, optional): The number of texts processed by a worker at a time. Defaults to 1000.
+        blas_threads (int, optional): The number of threads of each worker. Defaults to 1.
+        candidates (CandidateVocabulary | None, optional): See text_lm.sanitize_packed_ids_multi_epsilon, the candidate
+            matrix is shared in memory as well. Defaults to None.
+        master_seed (int | None, optional): If set, each (shard, epsilon) task draws from the random streams of
+            text_lm.task_seed, so that the output does not depend on the number of processes nor on the scheduling,
+            and any task can be re-run on its own. Defaults to None, which draws from fresh entropy.
+
+    Returns:
+        np.ndarray: A three-dimensional array of shape (len(epsilons), texts_ids.shape[0], texts_ids.shape[1])
+            containing the ids of the sanitized texts for each epsilon.
+    """
+    if n_processes is None:
+        n_processes = max(1, os.cpu_count() // blas_threads)
+    number_of_texts = texts_ids.shape[0]
+    # Otherwise, each worker would plan with 50% of the available RAM
+    worker_memory_budget = max(1, get_planner("numpy").budget // n_processes)
+
+    blocks: list[shared_memory.SharedMemory] = []
+    output = None
+    try:
+        descriptors = {
+            "vocabulary": share_array(np.asarray(vocabulary, dtype=np.float32), blocks),
+            "texts_ids": share_array(np.asarray(texts_ids), blocks),
+            "attention_mask": share_array(np.asarray(attention_mask), blocks),
+        }
+        if neighbor_table is not None:
+            descriptors["neighbor_table"] = share_array(neighbor_table, blocks)
+        if safe_radii is not None:
+            descriptors["safe_radii"] = share_array(safe_radii, blocks)
+        if candidates is not None:
+            descriptors["candidates_token_ids"] = share_array(
+                candidates.token_ids, blocks
+            )
+            descriptors["candidates_embeddings"] = share_array(
+                np.asarray(candidates.embeddings, dtype=np.float32), blocks
+            )
+        # Workers write their results straight into the shared output
+        output, descriptors["output"] = create_shared_array(
+            (len(epsilons),) + texts_ids.shape,
+            best_uint_type(vocabulary.shape[0]),
+            blocks,
+        )
+
+        with ProcessPoolExecutor(
+            n_processes,
+            initializer=_init_worker,
+            initargs=(
+                descriptors,
+                distance_metric,
+                blas_threads,
+                None if candidates is None else candidates.name,
+                worker_memory_budget,
+            ),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _sanitize_shard,
+                    epsilon_index,
+                    epsilon,
+                    start,
+                    min(start + shard_size, number_of_texts),
+                    pad_token_id,
+                    dx_constant,
+                    distance_metric,
+                    tail_mass,
+                    master_seed,
+                )
+                for epsilon_index, epsilon in enumerate(epsilons)
+                for start in range(0, number_of_texts, shard_size)
+            ]
+            for future in as_completed(futures):
+                epsilon_index, start, end = future.result()
+                print_timed(f"Epsi{epsilons[epsilon_index]}: slice {start}:{end} done")
+
+        # Copy the output out of shared memory before releasing it
+        return output.copy()
+    finally:
+        # Release the view on the shared output before closing its block
+        output = None
+        for block in blocks:
+            block.close()
+            block.unlink()
@@ -0,0 +1,199 @@
+import json
+import numpy as np
+import os
+import socket
+from os.path import join, exists, getmtime
+from time import time
+from typing import Callable
+from utils.files import print_timed
+
+# The states of a task, each one a folder of the queue: a task moves from one to the next with an atomic rename
+PENDING, CLAIMED, DONE = "pending", "claimed", "done"
+
+
+class TaskQueue:
+    """A queue of (epsilon, texts start, texts end) tasks of a sanitization sweep, stored in a folder of a shared
+    filesystem so that worker processes on several hosts can take tasks from it (see run_task_queue).
+
+    Each task is a file which moves from pending/ to claimed/ when a worker claims it, with an atomic rename so that
+    only one worker gets it, then its output is saved in done/. A task whose worker crashed stays in claimed/ until
+    requeue_stale_tasks puts it back in pending/. As each task draws from the random streams of
+    text_lm.task_seed, a task which is run again, or run twice, gives the same output.
+    """
+
+    def __init__(self, folderpath: str) -> None:
+        """
+        Args:
+            folderpath (str): The folder of the queue, created if it does not exist.
+        """
+        self.folderpath = folderpath
+        for state in (PENDING, CLAIMED, DONE):
+            os.makedirs(join(folderpath, state), exist_ok=True)
+
+    @staticmethod
+    def task_key(epsilon: int, start: int, end: int) -> str:
+        """The file name (without extension) of a task."""
+        return f"epsi{epsilon}_texts{start:09d}-{end:09d}"
+
+    def _filepath(self, state: str, key: str) -> str:
+        return join(
+            self.folderpath, state, f"{key}.npy" if state == DONE else f"{key}.json"
+        )
+
+    def submit(self, epsilons: list[int], number_of_texts: int, shard_size: int) -> int:
+        """Adds the tasks of a sweep, one per epsilon and slice of shard_size texts, except the ones already in the
+        queue. Several workers can submit the same sweep.
+
+        Returns:
+            int: The number of tasks added.
+        """
+        submitted = 0
+        for epsilon in epsilons:
+            for start in range(0, number_of_texts, shard_size):
+                end = min(start + shard_size, number_of_texts)
+                key = self.task_key(epsilon, start, end)
+                if any(
+                    exists(self._filepath(state, key))
+                    for state in (PENDING, CLAIMED, DONE)
+                ):
+                    continue
+                filepath = self._filepath(PENDING, key)
+                # Written in a temporary file so that a worker never claims an incomplete task
+                tmp_filepath = join(
+                    self.folderpath, f"{key}.{socket.gethostname()}.{os.getpid()}.tmp"
+                )
+                with open(tmp_filepath, "w") as f:
+                    json.dump({"epsilon": epsilon, "start": start, "end": end}, f)
+                os.replace(tmp_filepath, filepath)
+                submitted += 1
+        return submitted
+
+    def claim(self) -> tuple[int, int, int] | None:
+        """Claims a pending task, in the order of the file names.
+
+        Returns:
+            tuple[int, int, int] | None: The epsilon, start and end of the task, or None if no task is pending.
+        """
+        for filename in sorted(os.listdir(join(self.folderpath, PENDING))):
+            claimed_filepath = join(self.folderpath, CLAIMED, filename)
+            try:
+                os.rename(join(self.folderpath, PENDING, filename), claimed_filepath)
+            except FileNotFoundError:
+                # Claimed by another worker in the meantime
+                continue
+            # The claim time, see requeue_stale_tasks
+            os.utime(claimed_filepath)
+            with open(claimed_filepath) as f:
+                task = json.load(f)
+            return task["epsilon"], task["start"], task["end"]
+        return None
+
+    def complete(self, epsilon: int, start: int, end: int, output: np.ndarray) -> None:
+        """Saves the output of a claimed task and marks it done."""
+        key = self.task_key(epsilon, start, end)
+        tmp_filepath = join(
+            self.folderpath, f"{key}.{socket.gethostname()}.{os.getpid()}.tmp.npy"
+        )
+        np.save(tmp_filepath, output)
+        os.replace(tmp_filepath, self._filepath(DONE, key))
+        try:
+            os.remove(self._filepath(CLAIMED, key))
+        except FileNotFoundError:
+            # Requeued and completed by another worker as well
+            pass
+
+    def requeue_stale_tasks(self, timeout: float) -> int:
+        """Puts back in the queue the tasks claimed more than timeout seconds ago and not done, e.g., because their
+        worker crashed.
+
+        Returns:
+            int: The number of tasks requeued.
+        """
+        requeued = 0
+        now = time()
+        for filename in os.listdir(join(self.folderpath, CLAIMED)):
+            claimed_filepath = join(self.folderpath, CLAIMED, filename)
+            key = filename.removesuffix(".json")
+            try:
+                if now - getmtime(claimed_filepath) < timeout:
+                    continue
+                if exists(self._filepath(DONE, key)):
+                    os.remove(claimed_filepath)
+                    continue
+                os.rename(claimed_filepath, self._filepath(PENDING, key))
+            except FileNotFoundError:
+                # Completed or requeued by another worker in the meantime
+                continue
+            requeued += 1
+        return requeued
+
+    def remaining(self) -> int:
+        """The number of tasks pending or claimed."""
+        return len(os.listdir(join(self.folderpath, PENDING))) + len(
+            os.listdir(join(self.folderpath, CLAIMED))
+        )
+
+    def merge(self, epsilon: int, number_of_texts: int, shard_size: int) -> np.ndarray:
+        """The outputs of the tasks of an epsilon value concatenated along the texts, see submit.
+
+        Raises:
+            ValueError: If a task of this epsilon value is not done.
+        """
+        outputs = []
+        for start in range(0, number_of_texts, shard_size):
+            end = min(start + shard_size, number_of_texts)
+            filepath = self._filepath(DONE, self.task_key(epsilon, start, end))
+            if not exists(filepath):
+                raise ValueError(
+                    f"Task {self.task_key(epsilon, start, end)} is not done"
+                )
+            outputs.append(np.load(filepath))
+        return np.concatenate(outputs)
+
+    def lock(self, name: str) -> bool:
+        """Takes the lock name, e.g., to have a single worker merge the outputs of the sweep. Locks are never released.
+
+        Returns:
+            bool: Whether this call took the lock, False if it was already taken.
+        """
+        try:
+            os.close(
+                os.open(join(self.folderpath, f"{name}.lock"), os.O_CREAT | os.O_EXCL)
+            )
+        except FileExistsError:
+            return False
+        return True
+
+
+def run_task_queue(
+    queue: TaskQueue,
+    sanitize_task: Callable[[int, int, int], np.ndarray],
+    stale_timeout: float | None = None,
+) -> int:
+    """Runs the tasks of a queue until none is pending. Start one such worker per process and per host to spread a
+    sweep, each with the same master seed.
+
+    Args:
+        queue (TaskQueue): The queue.
+        sanitize_task (Callable[[int, int, int], np.ndarray]): Sanitizes the texts start to end for epsilon, given as
+            (epsilon, start, end), e.g., with text_lm.sanitize_texts_packed and text_lm.task_seed(master_seed, start, end).
+        stale_timeout (float | None, optional): If set, the tasks claimed more than stale_timeout seconds ago are
+            requeued whenever no task is pending, see TaskQueue.requeue_stale_tasks. Defaults to None.
+
+    Returns:
+        int: The number of tasks run by this worker.
+    """
+    completed = 0
+    while True:
+        task = queue.claim()
+        if task is None and stale_timeout is not None:
+            requeued = queue.requeue_stale_tasks(stale_timeout)
+            if requeued > 0:
+                print_timed(f"Requeued {requeued} stale tasks")
+                task = queue.claim()
+        if task is None:
+            return completed
+        epsilon, start, end = task
+        print_timed(f"Epsi{epsilon}: task {start}:{end}")
+        queue.complete(epsilon, start, end, sanitize_task(epsilon, start, end))
+        completed += 1
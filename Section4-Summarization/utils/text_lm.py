@@ -1,16 +1,39 @@
-import torch
 import numpy as np
-import cupy as cp
-from transformers import AutoTokenizer, AutoModel
-from .dx import noisy_embeddings_to_ids_cp, dx_post_processing
-from .tools import best_uint_type
+import os
+import json
+import threading
+from os.path import join, exists
+from typing import TYPE_CHECKING
+from .dx import (
+    noisy_embeddings_to_ids_cp,
+    noisy_embeddings_to_ids,
+    dx_post_processing,
+    prepare_vocabulary,
+    truncation_rank,
+    dx_post_processing_from_ids,
+    derive_seed,
+    sample_noise_vectors_np,
+    sample_noise_rays_np,
+    noisy_rays_to_ids,
+)
+from .tools import best_uint_type, print_timed
+from .pruned_search import PrunedNeighborSearch
+from .candidates import CandidateVocabulary
+from .detokenizer import TableDecoder
+
+# Imported on first use: CPU-only machines use the "numpy" backend, and only loading models requires PyTorch,
+# safetensors and huggingface_hub
+from .backends import cp, torch, safetensors, huggingface_hub
+
+if TYPE_CHECKING:
+    from transformers import AutoTokenizer, AutoModel
 
 
 def text_to_tokens_ids(
-    tokenizer: AutoTokenizer,
+    tokenizer: "AutoTokenizer",
     texts: list[list[str]],
     return_tokens: bool = False,
-) -> tuple[torch.Tensor, torch.Tensor, list[list[str]]]:
+) -> "tuple[torch.Tensor, torch.Tensor, list[list[str]]]":
     """Tokenize text into token ids.
 
     Args:
@@ -41,7 +64,7 @@ def text_to_tokens_ids(
     return texts_ids, encoded_input["attention_mask"], texts_tokens
 
 
-def get_model_vocabulary(model: AutoModel) -> torch.Tensor:
+def get_model_vocabulary(model: "AutoModel") -> "torch.Tensor":
     """Get the vocabulary (i.e., token embedding model) of the language model.
 
     Args:
@@ -53,16 +76,130 @@ def get_model_vocabulary(model: AutoModel) -> torch.Tensor:
     return model.get_input_embeddings().weight.detach().clone()
 
 
+# Suffixes of the name of the input-embedding tensor in checkpoints, by order of preference:
+# BART and T5 ("model.shared.weight", tied to their embed_tokens), Llama ("model.embed_tokens.weight"), BERT and GPT-2.
+EMBEDDING_TENSOR_SUFFIXES = (
+    "shared.weight",
+    "embed_tokens.weight",
+    "word_embeddings.weight",
+    "wte.weight",
+)
+
+
+def vocabulary_filepath(folderpath: str, model_name: str, revision: str) -> str:
+    """Path of the cached vocabulary of a model, keyed by its name and its revision."""
+    model_name = model_name.replace("/", "--")
+    return join(folderpath, f"{model_name}_{revision}_vocabulary.npy")
+
+
+def embedding_tensor_name(tensor_names: list[str]) -> str:
+    """The name of the input-embedding tensor among the tensors of a checkpoint, see EMBEDDING_TENSOR_SUFFIXES."""
+    for suffix in EMBEDDING_TENSOR_SUFFIXES:
+        names = [name for name in tensor_names if name.endswith(suffix)]
+        if names:
+            # The shortest name, e.g., "model.shared.weight" rather than a prefixed copy of it
+            return min(names, key=len)
+    raise ValueError(
+        f"No input-embedding tensor found, expected a name ending with one of {EMBEDDING_TENSOR_SUFFIXES}"
+    )
+
+
+def load_model_vocabulary(
+    model_name: str,
+    revision: str,
+    folderpath: str,
+    tensor_name: str | None = None,
+    batch_size: int = 8192,
+) -> np.ndarray:
+    """Loads the vocabulary (i.e., token embedding model) of a language model without loading the model. Only the
+    checkpoint file holding the input-embedding tensor is downloaded (or taken from the Hugging Face cache), and the
+    tensor is read from it lazily with memory-mapped slices of batch_size rows, converted to float32. The result is
+    cached in folderpath as a .npy file keyed by the model name and revision, and memory-mapped from there.
+    Same as get_model_vocabulary(model).to(torch.float32).numpy() after loading the whole model.
+
+    Args:
+        model_name (str): The name of the model, e.g., "facebook/bart-large-cnn".
+        revision (str): The revision of the model.
+        folderpath (str): The folder where vocabularies are cached.
+        tensor_name (str | None, optional): The name of the input-embedding tensor in the checkpoint. Defaults to None,
+            which looks it up with embedding_tensor_name.
+        batch_size (int, optional): The number of rows converted at a time. Defaults to 8192.
+
+    Returns:
+        np.ndarray: The float32 vocabulary of shape (vocabulary size, hidden size), memory-mapped in read-only mode.
+    """
+    filepath = vocabulary_filepath(folderpath, model_name, revision)
+    if exists(filepath):
+        return np.load(filepath, mmap_mode="r")
+    if not exists(folderpath):
+        os.makedirs(folderpath)
+
+    print_timed(f"Extracting the vocabulary of {model_name} to {filepath}")
+    try:
+        # Sharded checkpoint, the index maps each tensor to its shard
+        index_filepath = huggingface_hub.hf_hub_download(
+            model_name, "model.safetensors.index.json", revision=revision
+        )
+        with open(index_filepath) as f:
+            weight_map = json.load(f)["weight_map"]
+        if tensor_name is None:
+            tensor_name = embedding_tensor_name(list(weight_map))
+        checkpoint_filename = weight_map[tensor_name]
+    except huggingface_hub.utils.EntryNotFoundError:
+        checkpoint_filename = "model.safetensors"
+
+    # Write in a temporary file so that an interrupted extraction is never mistaken for a complete vocabulary.
+    tmp_filepath = f"{filepath}.tmp"
+    try:
+        checkpoint_filepath = huggingface_hub.hf_hub_download(
+            model_name, checkpoint_filename, revision=revision
+        )
+    except huggingface_hub.utils.EntryNotFoundError:
+        # Older checkpoints are only saved with torch.save, they are memory-mapped as well
+        checkpoint_filepath = huggingface_hub.hf_hub_download(
+            model_name, "pytorch_model.bin", revision=revision
+        )
+        state_dict = torch.load(
+            checkpoint_filepath, map_location="cpu", mmap=True, weights_only=True
+        )
+        if tensor_name is None:
+            tensor_name = embedding_tensor_name(list(state_dict))
+        _save_vocabulary(state_dict[tensor_name], tmp_filepath, batch_size)
+    else:
+        with safetensors.safe_open(checkpoint_filepath, framework="pt") as f:
+            if tensor_name is None:
+                tensor_name = embedding_tensor_name(list(f.keys()))
+            _save_vocabulary(f.get_slice(tensor_name), tmp_filepath, batch_size)
+    os.replace(tmp_filepath, filepath)
+
+    return np.load(filepath, mmap_mode="r")
+
+
+def _save_vocabulary(tensor, filepath: str, batch_size: int) -> None:
+    """Converts a two-dimensional tensor (or a lazy slice of a safetensors file) to a float32 .npy file, batch_size
+    rows at a time."""
+    vocab_size, hidden_size = (
+        tensor.get_shape() if hasattr(tensor, "get_shape") else tensor.shape
+    )
+    vocabulary = np.lib.format.open_memmap(
+        filepath, mode="w+", dtype=np.float32, shape=(vocab_size, hidden_size)
+    )
+    for i in range(0, vocab_size, batch_size):
+        j = min(i + batch_size, vocab_size)
+        vocabulary[i:j] = tensor[i:j].to(torch.float32).numpy()
+    vocabulary.flush()
+
+
 def texts_ids_to_embeddings(
-    vocabulary: torch.Tensor,
-    texts_ids: torch.Tensor,
-) -> torch.Tensor:
+    vocabulary: "torch.Tensor",
+    texts_ids: "torch.Tensor",
+) -> "torch.Tensor":
     return vocabulary[texts_ids]
 
 
 def nearest_neighbor_search_on_texts(
-    texts_embeddings: torch.Tensor,
-    vocabulary: torch.Tensor,
+    texts_embeddings: "torch.Tensor",
+    vocabulary: "torch.Tensor",
     distance_metric: str = "euclidean",
 ) -> list[list[int]]:
     """Performs a nearest neighbor search on the texts_embeddings array against the vocabulary.
@@ -102,6 +239,8 @@ def nearest_neighbor_search_on_textsV2(
     attention_mask: np.ndarray,
     pad_token_id: int,
     distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    candidates: CandidateVocabulary | None = None,
 ) -> np.ndarray:
     """Performs a nearest neighbor search on the texts_embeddings array against the vocabulary.
     This second version does not process pad tokens marked as such by the attention_mask and directly
@@ -109,10 +248,14 @@ def nearest_neighbor_search_on_textsV2(
 
     Args:
         texts_embeddings (torch.Tensor): A three-dimensional array containing the embeddings we want to process.
-        vocabulary (torch.Tensor): A two-dimensional array containing all the embeddings of the vocabulary to compute the nearest neighbor search against.
+        vocabulary (torch.Tensor): A two-dimensional array containing all the embeddings of the vocabulary to compute the nearest neighbor search against,
+            or an index of the vocabulary returned by dx.prepare_vocabulary, e.g., an approximate index of utils.ann.
         attention_mask (np.ndarray): A two-dimensional array of the same shape as texts_embeddings, where a 0 marks the position of a pad token.
         pad_token_id (int): The token id of a pad token (depends on the tokenizer)
         distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+        candidates (CandidateVocabulary | None, optional): If set, vocabulary is the candidate matrix candidates.embeddings
+            (or prepared from it, see utils.candidates) and the token ids of the results are returned. Defaults to None.
 
     Returns:
         np.ndarray: The nearest neighbor of each embeddings.
@@ -120,15 +263,17 @@ def nearest_neighbor_search_on_textsV2(
     number_of_texts = texts_embeddings.shape[0]
     padded_number_of_tokens = texts_embeddings.shape[1]
 
-    # Copy the vocabulary to GPU once to avoid copying each turn
+    # Load the vocabulary once (on GPU for cupy) to avoid doing it each turn
     # of the loop below.
-    vocab_cp = cp.asarray(vocabulary, dtype="float32")
+    vocab_backend = prepare_vocabulary(vocabulary, distance_metric, backend)
 
     # Declare the result as a two-dimensional array, consisting of only pad tokens for now.
     noisy_texts_ids = np.full(
         (number_of_texts, padded_number_of_tokens),
         pad_token_id,
-        dtype=best_uint_type(vocabulary.shape[0]),
+        dtype=best_uint_type(
+            vocabulary.shape[0] if candidates is None else candidates.vocab_size
+        ),
     )
 
     # Performs the nearest neighbor search text-by-text for all text embeddings, excluding pad tokens.
@@ -140,15 +285,17 @@ def nearest_neighbor_search_on_textsV2(
         first_index_to_be_computed = indexes_to_be_computed[0]
         last_index_to_be_computed = indexes_to_be_computed[-1] + 1
 
-        noisy_texts_ids[i][first_index_to_be_computed:last_index_to_be_computed] = (
-            noisy_embeddings_to_ids_cp(
-                texts_embeddings[i][
-                    first_index_to_be_computed:last_index_to_be_computed
-                ],
-                vocab_cp,
-                distance_metric,
-            )
+        pivot_ids = noisy_embeddings_to_ids(
+            texts_embeddings[i][first_index_to_be_computed:last_index_to_be_computed],
+            vocab_backend,
+            distance_metric,
+            backend,
         )
+        if candidates is not None:
+            pivot_ids = candidates.to_token_ids(pivot_ids)
+        noisy_texts_ids[i][
+            first_index_to_be_computed:last_index_to_be_computed
+        ] = pivot_ids
     return noisy_texts_ids
 
 
@@ -193,8 +340,11 @@ def apply_post_processing_on_textsV2(
     attention_mask: np.ndarray,
     pad_token_id: int,
     dx_constant: float,
-    epsilon: int,
+    epsilon: int | np.ndarray,
     distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    tail_mass: float | None = None,
+    candidates: CandidateVocabulary | None = None,
 ) -> np.ndarray:
     """Applies the post-processing fix proposed in (Asghar et al., 2024) on texts_embeddings, text-by-text. This second version does not process pad tokens marked as such by the attention_mask and directly puts pad_token_id as their associated result.
 
@@ -204,20 +354,46 @@ def apply_post_processing_on_textsV2(
         attention_mask (np.ndarray): A two-dimensional array of the same shape as texts_embeddings, where a 0 marks the position of a pad token.
         pad_token_id (int): The token id of a pad token (depends on the tokenizer)
         dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
-        epsilon (int): The epsilon value in the dx-privacy formula.
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, or an array broadcastable to
+            (number of texts, number of tokens) with the epsilon value of each token, e.g., one value per text of shape
+            (number of texts, 1). All texts are then processed in the same pass whatever their privacy budget.
         distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+        tail_mass (float | None, optional): If set, only sample among the nearest elements of the vocabulary such that
+            the probability of sampling a farther element is at most tail_mass, see dx.truncation_rank. Defaults to None.
+        candidates (CandidateVocabulary | None, optional): See nearest_neighbor_search_on_textsV2. Defaults to None.
 
     Returns:
         np.ndarray: A two-dimensional numpy array containing the ids of the sampled replacements.
     """
     number_of_texts = texts_embeddings.shape[0]
     padded_number_of_tokens = texts_embeddings.shape[1]
+    vocab_size = vocabulary.shape[0]
+
+    if tail_mass is not None:
+        # The largest number of neighbors, for the smallest epsilon value
+        k, dropped_mass = truncation_rank(
+            dx_constant, np.min(epsilon), vocab_size, tail_mass
+        )
+        print_timed(
+            f"Post-processing among the {k} nearest neighbors, dropped probability mass: {dropped_mass:.3e}"
+        )
+
+    # The numpy backend precomputes what it needs once for all texts,
+    # rank_neighbors copies the vocabulary to GPU itself for the cupy backend.
+    if backend == "numpy":
+        vocabulary = prepare_vocabulary(vocabulary, distance_metric, backend)
+
+    if np.ndim(epsilon) > 0:
+        epsilon = np.broadcast_to(epsilon, (number_of_texts, padded_number_of_tokens))
 
     # Declare the result as a two-dimensional array, consisting of pad tokens for now.
     noisy_texts_ids = np.full(
         (number_of_texts, padded_number_of_tokens),
         pad_token_id,
-        dtype=best_uint_type(vocabulary.shape[0]),
+        dtype=best_uint_type(
+            vocab_size if candidates is None else candidates.vocab_size
+        ),
     )
 
     # Apply the fix text-by-text for all text embeddings, excluding pad tokens.
@@ -227,21 +403,919 @@ def apply_post_processing_on_textsV2(
         first_index_to_be_computed = indexes_to_be_computed[0]
         last_index_to_be_computed = indexes_to_be_computed[-1] + 1
 
-        noisy_texts_ids[i][first_index_to_be_computed:last_index_to_be_computed] = (
-            dx_post_processing(
-                texts_embeddings[i][
-                    first_index_to_be_computed:last_index_to_be_computed
-                ],
-                vocabulary,
+        noisy_ids = dx_post_processing(
+            texts_embeddings[i][first_index_to_be_computed:last_index_to_be_computed],
+            vocabulary,
+            dx_constant,
+            (
+                epsilon
+                if np.ndim(epsilon) == 0
+                else epsilon[i][first_index_to_be_computed:last_index_to_be_computed]
+            ),
+            distance_metric,
+            backend,
+            tail_mass,
+        )
+        if candidates is not None:
+            noisy_ids = candidates.to_token_ids(noisy_ids)
+        noisy_texts_ids[i][
+            first_index_to_be_computed:last_index_to_be_computed
+        ] = noisy_ids
+    return noisy_texts_ids
+
+
+def apply_post_processing_on_texts_ids(
+    texts_ids: np.ndarray,
+    neighbor_table: np.ndarray,
+    vocabulary: np.ndarray,
+    attention_mask: np.ndarray,
+    pad_token_id: int,
+    dx_constant: float,
+    epsilon: int | np.ndarray,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    tail_mass: float | None = None,
+    candidates: CandidateVocabulary | None = None,
+) -> np.ndarray:
+    """Applies the post-processing fix proposed in (Asghar et al., 2024) on texts given as token ids, e.g. the result
+    of nearest_neighbor_search_on_textsV2. Same as apply_post_processing_on_textsV2 on vocabulary[texts_ids], but the
+    neighbors of each token are looked up in the neighbor table (see utils.neighbor_table) and all texts are processed
+    at once. Pad tokens marked as such by the attention_mask are not processed and pad_token_id is directly put as
+    their associated result.
+
+    Args:
+        texts_ids (np.ndarray): A two-dimensional array containing the token ids we want to process.
+        neighbor_table (np.ndarray): The neighbor table of the vocabulary, see utils.neighbor_table.get_neighbor_table.
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary to compute the fix against.
+        attention_mask (np.ndarray): A two-dimensional array of the same shape as texts_ids, where a 0 marks the position of a pad token.
+        pad_token_id (int): The token id of a pad token (depends on the tokenizer)
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, or an array broadcastable to
+            the shape of texts_ids, see apply_post_processing_on_textsV2.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+        tail_mass (float | None, optional): If set, only sample among the nearest elements of the vocabulary such that
+            the probability of sampling a farther element is at most tail_mass, see dx.truncation_rank. Defaults to None.
+        candidates (CandidateVocabulary | None, optional): See nearest_neighbor_search_on_textsV2, the neighbor table must
+            then be built for candidates.embeddings and texts_ids must only contain candidates (except for pad tokens). Defaults to None.
+
+    Returns:
+        np.ndarray: A two-dimensional numpy array containing the ids of the sampled replacements.
+    """
+    vocab_size = vocabulary.shape[0]
+
+    if tail_mass is not None:
+        # The largest number of neighbors, for the smallest epsilon value
+        k, dropped_mass = truncation_rank(
+            dx_constant, np.min(epsilon), vocab_size, tail_mass
+        )
+        print_timed(
+            f"Post-processing among the {k} nearest neighbors, dropped probability mass: {dropped_mass:.3e}"
+        )
+
+    # Declare the result as a two-dimensional array, consisting of pad tokens for now.
+    noisy_texts_ids = np.full(
+        texts_ids.shape,
+        pad_token_id,
+        dtype=best_uint_type(
+            vocab_size if candidates is None else candidates.vocab_size
+        ),
+    )
+
+    # Apply the fix on all tokens at once, excluding pad tokens.
+    tokens_to_be_computed = attention_mask == 1
+    ids = texts_ids[tokens_to_be_computed]
+    if candidates is not None:
+        ids = candidates.to_candidate_ids(ids)
+    noisy_ids = dx_post_processing_from_ids(
+        ids,
+        neighbor_table,
+        vocabulary,
+        dx_constant,
+        (
+            epsilon
+            if np.ndim(epsilon) == 0
+            else np.broadcast_to(epsilon, texts_ids.shape)[tokens_to_be_computed]
+        ),
+        distance_metric,
+        backend,
+        tail_mass,
+    )
+    if candidates is not None:
+        noisy_ids = candidates.to_token_ids(noisy_ids)
+    noisy_texts_ids[tokens_to_be_computed] = noisy_ids
+    return noisy_texts_ids
+
+
+def describe_epsilon(epsilon: int | np.ndarray) -> str:
+    """The epsilon value for logs, or the range of the epsilon values of an array."""
+    if np.ndim(epsilon) == 0:
+        return str(epsilon)
+    return f"{np.min(epsilon)}-{np.max(epsilon)}"
+
+
+def pack_texts_ids(
+    texts_ids: np.ndarray,
+    attention_mask: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Packs the tokens of padded texts into one contiguous array, without pad tokens.
+
+    Args:
+        texts_ids (np.ndarray): A two-dimensional array containing the token ids of the padded texts.
+        attention_mask (np.ndarray): A two-dimensional array of the same shape as texts_ids, where a 0 marks the position of a pad token.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: A tuple containing i) a one-dimensional array with the ids of all non-pad tokens, text
+            after text, and ii) the offsets of the texts in the first array, of shape (number_of_texts + 1), such that the
+            tokens of the i-th text are packed_ids[offsets[i]:offsets[i+1]].
+    """
+    tokens_to_be_computed = np.asarray(attention_mask) == 1
+    packed_ids = np.asarray(texts_ids)[tokens_to_be_computed]
+    offsets = np.zeros((tokens_to_be_computed.shape[0] + 1), dtype=np.int64)
+    np.cumsum(tokens_to_be_computed.sum(axis=-1), out=offsets[1:])
+    return packed_ids, offsets
+
+
+def unpack_texts_ids(
+    packed_ids: np.ndarray,
+    attention_mask: np.ndarray,
+    pad_token_id: int,
+) -> np.ndarray:
+    """Scatters packed token ids, as returned by pack_texts_ids, back to the padded layout of attention_mask.
+
+    Args:
+        packed_ids (np.ndarray): A one-dimensional array with the ids of all non-pad tokens, text after text. Leading
+            dimensions are kept, e.g., (trials, number of non-pad tokens) for several sanitized versions of the texts.
+        attention_mask (np.ndarray): A two-dimensional array where a 0 marks the position of a pad token.
+        pad_token_id (int): The token id of a pad token (depends on the tokenizer)
+
+    Returns:
+        np.ndarray: An array of shape packed_ids.shape[:-1] + attention_mask.shape, with pad_token_id at the position of pad tokens.
+    """
+    texts_ids = np.full(
+        packed_ids.shape[:-1] + attention_mask.shape,
+        pad_token_id,
+        dtype=packed_ids.dtype,
+    )
+    texts_ids[..., np.asarray(attention_mask) == 1] = packed_ids
+    return texts_ids
+
+
+def sanitize_packed_ids(
+    packed_ids: np.ndarray,
+    vocabulary: np.ndarray,
+    dx_constant: float,
+    epsilon: int | np.ndarray,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    tail_mass: float | None = None,
+    neighbor_table: np.ndarray | None = None,
+    vocab_backend=None,
+    safe_radii: np.ndarray | None = None,
+    candidates: CandidateVocabulary | None = None,
+    chunk_size: int | None = None,
+    seed: np.random.SeedSequence | None = None,
+) -> np.ndarray:
+    """Applies the whole dx-privacy mechanism on packed tokens: noise sampling, nearest neighbor search
+    and the post-processing fix proposed in (Asghar et al., 2024). Each step runs once over all the tokens.
+
+    Args:
+        packed_ids (np.ndarray): A one-dimensional array with the ids of the tokens to sanitize, see pack_texts_ids.
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, or a one-dimensional array with
+            the epsilon value of each token.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+        tail_mass (float | None, optional): See apply_post_processing_on_textsV2. Defaults to None.
+        neighbor_table (np.ndarray | None, optional): If set, post-processing neighbors are looked up in this table,
+            see utils.neighbor_table. Defaults to None.
+        vocab_backend (optional): The vocabulary already prepared with dx.prepare_vocabulary, to avoid preparing
+            it again at each call. Defaults to None.
+        safe_radii (np.ndarray | None, optional): The safe radius of each element of the vocabulary for the euclidean
+            distance, see neighbor_table.build_safe_radii. If set, the nearest neighbor search is skipped for the tokens
+            whose noise is shorter than their safe radius, as their nearest neighbor is provably themselves. Defaults to None.
+        candidates (CandidateVocabulary | None, optional): See sanitize_packed_ids_multi_epsilon. Defaults to None.
+        chunk_size (int | None, optional): See sanitize_packed_ids_multi_epsilon. Defaults to None.
+        seed (np.random.SeedSequence | None, optional): See sanitize_packed_ids_multi_epsilon. Defaults to None.
+
+    Returns:
+        np.ndarray: A one-dimensional array with the ids of the sanitized tokens.
+    """
+    _, noisy_packed_ids = next(
+        sanitize_packed_ids_multi_epsilon(
+            packed_ids,
+            vocabulary,
+            dx_constant,
+            [epsilon],
+            distance_metric,
+            backend,
+            tail_mass,
+            neighbor_table,
+            vocab_backend,
+            safe_radii,
+            candidates=candidates,
+            chunk_size=chunk_size,
+            seed=seed,
+        )
+    )
+    return noisy_packed_ids
+
+
+def sanitize_packed_ids_multi_epsilon(
+    packed_ids: np.ndarray,
+    vocabulary: np.ndarray,
+    dx_constant: float,
+    epsilons: list[int | np.ndarray],
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    tail_mass: float | None = None,
+    neighbor_table: np.ndarray | None = None,
+    vocab_backend=None,
+    safe_radii: np.ndarray | None = None,
+    common_noise: bool = False,
+    candidates: CandidateVocabulary | None = None,
+    chunk_size: int | None = None,
+    seed: np.random.SeedSequence | None = None,
+):
+    """Same as sanitize_packed_ids for several epsilon values in a single pass. The embeddings of the tokens are
+    gathered once, and the prepared vocabulary (e.g., copied to GPU, or with its squared norms) as well as the
+    noise buffer are shared by all epsilon values. The sanitized tokens of each epsilon are independent from the
+    ones of the other epsilon values, unless common_noise is True.
+
+    With common_noise, the noise of each token is sampled once for all epsilon values (common random numbers):
+    a unit direction u and a magnitude G (see dx.sample_noise_rays_np), so that the noise for epsilon is
+    (G / epsilon) * u. The noisy embeddings of a token then lie on one ray, and the nearest neighbors of all
+    epsilon values are found in one pass with dx.noisy_rays_to_ids, at the cost of about two searches instead of
+    one per epsilon value. For each epsilon taken separately, the noise, and therefore the privacy guarantee,
+    is unchanged. However, the sanitized tokens of different epsilon values are correlated, which is suitable
+    for sweeping epsilon (the differences between epsilon values have a lower variance) but not for releasing
+    several sanitized versions of the same texts.
+
+    With chunk_size, the tokens are streamed chunk-by-chunk through working buffers of chunk_size embeddings:
+    their embeddings are gathered, noised and searched, then the embeddings of their pivots are gathered for the
+    post-processing, without ever materializing the embeddings of all tokens. Peak memory then depends on chunk_size
+    instead of the number of tokens times the hidden size.
+
+    With seed, the noise and the post-processing of each chunk are drawn from their own random streams derived from
+    seed, the chunk and the epsilon value (see dx.derive_seed), so that the same tokens, parameters and seed always
+    give the same sanitized tokens, e.g., to re-run a task of a sweep (see task_seed). The streams are keyed by the
+    epsilon value rather than its position in epsilons, so an epsilon value gives the same result in any sweep.
+
+    Args:
+        packed_ids (np.ndarray): A one-dimensional array with the ids of the tokens to sanitize, see pack_texts_ids.
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilons (list[int | np.ndarray]): The epsilon values in the dx-privacy formula. Except with common_noise, each
+            of them can also be a one-dimensional array with the epsilon value of each token.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+        tail_mass (float | None, optional): See apply_post_processing_on_textsV2. Defaults to None.
+        neighbor_table (np.ndarray | None, optional): See sanitize_packed_ids. Defaults to None.
+        vocab_backend (optional): See sanitize_packed_ids. Defaults to None.
+        safe_radii (np.ndarray | None, optional): See sanitize_packed_ids. Defaults to None.
+        common_noise (bool, optional): Whether to sample the noise once for all epsilon values, see above. Defaults to False.
+        candidates (CandidateVocabulary | None, optional): If set, the nearest neighbor search and the post-processing
+            only consider these candidates (see utils.candidates), e.g., to never output special tokens. vocab_backend,
+            neighbor_table and safe_radii must then be built for candidates.embeddings. Defaults to None.
+        chunk_size (int | None, optional): The number of tokens processed at a time, see above. Defaults to None,
+            which processes all tokens at once.
+        seed (np.random.SeedSequence | None, optional): The seed of the random streams, see above. Defaults to None,
+            which draws from fresh entropy.
+
+    Yields:
+        tuple[int, np.ndarray]: Each epsilon value, in order, with the one-dimensional array of the ids of the sanitized tokens.
+    """
+    if safe_radii is not None and distance_metric == "cosine":
+        raise ValueError("Safe radii are only valid for the euclidean distance")
+    if common_noise and any(np.ndim(epsilon) > 0 for epsilon in epsilons):
+        raise ValueError("Common noise requires a single epsilon value per pass")
+    # The embeddings of the tokens are taken from the whole vocabulary, as the tokens may not be candidates
+    tokens_vocabulary = vocabulary
+    token_ids = packed_ids
+    if candidates is not None:
+        # Searched and post-processed against the candidates, mapped back to token ids when yielded
+        packed_ids = candidates.to_candidate_ids(packed_ids)
+        vocabulary = candidates.embeddings
+    if vocab_backend is None:
+        vocab_backend = prepare_vocabulary(vocabulary, distance_metric, backend)
+    token_radii = None
+    if safe_radii is not None:
+        # The safe radius of each token, 0 for the tokens which are not candidates (never certified)
+        token_radii = np.where(packed_ids >= 0, safe_radii[packed_ids], 0)
+
+    number_of_tokens = packed_ids.shape[0]
+    if chunk_size is None:
+        chunk_size = number_of_tokens
+    chunk_size = max(1, min(chunk_size, number_of_tokens))
+    chunks = [
+        (i, min(i + chunk_size, number_of_tokens))
+        for i in range(0, number_of_tokens, chunk_size)
+    ]
+    ids_dtype = best_uint_type(vocabulary.shape[0])
+    # Working buffers of chunk_size embeddings, shared by all chunks and epsilon values
+    embeddings = np.empty(
+        (chunk_size, tokens_vocabulary.shape[1]), dtype=tokens_vocabulary.dtype
+    )
+    noisy_embeddings = np.empty_like(embeddings)
+    if len(chunks) == 1:
+        # Gathered once for all epsilon values
+        np.take(tokens_vocabulary, token_ids, axis=0, out=embeddings[:number_of_tokens])
+
+    def gather(start: int, end: int) -> np.ndarray:
+        """The embeddings of the tokens start to end, in the working buffer."""
+        if len(chunks) > 1:
+            np.take(
+                tokens_vocabulary,
+                token_ids[start:end],
+                axis=0,
+                out=embeddings[: end - start],
+            )
+        return embeddings[: end - start]
+
+    def chunk_epsilon(epsilon: int | np.ndarray, start: int, end: int):
+        return epsilon if np.ndim(epsilon) == 0 else epsilon[start:end]
+
+    def chunk_seed(stream: int, epsilon_index: int, chunk_index: int):
+        """The seed of a random stream (0: noise, 1: rays, 2: post-processing) for an epsilon value and a chunk."""
+        return derive_seed(
+            seed,
+            stream,
+            _epsilon_key(epsilons[epsilon_index], epsilon_index),
+            chunk_index,
+        )
+
+    if common_noise:
+        rays_pivot_ids = np.empty((len(epsilons), number_of_tokens), dtype=ids_dtype)
+        searched = 0
+        for chunk_index, (start, end) in enumerate(chunks):
+            rays_pivot_ids[:, start:end], chunk_searched = _rays_pivot_ids(
+                packed_ids[start:end],
+                gather(start, end),
+                vocab_backend,
+                epsilons,
+                distance_metric,
+                backend,
+                None if token_radii is None else token_radii[start:end],
+                ids_dtype,
+                derive_seed(seed, 1, chunk_index),
+            )
+            searched += chunk_searched
+        if token_radii is not None:
+            print_timed(
+                f"Nearest neighbor search skipped for {1 - searched / max(1, number_of_tokens):.2%} of the tokens (certified identity for all epsilon values)"
+            )
+    # Sample the noise with as many threads as the vocabulary prepared for the numpy backend (e.g., one per
+    # worker process, see utils.sharding), or with all cores otherwise.
+    n_threads = getattr(vocab_backend, "n_threads", os.cpu_count())
+
+    for epsilon_index, epsilon in enumerate(epsilons):
+        if common_noise:
+            pivot_ids = rays_pivot_ids[epsilon_index]
+        else:
+            pivot_ids = np.empty(number_of_tokens, dtype=ids_dtype)
+            certified = scanned = 0
+            for chunk_index, (start, end) in enumerate(chunks):
+                pivot_ids[start:end], chunk_certified = _noisy_pivot_ids(
+                    packed_ids[start:end],
+                    gather(start, end),
+                    noisy_embeddings[: end - start],
+                    vocab_backend,
+                    chunk_epsilon(epsilon, start, end),
+                    distance_metric,
+                    backend,
+                    None if token_radii is None else token_radii[start:end],
+                    n_threads,
+                    ids_dtype,
+                    chunk_seed(0, epsilon_index, chunk_index),
+                )
+                certified += chunk_certified
+                if (
+                    isinstance(vocab_backend, PrunedNeighborSearch)
+                    and chunk_certified < end - start
+                ):
+                    scanned += vocab_backend.scanned_fractions.sum()
+            if token_radii is not None:
+                print_timed(
+                    f"Epsilon {describe_epsilon(epsilon)}: nearest neighbor search skipped for {certified / max(1, number_of_tokens):.2%} of the tokens (certified identity)"
+                )
+            if isinstance(vocab_backend, PrunedNeighborSearch):
+                print_timed(
+                    f"Epsilon {describe_epsilon(epsilon)}: the pruned search scanned {scanned / max(1, number_of_tokens - certified):.2%} of the vocabulary"
+                )
+
+        if neighbor_table is not None:
+            noisy_ids = dx_post_processing_from_ids(
+                pivot_ids,
+                neighbor_table,
+                vocab_backend,
                 dx_constant,
                 epsilon,
                 distance_metric,
+                backend,
+                tail_mass,
+                chunk_seed(2, epsilon_index, 0),
             )
+        else:
+            noisy_ids = np.empty(number_of_tokens, dtype=ids_dtype)
+            for chunk_index, (start, end) in enumerate(chunks):
+                # The embeddings of the pivots in the working buffer
+                noisy_ids[start:end] = dx_post_processing(
+                    np.take(
+                        vocabulary,
+                        pivot_ids[start:end],
+                        axis=0,
+                        out=noisy_embeddings[: end - start],
+                    ),
+                    vocab_backend,
+                    dx_constant,
+                    chunk_epsilon(epsilon, start, end),
+                    distance_metric,
+                    backend,
+                    tail_mass,
+                    chunk_seed(2, epsilon_index, chunk_index),
+                )
+        if candidates is not None:
+            noisy_ids = candidates.to_token_ids(noisy_ids)
+        yield epsilon, noisy_ids
+
+
+def _epsilon_key(epsilon: int | np.ndarray, epsilon_index: int) -> int:
+    """Identifies the random streams of an epsilon value, see sanitize_packed_ids_multi_epsilon: the bits of the
+    epsilon value, or its index for an array of epsilon values (offset beyond any float64 bit pattern).
+    """
+    if np.ndim(epsilon) > 0:
+        return 2**64 + epsilon_index
+    return int(np.float64(epsilon).view(np.uint64))
+
+
+def _noisy_pivot_ids(
+    packed_ids: np.ndarray,
+    embeddings: np.ndarray,
+    noisy_embeddings: np.ndarray,
+    vocab_backend,
+    epsilon: int | np.ndarray,
+    distance_metric: str,
+    backend: str,
+    token_radii: np.ndarray | None,
+    n_threads: int,
+    ids_dtype,
+    seed: np.random.SeedSequence | None = None,
+) -> tuple[np.ndarray, int]:
+    """The nearest neighbors of the embeddings with fresh noise for epsilon, see sanitize_packed_ids_multi_epsilon,
+    and the number of tokens certified by token_radii (their safe radii). noisy_embeddings is a buffer of the same
+    shape as embeddings, seed the seed of the noise.
+    """
+    certified = _add_noise(
+        embeddings, noisy_embeddings, epsilon, token_radii, n_threads, seed
+    )
+    pivot_ids = _search_pivot_ids(
+        packed_ids,
+        noisy_embeddings,
+        certified,
+        vocab_backend,
+        distance_metric,
+        backend,
+        ids_dtype,
+    )
+    return pivot_ids, 0 if certified is None else int(certified.sum())
+
+
+def _add_noise(
+    embeddings: np.ndarray,
+    noisy_embeddings: np.ndarray,
+    epsilon: int | np.ndarray,
+    token_radii: np.ndarray | None,
+    n_threads: int,
+    seed: np.random.SeedSequence | None,
+) -> np.ndarray | None:
+    """Fills noisy_embeddings with the embeddings plus fresh noise for epsilon. Returns which tokens are certified
+    by token_radii, i.e., whose noise is shorter than their safe radius, or None without token_radii.
+    """
+    # We need one noise vector per token, without any pad token to skip
+    sample_noise_vectors_np(
+        dimension=embeddings.shape[-1],
+        shape1=1,
+        shape2=embeddings.shape[0],
+        epsilon=epsilon,
+        dtype=embeddings.dtype,
+        out=noisy_embeddings[np.newaxis],
+        n_threads=n_threads,
+        seed=seed,
+    )
+    certified = None
+    if token_radii is not None:
+        noise_norms = np.sqrt(np.einsum("ij,ij->i", noisy_embeddings, noisy_embeddings))
+        certified = noise_norms < token_radii
+    noisy_embeddings += embeddings
+    return certified
+
+
+def _search_pivot_ids(
+    packed_ids: np.ndarray,
+    noisy_embeddings: np.ndarray,
+    certified: np.ndarray | None,
+    vocab_backend,
+    distance_metric: str,
+    backend: str,
+    ids_dtype,
+) -> np.ndarray:
+    """The nearest neighbors of the noisy embeddings, see _add_noise for certified."""
+    if certified is None:
+        return noisy_embeddings_to_ids(
+            noisy_embeddings, vocab_backend, distance_metric, backend
         )
-    return noisy_texts_ids
+    # Only the tokens whose nearest neighbor is not certified to be themselves are searched
+    pivot_ids = packed_ids.astype(ids_dtype)
+    searched = np.flatnonzero(~certified)
+    if searched.shape[0] > 0:
+        pivot_ids[searched] = noisy_embeddings_to_ids(
+            noisy_embeddings[searched], vocab_backend, distance_metric, backend
+        )
+    return pivot_ids
+
+
+def _rays_pivot_ids(
+    packed_ids: np.ndarray,
+    embeddings: np.ndarray,
+    vocab_backend,
+    epsilons: list[int],
+    distance_metric: str,
+    backend: str,
+    token_radii: np.ndarray | None,
+    ids_dtype,
+    seed: np.random.SeedSequence | None = None,
+) -> tuple[np.ndarray, int]:
+    """The nearest neighbors of the embeddings with common noise for all epsilon values, of shape
+    (len(epsilons), packed_ids.shape[0]), see sanitize_packed_ids_multi_epsilon, and the number of rays searched.
+    token_radii is the safe radius of each token, seed the seed of the noise.
+    """
+    directions, magnitudes = sample_noise_rays_np(
+        dimension=embeddings.shape[-1],
+        size=embeddings.shape[0],
+        dtype=embeddings.dtype,
+        seed=seed,
+    )
+    steps = magnitudes[:, np.newaxis] / np.asarray(epsilons, dtype=np.float64)
+    rays_pivot_ids = np.repeat(
+        packed_ids.astype(ids_dtype)[np.newaxis], len(epsilons), axis=0
+    )
+    if token_radii is None:
+        searched = np.arange(packed_ids.shape[0])
+    else:
+        # Only the rays which leave the safe ball of their token for some epsilon are searched
+        searched = np.flatnonzero(steps.max(axis=-1) >= token_radii)
+    if searched.shape[0] > 0:
+        rays_pivot_ids[:, searched] = noisy_rays_to_ids(
+            embeddings[searched],
+            directions[searched],
+            steps[searched],
+            vocab_backend,
+            distance_metric,
+            backend,
+        )
+    return rays_pivot_ids, searched.shape[0]
+
+
+def sanitize_texts_packed(
+    texts_ids: np.ndarray,
+    attention_mask: np.ndarray,
+    vocabulary: np.ndarray,
+    pad_token_id: int,
+    dx_constant: float,
+    epsilon: int | np.ndarray,
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    tail_mass: float | None = None,
+    neighbor_table: np.ndarray | None = None,
+    vocab_backend=None,
+    safe_radii: np.ndarray | None = None,
+    trials: int | None = None,
+    candidates: CandidateVocabulary | None = None,
+    chunk_size: int | None = None,
+    seed: np.random.SeedSequence | None = None,
+) -> np.ndarray:
+    """Applies the whole dx-privacy mechanism on padded texts. Same as sampling noise for texts_embeddings followed by
+    nearest_neighbor_search_on_textsV2 and apply_post_processing_on_textsV2, but the non-pad tokens of all texts are
+    packed into one contiguous array first (see pack_texts_ids). Therefore, no noise is sampled for pad tokens and each
+    step runs once for all texts instead of text-by-text. Pad tokens get pad_token_id as their result.
+
+    Args:
+        texts_ids (np.ndarray): A two-dimensional array containing the token ids of the padded texts.
+        attention_mask (np.ndarray): A two-dimensional array of the same shape as texts_ids, where a 0 marks the position of a pad token.
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        pad_token_id (int): The token id of a pad token (depends on the tokenizer)
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilon (int | np.ndarray): The epsilon value in the dx-privacy formula, or an array broadcastable to the
+            shape of texts_ids, see apply_post_processing_on_textsV2.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+        tail_mass (float | None, optional): See apply_post_processing_on_textsV2. Defaults to None.
+        neighbor_table (np.ndarray | None, optional): See sanitize_packed_ids. Defaults to None.
+        vocab_backend (optional): See sanitize_packed_ids. Defaults to None.
+        safe_radii (np.ndarray | None, optional): See sanitize_packed_ids. Defaults to None.
+        trials (int | None, optional): If set, the number of independent sanitized versions of each text, computed
+            in the same pass: the tokens of all trials are sanitized together as trials times more queries, sharing
+            the prepared vocabulary and the gathered tokens. Defaults to None, which sanitizes each text once.
+        candidates (CandidateVocabulary | None, optional): See sanitize_packed_ids_multi_epsilon. Defaults to None.
+        chunk_size (int | None, optional): See sanitize_packed_ids_multi_epsilon. Defaults to None.
+        seed (np.random.SeedSequence | None, optional): See sanitize_packed_ids_multi_epsilon, e.g., task_seed for
+            this slice of texts. Defaults to None.
+
+    Returns:
+        np.ndarray: A two-dimensional numpy array containing the ids of the sanitized texts, or a three-dimensional
+            array indexed by (trial, text) if trials is set.
+    """
+    if tail_mass is not None:
+        # The largest number of neighbors, for the smallest epsilon value
+        k, dropped_mass = truncation_rank(
+            dx_constant,
+            np.min(epsilon),
+            (vocabulary if candidates is None else candidates).shape[0],
+            tail_mass,
+        )
+        print_timed(
+            f"Post-processing among the {k} nearest neighbors, dropped probability mass: {dropped_mass:.3e}"
+        )
+
+    packed_ids, _ = pack_texts_ids(texts_ids, attention_mask)
+    if np.ndim(epsilon) > 0:
+        # Packed in the same order as the tokens
+        epsilon = np.broadcast_to(epsilon, texts_ids.shape)[
+            np.asarray(attention_mask) == 1
+        ]
+    if trials is not None:
+        # Each trial is a copy of the tokens, with its own noise
+        packed_ids = np.tile(packed_ids, trials)
+        if np.ndim(epsilon) > 0:
+            epsilon = np.tile(epsilon, trials)
+    noisy_packed_ids = sanitize_packed_ids(
+        packed_ids,
+        vocabulary,
+        dx_constant,
+        epsilon,
+        distance_metric,
+        backend,
+        tail_mass,
+        neighbor_table,
+        vocab_backend,
+        safe_radii,
+        candidates,
+        chunk_size,
+        seed,
+    )
+    if trials is not None:
+        noisy_packed_ids = noisy_packed_ids.reshape(trials, -1)
+    return unpack_texts_ids(noisy_packed_ids, attention_mask, pad_token_id)
+
+
+class PackedSanitizationStages:
+    """The steps of sanitize_texts_packed as separate stages, to overlap them across batches with
+    utils.pipeline.run_pipeline: noise sampling (noise), nearest neighbor search (search) and the post-processing fix
+    (post_process). Each stage takes the output of the previous one. For the same seed, the three stages give the same
+    texts as sanitize_texts_packed, without chunk_size and trials.
+
+    search and post_process size their chunks with the whole budget of the planner of the backend (see utils.memory),
+    so they hold a shared lock: only one of them runs at a time, while noise overlaps with either of them.
+    """
+
+    def __init__(
+        self,
+        vocabulary: np.ndarray,
+        pad_token_id: int,
+        dx_constant: float,
+        distance_metric: str = "euclidean",
+        backend: str = "cupy",
+        tail_mass: float | None = None,
+        neighbor_table: np.ndarray | None = None,
+        vocab_backend=None,
+        safe_radii: np.ndarray | None = None,
+        candidates: CandidateVocabulary | None = None,
+    ) -> None:
+        """See sanitize_texts_packed for the arguments."""
+        if safe_radii is not None and distance_metric == "cosine":
+            raise ValueError("Safe radii are only valid for the euclidean distance")
+        self.tokens_vocabulary = vocabulary
+        # Searched and post-processed against the candidates, see sanitize_packed_ids_multi_epsilon
+        self.vocabulary = vocabulary if candidates is None else candidates.embeddings
+        self.pad_token_id = pad_token_id
+        self.dx_constant = dx_constant
+        self.distance_metric = distance_metric
+        self.backend = backend
+        self.tail_mass = tail_mass
+        self.neighbor_table = neighbor_table
+        if vocab_backend is None:
+            vocab_backend = prepare_vocabulary(
+                self.vocabulary, distance_metric, backend
+            )
+        self.vocab_backend = vocab_backend
+        self.safe_radii = safe_radii
+        self.candidates = candidates
+        self.ids_dtype = best_uint_type(self.vocabulary.shape[0])
+        self.n_threads = getattr(vocab_backend, "n_threads", os.cpu_count())
+        # Held by the stages using the device memory budget, see the class
+        self.device_lock = threading.Lock()
+
+    def noise(
+        self,
+        texts_ids: np.ndarray,
+        attention_mask: np.ndarray,
+        epsilon: int | np.ndarray,
+        seed: np.random.SeedSequence | None = None,
+    ) -> dict:
+        """Packs the texts and adds noise to the embeddings of their tokens. See sanitize_texts_packed for the arguments.
+
+        Returns:
+            dict: The state of the batch, for search.
+        """
+        packed_ids, _ = pack_texts_ids(texts_ids, attention_mask)
+        if np.ndim(epsilon) > 0:
+            epsilon = np.broadcast_to(epsilon, texts_ids.shape)[
+                np.asarray(attention_mask) == 1
+            ]
+        token_ids = packed_ids
+        if self.candidates is not None:
+            packed_ids = self.candidates.to_candidate_ids(packed_ids)
+        token_radii = None
+        if self.safe_radii is not None:
+            token_radii = np.where(packed_ids >= 0, self.safe_radii[packed_ids], 0)
+
+        embeddings = np.take(self.tokens_vocabulary, token_ids, axis=0)
+        noisy_embeddings = np.empty_like(embeddings)
+        # The streams of the first chunk and epsilon value of sanitize_packed_ids_multi_epsilon
+        certified = _add_noise(
+            embeddings,
+            noisy_embeddings,
+            epsilon,
+            token_radii,
+            self.n_threads,
+            derive_seed(seed, 0, _epsilon_key(epsilon, 0), 0),
+        )
+        if certified is not None:
+            print_timed(
+                f"Epsilon {describe_epsilon(epsilon)}: nearest neighbor search skipped for {certified.sum() / max(1, certified.shape[0]):.2%} of the tokens (certified identity)"
+            )
+        return {
+            "attention_mask": attention_mask,
+            "epsilon": epsilon,
+            "seed": seed,
+            "packed_ids": packed_ids,
+            "noisy_embeddings": noisy_embeddings,
+            "certified": certified,
+        }
+
+    def search(self, batch: dict) -> dict:
+        """Searches the nearest neighbors of the noisy embeddings of a batch returned by noise.
+
+        Returns:
+            dict: The state of the batch, for post_process.
+        """
+        with self.device_lock:
+            batch["pivot_ids"] = _search_pivot_ids(
+                batch.pop("packed_ids"),
+                batch.pop("noisy_embeddings"),
+                batch.pop("certified"),
+                self.vocab_backend,
+                self.distance_metric,
+                self.backend,
+                self.ids_dtype,
+            )
+        return batch
+
+    def post_process(self, batch: dict) -> np.ndarray:
+        """Applies the post-processing fix on a batch returned by search.
+
+        Returns:
+            np.ndarray: A two-dimensional numpy array containing the ids of the sanitized texts, see sanitize_texts_packed.
+        """
+        pivot_ids = batch["pivot_ids"]
+        seed = derive_seed(batch["seed"], 2, _epsilon_key(batch["epsilon"], 0), 0)
+        with self.device_lock:
+            if self.neighbor_table is not None:
+                noisy_ids = dx_post_processing_from_ids(
+                    pivot_ids,
+                    self.neighbor_table,
+                    self.vocab_backend,
+                    self.dx_constant,
+                    batch["epsilon"],
+                    self.distance_metric,
+                    self.backend,
+                    self.tail_mass,
+                    seed,
+                )
+            else:
+                noisy_ids = dx_post_processing(
+                    np.take(self.vocabulary, pivot_ids, axis=0),
+                    self.vocab_backend,
+                    self.dx_constant,
+                    batch["epsilon"],
+                    self.distance_metric,
+                    self.backend,
+                    self.tail_mass,
+                    seed,
+                )
+        if self.candidates is not None:
+            noisy_ids = self.candidates.to_token_ids(noisy_ids)
+        return unpack_texts_ids(noisy_ids, batch["attention_mask"], self.pad_token_id)
+
+
+def sanitize_texts_packed_multi_epsilon(
+    texts_ids: np.ndarray,
+    attention_mask: np.ndarray,
+    vocabulary: np.ndarray,
+    pad_token_id: int,
+    dx_constant: float,
+    epsilons: list[int],
+    distance_metric: str = "euclidean",
+    backend: str = "cupy",
+    tail_mass: float | None = None,
+    neighbor_table: np.ndarray | None = None,
+    vocab_backend=None,
+    safe_radii: np.ndarray | None = None,
+    common_noise: bool = False,
+    trials: int | None = None,
+    candidates: CandidateVocabulary | None = None,
+    chunk_size: int | None = None,
+    seed: np.random.SeedSequence | None = None,
+):
+    """Same as sanitize_texts_packed for several epsilon values in a single pass over the texts, see
+    sanitize_packed_ids_multi_epsilon.
+
+    Args:
+        texts_ids (np.ndarray): A two-dimensional array containing the token ids of the padded texts.
+        attention_mask (np.ndarray): A two-dimensional array of the same shape as texts_ids, where a 0 marks the position of a pad token.
+        vocabulary (np.ndarray): A two-dimensional array containing all the embeddings of the vocabulary.
+        pad_token_id (int): The token id of a pad token (depends on the tokenizer)
+        dx_constant (float): The c constant in the formula of (Asghar et al., 2024).
+        epsilons (list[int]): The epsilon values in the dx-privacy formula.
+        distance_metric (str, optional): The distance metric to use for ranking elements of the vocabulary. Defaults to "euclidean".
+        backend (str, optional): "cupy" to compute on GPU or "numpy" to compute on CPU. Defaults to "cupy".
+        tail_mass (float | None, optional): See apply_post_processing_on_textsV2. Defaults to None.
+        neighbor_table (np.ndarray | None, optional): See sanitize_packed_ids. Defaults to None.
+        vocab_backend (optional): See sanitize_packed_ids. Defaults to None.
+        safe_radii (np.ndarray | None, optional): See sanitize_packed_ids. Defaults to None.
+        common_noise (bool, optional): See sanitize_packed_ids_multi_epsilon. Defaults to False.
+        trials (int | None, optional): See sanitize_texts_packed. Defaults to None.
+        candidates (CandidateVocabulary | None, optional): See sanitize_packed_ids_multi_epsilon. Defaults to None.
+        chunk_size (int | None, optional): See sanitize_packed_ids_multi_epsilon. Defaults to None.
+        seed (np.random.SeedSequence | None, optional): See sanitize_texts_packed. Without common_noise, each epsilon
+            value gives the same texts as sanitize_texts_packed with the same seed. Defaults to None.
+
+    Yields:
+        tuple[int, np.ndarray]: Each epsilon value, in order, with the two-dimensional array of the ids of the sanitized texts
+            (three-dimensional and indexed by (trial, text) if trials is set).
+    """
+    packed_ids, _ = pack_texts_ids(texts_ids, attention_mask)
+    if trials is not None:
+        # Each trial is a copy of the tokens, with its own noise
+        packed_ids = np.tile(packed_ids, trials)
+    for epsilon, noisy_packed_ids in sanitize_packed_ids_multi_epsilon(
+        packed_ids,
+        vocabulary,
+        dx_constant,
+        epsilons,
+        distance_metric,
+        backend,
+        tail_mass,
+        neighbor_table,
+        vocab_backend,
+        safe_radii,
+        common_noise,
+        candidates,
+        chunk_size,
+        seed,
+    ):
+        if tail_mass is not None:
+            k, dropped_mass = truncation_rank(
+                dx_constant,
+                epsilon,
+                (vocabulary if candidates is None else candidates).shape[0],
+                tail_mass,
+            )
+            print_timed(
+                f"Epsilon {epsilon}: post-processing among the {k} nearest neighbors, dropped probability mass: {dropped_mass:.3e}"
+            )
+        if trials is not None:
+            noisy_packed_ids = noisy_packed_ids.reshape(trials, -1)
+        yield epsilon, unpack_texts_ids(noisy_packed_ids, attention_mask, pad_token_id)
+
+
+def task_seed(master_seed: int, start: int, end: int) -> np.random.SeedSequence:
+    """The seed of the task sanitizing the texts start to end of a sweep, derived from the master seed of the sweep.
+    Each epsilon value then gets its own streams, see sanitize_packed_ids_multi_epsilon, so any (epsilon, texts)
+    task can be re-run on its own, on any machine, and give the same sanitized texts."""
+    return np.random.SeedSequence(master_seed, spawn_key=(start, end))
 
 
-def ids_to_texts(texts_ids: list[list[int]], tokenizer: AutoTokenizer) -> list[str]:
+def ids_to_texts(
+    texts_ids: list[list[int]],
+    tokenizer: "AutoTokenizer",
+    decoder: TableDecoder | None = None,
+    n_processes: int | None = None,
+) -> list[str]:
+    # The decoding table gives the same texts as batch_decode (see detokenizer.check_decoder_parity), faster
+    if decoder is not None:
+        return decoder.decode(np.asarray(texts_ids), n_processes)
     # batch_decode does not exist for some tokenizers
     try:
         return tokenizer.batch_decode(texts_ids, skip_special_tokens=True)
@@ -1,11 +1,22 @@
 import numpy as np
-import cupy as cp
-from cupyx.scipy.spatial import distance
-from datetime import datetime
-import math
-import pickle
-from os.path import join
-from typing import Any, Type
+from typing import Type
+from utils.backends import cp, distance
+from utils.memory import get_planner
+
+# The I/O helpers moved to utils.files, which imports faster. Still importable from utils.tools.
+from utils.files import print_timed, save_pickle, load_pickle
+
+__all__ = [
+    "best_uint_type",
+    "rank_neighbors",
+    "nearest_neighbors_sorted",
+    "nth_nearest_neighbors",
+    "ray_nearest_neighbors",
+    # Re-exported from utils.files
+    "print_timed",
+    "save_pickle",
+    "load_pickle",
+]
 
 
 def best_uint_type(x: int) -> Type[np.unsignedinteger]:
@@ -19,51 +30,6 @@ def best_uint_type(x: int) -> Type[np.unsignedinteger]:
         return np.uint64
 
 
-def print_timed(*args, **kwargs) -> None:
-    print(datetime.now().strftime("%Hh%Mm%Ss"), *args, **kwargs)
-
-
-def save_pickle(
-    folderpath: str, filename: str, toBeSaved, datetime_prefix: bool = False
-) -> None:
-    if datetime_prefix:
-        filename = f"{datetime.now().strftime('%Y-%m-%d_%H.%M.%S')}_{filename}"
-    filepath = join(folderpath, filename)
-
-    with open(filepath, "wb") as f:
-        pickle.dump(toBeSaved, f)
-
-
-def load_pickle(folderpath: str, filename: str) -> Any:
-    with open(join(folderpath, filename), "rb") as f:
-        result = pickle.load(f)
-    return result
-
-
-def best_chunk_size(input_size: int, unitary_size: int) -> int:
-    """Compute the number of elements which can be processed at the same time
-    in a GPU computation. input_size is the amount of bytes which has to be
-    fully loaded in memory during the entire computation. unitary_size is the
-    amount of bytes needed when computing one element, both for storing
-    this element and its associated result."""
-    # Size of unallocated VRAM
-    available_vram = cp.cuda.runtime.memGetInfo()[0]
-
-    mempool = cp.get_default_memory_pool()
-    # Size of VRAM allocated to CuPy but unused
-    cp_mempool_available = mempool.total_bytes() - mempool.used_bytes()
-
-    available_vram = available_vram + cp_mempool_available
-    # Using 90% of the available VRAM
-    available_vram = math.floor(available_vram * 0.90)
-
-    # Memory available for computing elements
-    memory_size = available_vram - input_size
-
-    # Chunk size is at least 1
-    return max(1, math.floor(memory_size / unitary_size))
-
-
 def rank_neighbors(
     embeddings: np.ndarray,
     vocabulary: np.ndarray,
@@ -74,15 +40,10 @@ def rank_neighbors(
     where array[i][j] contains the rank of the j-th vocabulary element in the list of neighbors of
     the i-th embedding. The function benefits from cupy for a faster computation of distances and
     sorting on GPU. Computes chunk-by-chunk to avoid overloading the VRAM."""
-    # Calculate the ideal chunk_size for the computation. Note that cupyx.scipy.spatial.distance.cdist(x1, x2)
-    # first allocates an array of shape (x1.shape[0], x2.shape[0]) with np.float64 precision (8 bytes).
-    # Argsort returns an array of dtype int64 (8 bytes).
-    chunk_size = best_chunk_size(
-        vocabulary.shape[0] * vocabulary.shape[1] * 4,
-        embeddings.shape[1] * 4 + vocabulary.shape[0] * 8 * 2,
+    # The ideal chunk_size for the computation, see utils.memory.MemoryPlanner for the working set of argsort.
+    chunk_size = get_planner("cupy").chunk_size(
+        "rank", vocabulary.shape, embeddings.shape[1]
     )
-    # Argsort allocates more than expected. Choosing a smaller chunk_size for safety.
-    chunk_size = math.floor(chunk_size / 4)
 
     number_of_words = embeddings.shape[0]
     # Copy the vocabulary to GPU. Casting to float32 as distance.cdist will do it anyway,
@@ -95,13 +56,137 @@ def rank_neighbors(
         dtype=best_uint_type(vocab_cp.shape[0]),
     )
 
+    # Ranks scattered at the position of each vocabulary element, this inverts the permutation
+    # returned by argsort in O(vocab_size) instead of sorting a second time.
+    ranks_values = cp.arange(vocab_cp.shape[0], dtype=words_neighbors_ranked.dtype)
+
     for i in range(0, number_of_words, chunk_size):
         j = min(i + chunk_size, number_of_words)
-        words_neighbors_ranked[i:j, :] = (
-            distance.cdist(embeddings[i:j], vocab_cp, distance_metric)
-            .argsort(axis=-1)
-            .argsort(axis=-1)
-            .get()
-        )  # argsort on GPU before copying to RAM with .get()
+        neighbors_sorted = distance.cdist(
+            embeddings[i:j], vocab_cp, distance_metric
+        ).argsort(axis=-1)
+        ranks = cp.empty(neighbors_sorted.shape, dtype=ranks_values.dtype)
+        ranks[cp.arange(j - i)[:, cp.newaxis], neighbors_sorted] = ranks_values
+        words_neighbors_ranked[i:j, :] = ranks.get()  # copying to RAM with .get()
 
     return words_neighbors_ranked
+
+
+def nearest_neighbors_sorted(
+    embeddings: np.ndarray,
+    vocabulary: np.ndarray,
+    k: int,
+    distance_metric: str = "euclidean",
+) -> np.ndarray:
+    """For each embedding, returns the ids of its k nearest elements in the vocabulary sorted
+    by distance, as a numpy array of shape (embeddings.shape[0], k). array[i][r] thus contains
+    the id of the vocabulary element with rank r in the list of neighbors of the i-th embedding.
+    Only the k nearest are sorted, after a partition of the distances. The function benefits from
+    cupy for a faster computation on GPU. Computes chunk-by-chunk to avoid overloading the VRAM.
+    """
+    chunk_size = get_planner("cupy").chunk_size(
+        "top_k", vocabulary.shape, embeddings.shape[1], k
+    )
+
+    number_of_words = embeddings.shape[0]
+    vocab_cp = cp.asarray(vocabulary, dtype="float32")
+
+    words_nearest_neighbors = np.empty(
+        (number_of_words, k), dtype=best_uint_type(vocab_cp.shape[0])
+    )
+
+    for i in range(0, number_of_words, chunk_size):
+        j = min(i + chunk_size, number_of_words)
+        distances = distance.cdist(embeddings[i:j], vocab_cp, distance_metric)
+        candidates = cp.argpartition(distances, k - 1, axis=-1)[:, :k]
+        order = cp.take_along_axis(distances, candidates, axis=-1).argsort(axis=-1)
+        words_nearest_neighbors[i:j, :] = cp.take_along_axis(
+            candidates, order, axis=-1
+        ).get()
+
+    return words_nearest_neighbors
+
+
+def nth_nearest_neighbors(
+    embeddings: np.ndarray,
+    vocabulary: np.ndarray,
+    ranks,
+    distance_metric: str = "euclidean",
+) -> np.ndarray:
+    """For each embedding, returns the id of the vocabulary element whose rank in the list of
+    neighbors of the i-th embedding is ranks[i]. ranks can either be a numpy or a cupy array.
+    Distances, sorting and the look up are computed on GPU with cupy, only the resulting ids are
+    copied back to RAM. Computes chunk-by-chunk to avoid overloading the VRAM."""
+    chunk_size = get_planner("cupy").chunk_size(
+        "nth", vocabulary.shape, embeddings.shape[1]
+    )
+
+    number_of_words = embeddings.shape[0]
+    vocab_cp = cp.asarray(vocabulary, dtype="float32")
+    ranks = cp.asarray(ranks)
+
+    words_neighbors = np.empty(
+        (number_of_words), dtype=best_uint_type(vocab_cp.shape[0])
+    )
+
+    for i in range(0, number_of_words, chunk_size):
+        j = min(i + chunk_size, number_of_words)
+        neighbors_sorted = distance.cdist(
+            embeddings[i:j], vocab_cp, distance_metric
+        ).argsort(axis=-1)
+        words_neighbors[i:j] = cp.take_along_axis(
+            neighbors_sorted, ranks[i:j, cp.newaxis], axis=-1
+        )[:, 0].get()
+
+    return words_neighbors
+
+
+def ray_nearest_neighbors(
+    origins: np.ndarray,
+    directions: np.ndarray,
+    steps: np.ndarray,
+    vocabulary: np.ndarray,
+    distance_metric: str = "euclidean",
+) -> np.ndarray:
+    """For each ray origins[i] + s * directions[i] with unit directions, returns the nearest neighbor in the
+    vocabulary of the points at distances s = steps[i, k] from the origin, as a numpy array of shape
+    (steps.shape[1], origins.shape[0]). Same as search.ExactNeighborSearch.ray_search, on GPU with cupy:
+    the scores along each ray are linear in s and their two terms are computed once with two GEMMs.
+    Computes chunk-by-chunk to avoid overloading the VRAM."""
+    # Three rows of float32 scores per ray (offsets, slopes and their sum) instead of one row of float64 distances
+    chunk_size = max(
+        1,
+        get_planner("cupy").chunk_size("nearest", vocabulary.shape, origins.shape[1])
+        * 2
+        // 3,
+    )
+    number_of_rays, number_of_steps = steps.shape
+    vocab_cp = cp.asarray(vocabulary, dtype="float32")
+    if distance_metric == "cosine":
+        # Not in place, the vocabulary may already be the cupy array prepared by dx.prepare_vocabulary
+        vocab_cp = vocab_cp / cp.maximum(
+            cp.linalg.norm(vocab_cp, axis=-1, keepdims=True), np.finfo(np.float32).tiny
+        )
+        factor, vocab_sq_norms = -1, 0
+    else:
+        factor, vocab_sq_norms = -2, cp.einsum("ij,ij->i", vocab_cp, vocab_cp)
+
+    rays_neighbors = np.empty(
+        (number_of_steps, number_of_rays), dtype=best_uint_type(vocab_cp.shape[0])
+    )
+    for i in range(0, number_of_rays, chunk_size):
+        j = min(i + chunk_size, number_of_rays)
+        offsets = (
+            cp.matmul(factor * cp.asarray(origins[i:j], dtype="float32"), vocab_cp.T)
+            + vocab_sq_norms
+        )
+        slopes = cp.matmul(
+            factor * cp.asarray(directions[i:j], dtype="float32"), vocab_cp.T
+        )
+        steps_cp = cp.asarray(steps[i:j], dtype="float32")
+        for k in range(number_of_steps):
+            rays_neighbors[k, i:j] = (
+                (offsets + steps_cp[:, k, cp.newaxis] * slopes).argmin(axis=-1).get()
+            )
+
+    return rays_neighbors
@@ -8,7 +8,7 @@ from pathlib import Path
 
 # Use utils package from other folder
 sys.path.append(join(str(Path(__file__).parent.parent), "Section4-Summarization"))
-from utils.tools import save_pickle, print_timed
+from utils.files import save_pickle, print_timed
 
 load_dotenv()
 glove_data_folderpath = os.environ["ROOT_SAVE_FOLDER"]
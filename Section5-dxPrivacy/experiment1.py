@@ -11,7 +11,7 @@ from pathlib import Path
 
 # Use utils package from other folder
 sys.path.append(join(str(Path(__file__).parent.parent), "Section4-Summarization"))
-from utils.tools import load_pickle, print_timed
+from utils.files import load_pickle, print_timed
 
 load_dotenv()
 
@@ -13,7 +13,7 @@ from pathlib import Path
 
 # Use utils package from other folder
 sys.path.append(join(str(Path(__file__).parent.parent), "Section4-Summarization"))
-from utils.tools import load_pickle, print_timed, save_pickle
+from utils.files import load_pickle, print_timed, save_pickle
 
 load_dotenv()
 
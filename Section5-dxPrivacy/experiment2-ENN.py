@@ -9,7 +9,7 @@ from pathlib import Path
 # Use utils package from other folder
 sys.path.append(join(str(Path(__file__).parent.parent), "Section4-Summarization"))
 from utils.dx import sample_noise_vectors_np, noisy_embeddings_to_ids_cp
-from utils.tools import load_pickle, save_pickle, print_timed
+from utils.files import load_pickle, save_pickle, print_timed
 
 load_dotenv()
 